@@ -64,8 +64,19 @@ import errno
 import time
 import optparse
 import io
+import mmap
 import platform
 import builtins
+import hashlib
+import bisect
+import ast
+import copy
+import tempfile
+import json
+import collections
+import operator
+import functools
+import threading
 
 # Prevent cluttering user directory with Python bytecode
 sys.dont_write_bytecode = True
@@ -107,7 +118,8 @@ _DIRECT_CALL_KWARG_REGEXP = re.compile(
     r'(?:(?P<kwname>[a-zA-Z_]\w*)\s*=(?=[^=]|$))?')
 
 _DEF_PARAM_REGEXP = re.compile(
-    r'^(?P<name>[a-zA-Z_]\w*)[ \t]*\(\s*(?P<args>.+)?\s*\)$')
+    r'^(?P<name>[a-zA-Z_]\w*)[ \t]*\(\s*(?P<args>.+)?\s*\)'
+    r'(?P<attribs>(?:[ \t]+(?:pure|lazy))*)$')
 
 _SIMPLE_CALLABLE_REGEXP = re.compile(
     r'^(?P<name>[a-zA-Z_][\w.]*)[ \t]*(?:\([ \t]*(?P<args>.*)[ \t]*\))?$')
@@ -124,7 +136,9 @@ _DEL_PARAM_REGEXP = re.compile(
     r'^(?:[(]\s*)?[a-zA-Z_]\w*(?:\s*,\s*[a-zA-Z_]\w*)*(?:\s*[)])?$')
 
 _FOR_PARAM_REGEXP = re.compile(
-    r'^(?P<loopexpr>[a-zA-Z_]\w*(\s*,\s*[a-zA-Z_]\w*)*)\s+in\s+(?P<iter>.+)$')
+    r'^(?:(?P<parallel>parallel)\s+'
+    r'(?=[a-zA-Z_]\w*(?:\s*,\s*[a-zA-Z_]\w*)*\s+in\s))?'
+    r'(?P<loopexpr>[a-zA-Z_]\w*(\s*,\s*[a-zA-Z_]\w*)*)\s+in\s+(?P<iter>.+)$')
 
 _INCLUDE_PARAM_REGEXP = re.compile(r'^(\'|")(?P<fname>.*?)\1$')
 
@@ -140,6 +154,108 @@ _UNESCAPE_TEXT_REGEXP3 = re.compile(r'(\})\\(\\*)([$#@])')
 
 _INLINE_EVAL_REGION_REGEXP = re.compile(r'\${.*?}\$')
 
+# Byte sequences which may indicate a directive or an escaped directive
+_DIRECTIVE_MARKER_REGEXP_BYTES = re.compile(rb'[$#@]\\*[{:]|#\\*!|\}\\*[$#@]')
+
+# Characters, whose encoding must be ASCII compatible to allow scanning of
+# memory mapped files
+_MMAP_SCANNED_CHARS = '\n\r\t $#@{}:!&\\'
+
+# Options, which do not affect the output of a processed file
+_OUTPUT_NEUTRAL_OPTIONS = frozenset([
+    'create_parent_folder', 'mmap_threshold', 'macro_cache_size',
+    'macro_cache_report', 'block_cache_dir', 'cache_dir', 'watch',
+    'watch_interval', 'options_files', 'translate_locations', 'loop_workers',
+    'jobs', 'specialize', 'define_usage', 'memory_report', 'expansion_report',
+    'expansion_json', 'metrics_file', 'depfile', 'depfile_target',
+    'write_if_changed'])
+
+# Marker starting the internal line records, which are converted into source
+# maps or into line markers after rendering
+_LINE_RECORD = '\x00fypp-line\x00'
+
+# Header of source maps in binary format
+_SOURCE_MAP_MAGIC = b'FYPPMAP1'
+
+# Maximal number of folded lines cached by a renderer
+_FOLD_CACHE_SIZE = 4096
+
+# Content of loaded definition and option files
+_LOADED_DATA_FILES = {}
+
+# Nodes changing the scope they are rendered in
+_SCOPE_CHANGING_NODES = ('set', 'def', 'del')
+
+# Nodes with effects beyond the scope they are rendered in (cache blocks share
+# the block cache of the renderer)
+_GLOBAL_EFFECT_NODES = ('global', 'output', 'cache')
+
+# Identifiers in expressions
+_IDENTIFIER_REGEXP = re.compile(r'[a-zA-Z_]\w*')
+
+# Renderer of the parent process in a worker process of parallel loops
+_LOOP_WORKER_STATE = None
+
+# Maximal number of compiled expressions kept by the evaluators
+_COMPILED_EXPR_CACHE_SIZE = 4096
+
+# Types of literal constants which trivial expressions may evaluate to
+_TRIVIAL_CONSTANT_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+# Comparison operators available in trivial expressions
+_TRIVIAL_COMPARISONS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Is: operator.is_, ast.IsNot: operator.is_not,
+    ast.In: lambda item, container: item in container,
+    ast.NotIn: lambda item, container: item not in container,
+}
+
+# Predefined variables depending on the position of the evaluated expression
+_POSITION_DEPENDENT_NAMES = frozenset(
+    ['_LINE_', '_FILE_', '_THIS_FILE_', '_THIS_LINE_', '_TIME_', '_DATE_'])
+
+# Predefined variables depending on the time of the evaluation
+_TIMESTAMP_NAMES = frozenset(['_TIME_', '_DATE_'])
+
+# Builtins without side effects, which may be called in folded expressions
+_FOLDABLE_FUNCTIONS = frozenset(
+    ['abs', 'all', 'any', 'bool', 'chr', 'divmod', 'float', 'hex', 'int', 'len',
+     'max', 'min', 'oct', 'ord', 'repr', 'round', 'sorted', 'str', 'sum',
+     'tuple', 'defined', 'getvar'])
+
+# Syntax elements which may occur in folded expressions (besides operators)
+_FOLDABLE_AST_NODES = (ast.Expression, ast.Name, ast.Call, ast.keyword,
+                       ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare,
+                       ast.IfExp, ast.Tuple, ast.List, ast.Subscript, ast.Slice,
+                       ast.Attribute, ast.expr_context, ast.boolop,
+                       ast.operator, ast.unaryop, ast.cmpop)
+
+# Literal nodes of the various Python versions
+_FOLDABLE_AST_NODE_NAMES = frozenset(
+    ['Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Index'])
+
+# Functions accessing variables by their name
+_VARIABLE_FUNCTIONS = frozenset(
+    ['defined', 'getvar', 'setvar', 'delvar', 'globalvar'])
+
+# Functions which may change variables in the scope of the evaluator
+_SCOPE_ACCESSING_FUNCTIONS = frozenset(
+    ['setvar', 'delvar', 'globalvar', 'globals', 'locals', 'vars', 'eval',
+     'exec'])
+
+# Marks values which could not be determined during specialization
+_UNKNOWN_VALUE = object()
+
+# Names of the methods of FyppHooks
+_HOOK_EVENTS = (
+    'parse_begin', 'parse_end', 'render_node_begin', 'render_node_end',
+    'macro_call_begin', 'macro_call_end', 'include_begin', 'include_end',
+    'eval_begin', 'eval_end', 'write_begin', 'write_end')
+
+# Lock serializing the manipulation of the module search path
+_SYSPATH_LOCK = threading.RLock()
+
 _RESERVED_PREFIX = '__'
 
 _RESERVED_NAMES = set(['defined', 'setvar', 'getvar', 'delvar', 'globalvar',
@@ -158,6 +274,12 @@ _CLOSING_BRACKETS_FORTRAN = '})]'
 
 _ARGUMENT_SPLIT_CHAR_FORTRAN = ','
 
+_ARGSPLIT_TOKEN_REGEXP = re.compile(
+    r'''"[^"]*"|'[^']*'|["'{}()\[\],]''')
+
+_ARGSPLIT_NESTED_TOKEN_REGEXP = re.compile(
+    r'''"[^"]*"|'[^']*'|["'{}()\[\]]''')
+
 
 class FyppError(Exception):
     '''Signalizes error occurring during preprocessing.
@@ -218,9 +340,14 @@ class Parser:
             be searched for, when they are not found at the default location.
 
         encoding (str): Encoding to use when reading the file (default: utf-8)
+
+        mmapthreshold (int): Files with a size (in bytes) of at least this value
+            are memory mapped and only the regions containing directives are
+            decoded as whole. Directive free regions are passed as text in
+            between. If None (default), files are always read completely.
     '''
 
-    def __init__(self, includedirs=None, encoding='utf-8'):
+    def __init__(self, includedirs=None, encoding='utf-8', mmapthreshold=None):
 
         # Directories to search for include files
         if includedirs is None:
@@ -231,12 +358,25 @@ class Parser:
         # Encoding
         self._encoding = encoding
 
+        # Minimal file size for memory mapped parsing
+        self._mmapthreshold = mmapthreshold
+
         # Name of current file
         self._curfile = None
 
         # Directory of current file
         self._curdir = None
 
+        # Included files and unsuccessfully probed locations for each of them
+        self._includedfiles = []
+
+        # Real paths of files, whose include directives should be ignored
+        self._skippedincludes = set()
+
+        # Cache for include file lookups and the events of parsed include
+        # files (possibly shared with other parsers)
+        self._includecache = None
+
 
     def parsefile(self, fobj):
         '''Parses file or a file like object.
@@ -244,6 +384,7 @@ class Parser:
         Args:
             fobj (str or file): Name of a file or a file like object.
         '''
+        self._includedfiles = []
         if isinstance(fobj, str):
             if fobj == STDIN:
                 self._includefile(None, sys.stdin, STDIN, os.getcwd())
@@ -260,22 +401,91 @@ class Parser:
         olddir = self._curdir
         self._curfile = fname
         self._curdir = curdir
-        self._parse_txt(span, fname, fobj.read())
+        mapped = self._map_file(fobj)
+        if mapped is None:
+            self._parse_txt(span, fname, fobj.read())
+        else:
+            try:
+                self.handle_include(span, fname)
+                self._parse_mapped(mapped)
+                self.handle_endinclude(span, fname)
+            finally:
+                mapped.close()
         self._curfile = oldfile
         self._curdir = olddir
 
 
+    def _map_file(self, fobj):
+        '''Returns a read-only memory map of the file or None, if the file
+        should be (or can only be) read in the conventional way.'''
+        if self._mmapthreshold is None or not _is_ascii_compatible(
+                self._encoding):
+            return None
+        try:
+            fileno = fobj.fileno()
+            if os.fstat(fileno).st_size < max(self._mmapthreshold, 1):
+                return None
+            mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            return None
+        # Files with carriage returns need newline translation -> no mapping
+        if mapped.find(b'\r') != -1:
+            mapped.close()
+            return None
+        return mapped
+
+
     def parse(self, txt):
         '''Parses string.
 
         Args:
             txt (str): Text to parse.
         '''
+        self._includedfiles = []
         self._curfile = STRING
         self._curdir = ''
         self._parse_txt(None, self._curfile, txt)
 
 
+    def share_include_cache(self, cache):
+        '''Caches the location of include files and the parsing events they
+        generate.
+
+        The cache can be shared between parsers with identical settings, also
+        if they run in different threads. It should be only used as long as the
+        include files (and the files in the include search path) do not
+        change.
+
+        Args:
+            cache (dict): Dictionary to store the cached data in. Pass an empty
+                dictionary, or one passed to another parser before.
+        '''
+        self._includecache = cache
+
+
+    def get_included_files(self):
+        '''Returns the files included during the last parsing.
+
+        Returns:
+            list of tuple: Path of each included file (as found in the include
+            search path) and the list of the paths, which were probed without
+            success before it was found.
+        '''
+        return list(self._includedfiles)
+
+
+    def skip_include_files(self, fnames):
+        '''Ignores include directives referring to given files from now on.
+
+        The include directive of such a file is processed as if the file was
+        empty.
+
+        Args:
+            fnames (list of str): Names of the files to ignore.
+        '''
+        self._skippedincludes.update(os.path.realpath(fname) for fname in fnames)
+
+
     def handle_include(self, span, fname):
         '''Called when parser starts to process a new file.
 
@@ -316,7 +526,7 @@ class Parser:
         self._log_event('set', span, name=name, expression=expr)
 
 
-    def handle_def(self, span, name, args):
+    def handle_def(self, span, name, args, pure=False, lazy=False):
         '''Called when parser encounters a def directive.
 
         It is a stub method and should be overridden for actual use.
@@ -325,8 +535,11 @@ class Parser:
             span (tuple of int): Start and end line of the directive.
             name (str): Name of the macro to be defined.
             argexpr (str): String with argument definition (or None)
+            pure (bool): Whether the macro was declared as pure.
+            lazy (bool): Whether the macro was declared as lazy.
         '''
-        self._log_event('def', span, name=name, arguments=args)
+        self._log_event('def', span, name=name, arguments=args, pure=pure,
+                        lazy=lazy)
 
 
     def handle_enddef(self, span, name):
@@ -399,7 +612,7 @@ class Parser:
         self._log_event('endif', span)
 
 
-    def handle_for(self, span, varexpr, iterator):
+    def handle_for(self, span, varexpr, iterator, parallel=False):
         '''Called when parser encounters a for directive.
 
         It is a stub method and should be overridden for actual use.
@@ -409,8 +622,10 @@ class Parser:
             varexpr (str): String representation of the loop variable
                 expression.
             iterator (str): String representation of the iterable.
+            parallel (bool): Whether the loop was declared as parallel.
         '''
-        self._log_event('for', span, variable=varexpr, iterable=iterator)
+        self._log_event('for', span, variable=varexpr, iterable=iterator,
+                        parallel=parallel)
 
 
     def handle_endfor(self, span):
@@ -540,6 +755,53 @@ class Parser:
         self._log_event('endmute', span)
 
 
+    def handle_cache(self, span, keyexpr):
+        '''Called when parser finds a cache directive.
+
+        It is a stub method and should be overridden for actual use.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+            keyexpr (str): String representation of the cache key expression.
+        '''
+        self._log_event('cache', span, keyexpr=keyexpr)
+
+
+    def handle_endcache(self, span):
+        '''Called when parser finds an endcache directive.
+
+        It is a stub method and should be overridden for actual use.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+        '''
+        self._log_event('endcache', span)
+
+
+    def handle_output(self, span, pathexpr):
+        '''Called when parser finds an output directive.
+
+        It is a stub method and should be overridden for actual use.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+            pathexpr (str): String representation of the output path
+                expression.
+        '''
+        self._log_event('output', span, pathexpr=pathexpr)
+
+
+    def handle_endoutput(self, span):
+        '''Called when parser finds an endoutput directive.
+
+        It is a stub method and should be overridden for actual use.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+        '''
+        self._log_event('endoutput', span)
+
+
     def handle_stop(self, span, msg):
         '''Called when parser finds an stop directive.
 
@@ -621,6 +883,37 @@ class Parser:
             self._process_text(txt[pos:], (linenr, endlinenr))
 
 
+    def _parse_mapped(self, buf):
+        # Regions containing directive markers are decoded and parsed as usual,
+        # regions in between are passed as text without regex scanning.
+        # Region boundaries are always at line starts.
+        size = len(buf)
+        pos = 0
+        linenr = 0
+        match = _DIRECTIVE_MARKER_REGEXP_BYTES.search(buf)
+        while match is not None:
+            start = max(pos, buf.rfind(b'\n', pos, match.start()) + 1)
+            end = _find_mapped_region_end(buf, match.end())
+            match = _DIRECTIVE_MARKER_REGEXP_BYTES.search(buf, end)
+            # Merge directive regions on adjacent lines
+            while (match is not None
+                   and buf.rfind(b'\n', end, match.start()) == -1):
+                end = _find_mapped_region_end(buf, match.end())
+                match = _DIRECTIVE_MARKER_REGEXP_BYTES.search(buf, end)
+            if start > pos:
+                txt = buf[pos:start].decode(self._encoding)
+                endlinenr = linenr + txt.count('\n')
+                self.handle_text((linenr, endlinenr), txt)
+                linenr = endlinenr
+            txt = buf[start:end].decode(self._encoding)
+            self._parse(txt, linenr=linenr)
+            linenr += txt.count('\n')
+            pos = end
+        if pos < size:
+            txt = buf[pos:size].decode(self._encoding)
+            self.handle_text((linenr, linenr + txt.count('\n')), txt)
+
+
     def _process_text(self, txt, span):
         escaped_txt = self._unescape(txt)
         self.handle_text(span, escaped_txt)
@@ -681,6 +974,22 @@ class Parser:
             self._check_param_presence(False, 'endmute', param, span)
             self._check_not_inline_directive('endmute', span)
             self.handle_endmute(span)
+        elif directive == 'cache':
+            self._check_param_presence(True, 'cache', param, span)
+            self._check_not_inline_directive('cache', span)
+            self.handle_cache(span, param)
+        elif directive == 'endcache':
+            self._check_param_presence(False, 'endcache', param, span)
+            self._check_not_inline_directive('endcache', span)
+            self.handle_endcache(span)
+        elif directive == 'output':
+            self._check_param_presence(True, 'output', param, span)
+            self._check_not_inline_directive('output', span)
+            self.handle_output(span, param)
+        elif directive == 'endoutput':
+            self._check_param_presence(False, 'endoutput', param, span)
+            self._check_not_inline_directive('endoutput', span)
+            self.handle_endoutput(span)
         elif directive == 'stop':
             self._check_param_presence(True, 'stop', param, span)
             self._check_not_inline_directive('stop', span)
@@ -732,7 +1041,10 @@ class Parser:
             raise FyppFatalError(msg, self._curfile, span)
         name = match.group('name')
         argexpr = match.group('args')
-        self.handle_def(span, name, argexpr)
+        # Attributes are only passed if set, so that builders not knowing them
+        # can still process plain definitions
+        attribs = {attrib: True for attrib in match.group('attribs').split()}
+        self.handle_def(span, name, argexpr, **attribs)
 
 
     def _process_enddef(self, param, span):
@@ -776,7 +1088,8 @@ class Parser:
             raise FyppFatalError(msg, self._curfile, span)
         loopexpr = match.group('loopexpr')
         loopvars = [s.strip() for s in loopexpr.split(',')]
-        self.handle_for(span, loopvars, match.group('iter'))
+        parallel = match.group('parallel') is not None
+        self.handle_for(span, loopvars, match.group('iter'), parallel)
 
 
     def _process_call(self, param, span, blockcall):
@@ -814,18 +1127,78 @@ class Parser:
             msg = "invalid include file declaration '{0}'".format(param)
             raise FyppFatalError(msg, self._curfile, span)
         fname = match.group('fname')
+        fpath, probed = self._find_include_file(fname, span)
+        self._includedfiles.append((fpath, probed))
+        if self._skippedincludes \
+                and os.path.realpath(fpath) in self._skippedincludes:
+            self.handle_include(span, fpath)
+            self.handle_endinclude(span, fpath)
+            return
+        if self._includecache is None:
+            self._parse_include_file(span, fpath)
+        else:
+            self._replay_include_file(span, fpath)
+
+
+    def _find_include_file(self, fname, span):
+        key = ('location', self._curdir, fname)
+        if self._includecache is not None and key in self._includecache:
+            return self._includecache[key]
+        probed = []
         for incdir in [self._curdir] + self._includedirs:
             fpath = os.path.join(incdir, fname)
             if os.path.exists(fpath):
                 break
+            probed.append(fpath)
         else:
             msg = "include file '{0}' not found".format(fname)
             raise FyppFatalError(msg, self._curfile, span)
+        if self._includecache is not None:
+            self._includecache[key] = (fpath, probed)
+        return fpath, probed
+
+
+    def _parse_include_file(self, span, fpath):
         inpfp = _open_input_file(fpath, self._encoding)
         self._includefile(span, inpfp, fpath, os.path.dirname(fpath))
         inpfp.close()
 
 
+    def _replay_include_file(self, span, fpath):
+        '''Generates the events of an include file, using the events recorded
+        when parsing it the first time.'''
+        key = ('events', fpath)
+        cached = self._includecache.get(key)
+        if cached is not None:
+            events, includedfiles = cached
+            self._includedfiles += includedfiles
+            self.handle_include(span, fpath)
+            for name, args, keywords in events:
+                getattr(self, name)(*args, **keywords)
+            self.handle_endinclude(span, fpath)
+            return
+        events = []
+        ninclude = len(self._includedfiles)
+        # Events are recorded by wrapping the current event handlers
+        handlers = {}
+        for name in dir(self):
+            if name.startswith('handle_'):
+                handlers[name] = self.__dict__.get(name)
+                setattr(self, name, _get_event_recorder(
+                    events, name, getattr(self, name)))
+        try:
+            self._parse_include_file(span, fpath)
+        finally:
+            for name, handler in handlers.items():
+                if handler is None:
+                    delattr(self, name)
+                else:
+                    setattr(self, name, handler)
+        # Opening and closing events depend on the including directive
+        self._includecache[key] = (events[1:-1],
+                                   self._includedfiles[ninclude:])
+
+
     def _process_mute(self, span):
         if span[0] == span[1]:
             msg = 'Inline form of mute directive not allowed'
@@ -863,8 +1236,252 @@ class Parser:
         return txt
 
 
+class _Node:
+
+    '''Base class for the nodes of the tree created by the Builder.
+
+    Nodes store their data in slots. For backwards compatibility they can
+    also be indexed and unpacked like the tuples used in earlier versions:
+    the first item is the name of the directive, followed by the node fields
+    in the order given in `_FIELDS`.
+    '''
+
+    __slots__ = ()
+
+    # Name of the directive the node represents
+    directive = None
+
+    # Name of the fields, in the order they appear in the tuple representation
+    _FIELDS = ()
+
+    def __getitem__(self, ind):
+        return self.astuple()[ind]
+
+
+    def __len__(self):
+        return len(self._FIELDS) + 1
+
+
+    def __iter__(self):
+        return iter(self.astuple())
+
+
+    def __repr__(self):
+        return '{0}{1!r}'.format(self.__class__.__name__, self.astuple())
+
+
+    def astuple(self):
+        '''Returns the tuple representation of the node.'''
+        return (self.directive,) + tuple(getattr(self, name)
+                                         for name in self._FIELDS)
+
+
+class _TextNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'txt')
+    directive = 'txt'
+
+    def __init__(self, fname, span, txt):
+        self.fname = fname
+        self.span = span
+        self.txt = txt
+
+
+class _IfNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'conds', 'contents')
+    directive = 'if'
+
+    def __init__(self, fname, spans, conds, contents):
+        self.fname = fname
+        self.spans = spans
+        self.conds = conds
+        self.contents = contents
+
+
+class _EvalNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'expr')
+    directive = 'eval'
+
+    def __init__(self, fname, span, expr):
+        self.fname = fname
+        self.span = span
+        self.expr = expr
+
+
+class _DefNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'name', 'argexpr', 'content',
+                           'pure', 'lazy')
+    directive = 'def'
+
+    def __init__(self, fname, spans, name, argexpr, content, pure=False,
+                 lazy=False):
+        self.fname = fname
+        self.spans = spans
+        self.name = name
+        self.argexpr = argexpr
+        self.content = content
+        self.pure = pure
+        self.lazy = lazy
+
+
+class _SetNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'name', 'expr')
+    directive = 'set'
+
+    def __init__(self, fname, span, name, expr):
+        self.fname = fname
+        self.span = span
+        self.name = name
+        self.expr = expr
+
+
+class _DelNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'name')
+    directive = 'del'
+
+    def __init__(self, fname, span, name):
+        self.fname = fname
+        self.span = span
+        self.name = name
+
+
+class _ForNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'loopvars', 'iterator', 'content',
+                           'parallel')
+    directive = 'for'
+
+    def __init__(self, fname, spans, loopvars, iterator, content,
+                 parallel=False):
+        self.fname = fname
+        self.spans = spans
+        self.loopvars = loopvars
+        self.iterator = iterator
+        self.content = content
+        self.parallel = parallel
+
+
+class _CallNode(_Node):
+    _FIELDS = ('fname', 'spans', 'name', 'argexpr', 'args', 'argnames')
+    __slots__ = ('directive',) + _FIELDS
+
+    def __init__(self, directive, fname, spans, name, argexpr, args,
+                 argnames):
+        self.directive = directive
+        self.fname = fname
+        self.spans = spans
+        self.name = name
+        self.argexpr = argexpr
+        self.args = args
+        self.argnames = argnames
+
+
+class _IncludeNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'includefname', 'content')
+    directive = 'include'
+
+    def __init__(self, fname, spans, includefname, content):
+        self.fname = fname
+        self.spans = spans
+        self.includefname = includefname
+        self.content = content
+
+
+class _CommentNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span')
+    directive = 'comment'
+
+    def __init__(self, fname, span):
+        self.fname = fname
+        self.span = span
+
+
+class _MuteNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'content')
+    directive = 'mute'
+
+    def __init__(self, fname, spans, content):
+        self.fname = fname
+        self.spans = spans
+        self.content = content
+
+
+class _CacheNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'keyexpr', 'content')
+    directive = 'cache'
+
+    def __init__(self, fname, spans, keyexpr, content):
+        self.fname = fname
+        self.spans = spans
+        self.keyexpr = keyexpr
+        self.content = content
+
+
+class _OutputNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'spans', 'pathexpr', 'content')
+    directive = 'output'
+
+    def __init__(self, fname, spans, pathexpr, content):
+        self.fname = fname
+        self.spans = spans
+        self.pathexpr = pathexpr
+        self.content = content
+
+
+class _StopNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'msg')
+    directive = 'stop'
+
+    def __init__(self, fname, span, msg):
+        self.fname = fname
+        self.span = span
+        self.msg = msg
+
+
+class _AssertNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'cond')
+    directive = 'assert'
+
+    def __init__(self, fname, span, cond):
+        self.fname = fname
+        self.span = span
+        self.cond = cond
+
+
+class _GlobalNode(_Node):
+    __slots__ = _FIELDS = ('fname', 'span', 'name')
+    directive = 'global'
+
+    def __init__(self, fname, span, name):
+        self.fname = fname
+        self.span = span
+        self.name = name
+
+
+# Node classes by directive name
+_NODE_CLASSES = {
+    nodeclass.directive: nodeclass for nodeclass in (
+        _TextNode, _IfNode, _EvalNode, _DefNode, _SetNode, _DelNode, _ForNode,
+        _IncludeNode, _CommentNode, _MuteNode, _CacheNode, _OutputNode,
+        _StopNode, _AssertNode, _GlobalNode)
+}
+_NODE_CLASSES['call'] = _NODE_CLASSES['block'] = _CallNode
+
+
+def _node_from_tuple(node):
+    '''Converts the tuple representation of a node into a node object.'''
+    nodeclass = _NODE_CLASSES.get(node[0])
+    if nodeclass is None:
+        msg = "internal error: unknown command '{0}'".format(node[0])
+        raise FyppFatalError(msg)
+    if nodeclass is _CallNode:
+        return _CallNode(*node)
+    return nodeclass(*node[1:])
+
+
 class Builder:
     '''Builds a tree representing a text with preprocessor directives.
+
+    The tree is a list of node objects. Each node can be also accessed as a
+    tuple, containing the name of the directive and the node data.
     '''
 
     def __init__(self):
@@ -909,7 +1526,7 @@ class Builder:
         self._path.append(self._curnode)
         self._curnode = []
         self._open_blocks.append(
-            ('include', self._curfile, [span], fname, None))
+            _IncludeNode(self._curfile, [span], fname, None))
         self._curfile = fname
         self._nr_prev_blocks.append(len(self._open_blocks))
 
@@ -924,29 +1541,28 @@ class Builder:
         '''
         nprev_blocks = self._nr_prev_blocks.pop(-1)
         if len(self._open_blocks) > nprev_blocks:
-            directive, fname, spans = self._open_blocks[-1][0:3]
+            block = self._open_blocks[-1]
             msg = '{0} directive still unclosed when reaching end of file'\
-                  .format(directive)
-            raise FyppFatalError(msg, self._curfile, spans[0])
+                  .format(block.directive)
+            raise FyppFatalError(msg, self._curfile, block.spans[0])
         block = self._open_blocks.pop(-1)
-        directive, blockfname, spans = block[0:3]
-        if directive != 'include':
+        if block.directive != 'include':
             msg = 'internal error: last open block is not \'include\' when '\
                   'closing file \'{0}\''.format(fname)
             raise FyppFatalError(msg)
-        if span != spans[0]:
+        if span != block.spans[0]:
             msg = 'internal error: span for include and endinclude differ ('\
-                  '{0} vs {1}'.format(span, spans[0])
+                  '{0} vs {1}'.format(span, block.spans[0])
             raise FyppFatalError(msg)
-        oldfname, _ = block[3:5]
-        if fname != oldfname:
+        if fname != block.includefname:
             msg = 'internal error: mismatching file name in close_file event'\
-                  " (expected: '{0}', got: '{1}')".format(oldfname, fname)
+                  " (expected: '{0}', got: '{1}')".format(block.includefname,
+                                                          fname)
             raise FyppFatalError(msg, fname)
-        block = directive, blockfname, spans, fname, self._curnode
+        block.content = self._curnode
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
-        self._curfile = blockfname
+        self._curfile = block.fname
 
 
     def handle_if(self, span, cond):
@@ -958,7 +1574,7 @@ class Builder:
         '''
         self._path.append(self._curnode)
         self._curnode = []
-        self._open_blocks.append(('if', self._curfile, [span], [cond], []))
+        self._open_blocks.append(_IfNode(self._curfile, [span], [cond], []))
 
 
     def handle_elif(self, span, cond):
@@ -970,12 +1586,11 @@ class Builder:
         '''
         self._check_for_open_block(span, 'elif')
         block = self._open_blocks[-1]
-        directive, _, spans = block[0:3]
-        self._check_if_matches_last(directive, 'if', spans[-1], span, 'elif')
-        conds, contents = block[3:5]
-        conds.append(cond)
-        contents.append(self._curnode)
-        spans.append(span)
+        self._check_if_matches_last(block.directive, 'if', block.spans[-1],
+                                    span, 'elif')
+        block.conds.append(cond)
+        block.contents.append(self._curnode)
+        block.spans.append(span)
         self._curnode = []
 
 
@@ -987,12 +1602,11 @@ class Builder:
         '''
         self._check_for_open_block(span, 'else')
         block = self._open_blocks[-1]
-        directive, _, spans = block[0:3]
-        self._check_if_matches_last(directive, 'if', spans[-1], span, 'else')
-        conds, contents = block[3:5]
-        conds.append('True')
-        contents.append(self._curnode)
-        spans.append(span)
+        self._check_if_matches_last(block.directive, 'if', block.spans[-1],
+                                    span, 'else')
+        block.conds.append('True')
+        block.contents.append(self._curnode)
+        block.spans.append(span)
         self._curnode = []
 
 
@@ -1004,16 +1618,15 @@ class Builder:
         '''
         self._check_for_open_block(span, 'endif')
         block = self._open_blocks.pop(-1)
-        directive, _, spans = block[0:3]
-        self._check_if_matches_last(directive, 'if', spans[-1], span, 'endif')
-        _, contents = block[3:5]
-        contents.append(self._curnode)
-        spans.append(span)
+        self._check_if_matches_last(block.directive, 'if', block.spans[-1],
+                                    span, 'endif')
+        block.contents.append(self._curnode)
+        block.spans.append(span)
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
 
 
-    def handle_for(self, span, loopvar, iterator):
+    def handle_for(self, span, loopvar, iterator, parallel=False):
         '''Should be called to signalize a for directive.
 
         Args:
@@ -1021,11 +1634,13 @@ class Builder:
             varexpr (str): String representation of the loop variable
                 expression.
             iterator (str): String representation of the iterable.
+            parallel (bool): Whether the iterations may be rendered in
+                parallel.
         '''
         self._path.append(self._curnode)
         self._curnode = []
-        self._open_blocks.append(('for', self._curfile, [span], loopvar,
-                                  iterator, None))
+        self._open_blocks.append(
+            _ForNode(self._curfile, [span], loopvar, iterator, None, parallel))
 
 
     def handle_endfor(self, span):
@@ -1036,27 +1651,30 @@ class Builder:
         '''
         self._check_for_open_block(span, 'endfor')
         block = self._open_blocks.pop(-1)
-        directive, fname, spans = block[0:3]
-        self._check_if_matches_last(directive, 'for', spans[-1], span, 'endfor')
-        loopvar, iterator, stub = block[3:6]
-        spans.append(span)
-        block = (directive, fname, spans, loopvar, iterator, self._curnode)
+        self._check_if_matches_last(block.directive, 'for', block.spans[-1],
+                                    span, 'endfor')
+        block.spans.append(span)
+        block.content = self._curnode
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
 
 
-    def handle_def(self, span, name, argexpr):
+    def handle_def(self, span, name, argexpr, pure=False, lazy=False):
         '''Should be called to signalize a def directive.
 
         Args:
             span (tuple of int): Start and end line of the directive.
             name (str): Name of the macro to be defined.
             argexpr (str): Macro argument definition or None
+            pure (bool): Whether the macro was declared as pure, so that its
+                results can be memoized.
+            lazy (bool): Whether the arguments passed to the macro in the body
+                of a call directive should only be rendered when first used.
         '''
         self._path.append(self._curnode)
         self._curnode = []
-        defblock = ('def', self._curfile, [span], name, argexpr, None)
-        self._open_blocks.append(defblock)
+        self._open_blocks.append(
+            _DefNode(self._curfile, [span], name, argexpr, None, pure, lazy))
 
 
     def handle_enddef(self, span, name):
@@ -1069,15 +1687,14 @@ class Builder:
         '''
         self._check_for_open_block(span, 'enddef')
         block = self._open_blocks.pop(-1)
-        directive, fname, spans = block[0:3]
-        self._check_if_matches_last(directive, 'def', spans[-1], span, 'enddef')
-        defname, argexpr, stub = block[3:6]
-        if name is not None and name != defname:
+        self._check_if_matches_last(block.directive, 'def', block.spans[-1],
+                                    span, 'enddef')
+        if name is not None and name != block.name:
             msg = "wrong name in enddef directive "\
-                  "(expected '{0}', got '{1}')".format(defname, name)
-            raise FyppFatalError(msg, fname, span)
-        spans.append(span)
-        block = (directive, fname, spans, defname, argexpr, self._curnode)
+                  "(expected '{0}', got '{1}')".format(block.name, name)
+            raise FyppFatalError(msg, block.fname, span)
+        block.spans.append(span)
+        block.content = self._curnode
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
 
@@ -1097,7 +1714,8 @@ class Builder:
         self._curnode = []
         directive = 'block' if blockcall else 'call'
         self._open_blocks.append(
-            (directive, self._curfile, [span, span], name, argexpr, [], []))
+            _CallNode(directive, self._curfile, [span, span], name, argexpr,
+                      [], []))
 
 
     def handle_nextarg(self, span, name, blockcall):
@@ -1112,20 +1730,19 @@ class Builder:
         '''
         self._check_for_open_block(span, 'nextarg')
         block = self._open_blocks[-1]
-        directive, fname, spans = block[0:3]
         if blockcall:
             opened, current = 'block', 'contains'
         else:
             opened, current = 'call', 'nextarg'
-        self._check_if_matches_last(directive, opened, spans[-1], span, current)
-        args, argnames = block[5:7]
-        args.append(self._curnode)
-        spans.append(span)
+        self._check_if_matches_last(block.directive, opened, block.spans[-1],
+                                    span, current)
+        block.args.append(self._curnode)
+        block.spans.append(span)
         if name is not None:
-            argnames.append(name)
-        elif argnames:
+            block.argnames.append(name)
+        elif block.argnames:
             msg = 'non-keyword argument following keyword argument'
-            raise FyppFatalError(msg, fname, span)
+            raise FyppFatalError(msg, block.fname, span)
         self._curnode = []
 
 
@@ -1141,18 +1758,19 @@ class Builder:
         '''
         self._check_for_open_block(span, 'endcall')
         block = self._open_blocks.pop(-1)
-        directive, fname, spans = block[0:3]
-        callname, callargexpr, args, argnames = block[3:7]
         if blockcall:
             opened, current = 'block', 'endblock'
         else:
             opened, current = 'call', 'endcall'
-        self._check_if_matches_last(directive, opened, spans[0], span, current)
+        self._check_if_matches_last(block.directive, opened, block.spans[0],
+                                    span, current)
 
-        if name is not None and name != callname:
+        if name is not None and name != block.name:
             msg = "wrong name in {0} directive "\
-                  "(expected '{1}', got '{2}')".format(current, callname, name)
-            raise FyppFatalError(msg, fname, span)
+                  "(expected '{1}', got '{2}')".format(current, block.name,
+                                                       name)
+            raise FyppFatalError(msg, block.fname, span)
+        args, argnames, spans = block.args, block.argnames, block.spans
         args.append(self._curnode)
         # If nextarg or endcall immediately followed call, then first argument
         # is empty and should be removed (to allow for calls without arguments
@@ -1163,7 +1781,6 @@ class Builder:
             del args[0]
             del spans[1]
         spans.append(span)
-        block = (directive, fname, spans, callname, callargexpr, args, argnames)
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
 
@@ -1177,7 +1794,7 @@ class Builder:
             expr (str): String representation of the expression to be assigned
                 to the variable.
         '''
-        self._curnode.append(('set', self._curfile, span, name, expr))
+        self._curnode.append(_SetNode(self._curfile, span, name, expr))
 
 
     def handle_global(self, span, name):
@@ -1187,7 +1804,7 @@ class Builder:
             span (tuple of int): Start and end line of the directive.
             name (str): Name of the variable(s) to make global.
         '''
-        self._curnode.append(('global', self._curfile, span, name))
+        self._curnode.append(_GlobalNode(self._curfile, span, name))
 
 
     def handle_del(self, span, name):
@@ -1197,7 +1814,7 @@ class Builder:
             span (tuple of int): Start and end line of the directive.
             name (str): Name of the variable(s) to delete.
         '''
-        self._curnode.append(('del', self._curfile, span, name))
+        self._curnode.append(_DelNode(self._curfile, span, name))
 
 
     def handle_eval(self, span, expr):
@@ -1208,7 +1825,7 @@ class Builder:
             expr (str): String representation of the Python expression to
                 be evaluated.
         '''
-        self._curnode.append(('eval', self._curfile, span, expr))
+        self._curnode.append(_EvalNode(self._curfile, span, expr))
 
 
     def handle_comment(self, span):
@@ -1220,7 +1837,7 @@ class Builder:
         Args:
             span (tuple of int): Start and end line of the directive.
         '''
-        self._curnode.append(('comment', self._curfile, span))
+        self._curnode.append(_CommentNode(self._curfile, span))
 
 
     def handle_text(self, span, txt):
@@ -1230,7 +1847,7 @@ class Builder:
             span (tuple of int): Start and end line of the text.
             txt (str): Text.
         '''
-        self._curnode.append(('txt', self._curfile, span, txt))
+        self._curnode.append(_TextNode(self._curfile, span, txt))
 
 
     def handle_mute(self, span):
@@ -1241,7 +1858,7 @@ class Builder:
         '''
         self._path.append(self._curnode)
         self._curnode = []
-        self._open_blocks.append(('mute', self._curfile, [span], None))
+        self._open_blocks.append(_MuteNode(self._curfile, [span], None))
 
 
     def handle_endmute(self, span):
@@ -1252,11 +1869,69 @@ class Builder:
         '''
         self._check_for_open_block(span, 'endmute')
         block = self._open_blocks.pop(-1)
-        directive, fname, spans = block[0:3]
-        self._check_if_matches_last(directive, 'mute', spans[-1], span,
-                                    'endmute')
-        spans.append(span)
-        block = (directive, fname, spans, self._curnode)
+        self._check_if_matches_last(block.directive, 'mute', block.spans[-1],
+                                    span, 'endmute')
+        block.spans.append(span)
+        block.content = self._curnode
+        self._curnode = self._path.pop(-1)
+        self._curnode.append(block)
+
+
+    def handle_cache(self, span, keyexpr):
+        '''Should be called to signalize a cache directive.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+            keyexpr (str): String representation of the cache key expression.
+        '''
+        self._path.append(self._curnode)
+        self._curnode = []
+        self._open_blocks.append(
+            _CacheNode(self._curfile, [span], keyexpr, None))
+
+
+    def handle_endcache(self, span):
+        '''Should be called to signalize an endcache directive.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+        '''
+        self._check_for_open_block(span, 'endcache')
+        block = self._open_blocks.pop(-1)
+        self._check_if_matches_last(block.directive, 'cache', block.spans[-1],
+                                    span, 'endcache')
+        block.spans.append(span)
+        block.content = self._curnode
+        self._curnode = self._path.pop(-1)
+        self._curnode.append(block)
+
+
+    def handle_output(self, span, pathexpr):
+        '''Should be called to signalize an output directive.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+            pathexpr (str): String representation of the output path
+                expression.
+        '''
+        self._path.append(self._curnode)
+        self._curnode = []
+        self._open_blocks.append(
+            _OutputNode(self._curfile, [span], pathexpr, None))
+
+
+    def handle_endoutput(self, span):
+        '''Should be called to signalize an endoutput directive.
+
+        Args:
+            span (tuple of int): Start and end line of the directive.
+        '''
+        self._check_for_open_block(span, 'endoutput')
+        block = self._open_blocks.pop(-1)
+        self._check_if_matches_last(block.directive, 'output',
+                                    block.spans[-1], span, 'endoutput')
+        block.spans.append(span)
+        block.content = self._curnode
         self._curnode = self._path.pop(-1)
         self._curnode.append(block)
 
@@ -1267,7 +1942,7 @@ class Builder:
         Args:
             span (tuple of int): Start and end line of the directive.
         '''
-        self._curnode.append(('stop', self._curfile, span, msg))
+        self._curnode.append(_StopNode(self._curfile, span, msg))
 
 
     def handle_assert(self, span, cond):
@@ -1276,7 +1951,7 @@ class Builder:
         Args:
             span (tuple of int): Start and end line of the directive.
         '''
-        self._curnode.append(('assert', self._curfile, span, cond))
+        self._curnode.append(_AssertNode(self._curfile, span, cond))
 
 
     @property
@@ -1311,28 +1986,321 @@ class Builder:
             raise FyppFatalError(msg, self._curfile, curspan)
 
 
-class Renderer:
+class _Specializer:
 
-    ''''Renders a tree.
+    '''Specializes trees for variables with fixed values.
+
+    Expressions depending only on the fixed variables are replaced by literals
+    of their values, and branches of if directives with conditions known to be
+    false (or following a condition known to be true) are removed together
+    with the directives and include files they contain. Rendering the
+    specialized tree yields the same output as rendering the original one.
 
     Args:
-        evaluator (Evaluator, optional): Evaluator to use when rendering eval
-            directives. If None (default), Evaluator() is used.
-        linenums (bool, optional): Whether linenums should be generated,
-            defaults to False.
-        contlinenums (bool, optional): Whether linenums for continuation
-            should be generated, defaults to False.
-        linenumformat (str, optional): 'std', 'cpp' or 'gfortran5' depending
-            what kind of line directives should be created. Default: 'cpp'.
-            Format 'std' emits #line pragmas, 'cpp' resembles GNU cpps special
+        evaluator (Evaluator): Evaluator used for rendering the trees.
+        fixedvalues (dict): Values of the variables to consider as fixed. A
+            variable is only treated as fixed, if its value in the evaluator at
+            the time of the specialization equals the given one, if it is never
+            assigned by the specialized tree or by any macro defined in the
+            evaluator, and if its value is immutable.
+    '''
+
+    def __init__(self, evaluator, fixedvalues):
+        self._evaluator = evaluator
+        # Mutable values could be changed by method calls in expressions
+        self._fixedvalues = {name: value for name, value in fixedvalues.items()
+                             if _is_immutable_literal(value)}
+        self._folder = None
+        self._fixednames = None
+        self._foldable = None
+        self._folded = None
+
+
+    def specialize(self, tree):
+        '''Returns the specialized version of a tree.
+
+        Args:
+            tree (fypp-tree): Tree to specialize (left unchanged).
+
+        Returns:
+            fypp-tree: Specialized tree. It is the original tree, if no
+            variable could be treated as fixed.
+        '''
+        assigned = set()
+        if not self._collect_assigned_names(tree, assigned, set()):
+            return tree
+        globalscope = self._evaluator.globalscope
+        fixedvalues = {
+            name: value for name, value in self._fixedvalues.items()
+            if name not in assigned and name in globalscope
+            and type(globalscope[name]) is type(value)
+            and globalscope[name] == value}
+        if not fixedvalues:
+            return tree
+        self._folder = Evaluator()
+        for name, value in fixedvalues.items():
+            self._folder.define(name, value)
+        self._fixednames = set(fixedvalues)
+        # Builtins rebound in the global scope (e.g. by -D) must not be folded
+        self._foldable = set(_FOLDABLE_FUNCTIONS.difference(assigned)
+                             .difference(globalscope))
+        self._foldable.update(fixedvalues)
+        self._folded = {}
+        # Variables read by folded expressions count as read by the tree
+        self._folder.start_recording_variables()
+        try:
+            return self._specialize(tree)
+        finally:
+            self._evaluator.record_variables(
+                self._folder.stop_recording_variables())
+            self._folder = self._fixednames = self._foldable = None
+            self._folded = None
+
+
+    def _collect_assigned_names(self, tree, assigned, checkedmacros):
+        '''Collects the names of the variables a tree may assign to.
+
+        Returns False, if the assigned variables can not be determined.
+        '''
+        for node in tree:
+            if not isinstance(node, _Node):
+                node = _node_from_tuple(node)
+            directive = node.directive
+            if directive in ('txt', 'comment'):
+                continue
+            exprs = []
+            subtrees = []
+            if directive in ('set', 'del', 'global'):
+                assigned.update(_IDENTIFIER_REGEXP.findall(node.name))
+                if directive == 'set':
+                    exprs = [node.expr]
+            elif directive == 'eval':
+                exprs = [node.expr]
+            elif directive == 'if':
+                exprs = node.conds
+                subtrees = node.contents
+            elif directive == 'for':
+                assigned.update(node.loopvars)
+                exprs = [node.iterator]
+                subtrees = [node.content]
+            elif directive == 'def':
+                assigned.add(node.name)
+                assigned.update(_IDENTIFIER_REGEXP.findall(node.argexpr or ''))
+                exprs = [node.argexpr]
+                subtrees = [node.content]
+            elif directive in ('call', 'block'):
+                assigned.update(name for name in node.argnames if name)
+                exprs = [node.name, node.argexpr]
+                subtrees = node.args
+            elif directive in ('include', 'mute'):
+                subtrees = [node.content]
+            elif directive == 'cache':
+                exprs = [node.keyexpr]
+                subtrees = [node.content]
+            elif directive == 'output':
+                exprs = [node.pathexpr]
+                subtrees = [node.content]
+            elif directive == 'stop':
+                exprs = [node.msg]
+            elif directive == 'assert':
+                exprs = [node.cond]
+            for expr in exprs:
+                if expr is not None \
+                   and not self._collect_assigned_in_expr(expr, assigned,
+                                                          checkedmacros):
+                    return False
+            for subtree in subtrees:
+                if not self._collect_assigned_names(subtree, assigned,
+                                                    checkedmacros):
+                    return False
+        return True
+
+
+    def _collect_assigned_in_expr(self, expr, assigned, checkedmacros):
+        globalscope = self._evaluator.globalscope
+        names = _IDENTIFIER_REGEXP.findall(expr)
+        for name in names:
+            value = globalscope.get(name)
+            if isinstance(value, _Macro) and id(value) not in checkedmacros:
+                checkedmacros.add(id(value))
+                if not self._collect_assigned_names(value.content, assigned,
+                                                    checkedmacros):
+                    return False
+        if _SCOPE_ACCESSING_FUNCTIONS.isdisjoint(names):
+            return True
+        try:
+            tree = ast.parse(expr.lstrip(' \t'), mode='eval')
+        except SyntaxError:
+            return True
+        calls = {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                calls[id(node.func)] = node
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Name) \
+               or node.id not in _SCOPE_ACCESSING_FUNCTIONS:
+                continue
+            call = calls.get(id(node))
+            varname = _get_string_constant(call.args[0]) \
+                if call is not None and call.args else None
+            if node.id not in _VARIABLE_FUNCTIONS or varname is None:
+                return False
+            assigned.update(_IDENTIFIER_REGEXP.findall(varname))
+        return True
+
+
+    def _specialize(self, tree):
+        specialized = []
+        for node in tree:
+            if not isinstance(node, _Node):
+                node = _node_from_tuple(node)
+            directive = node.directive
+            if directive == 'if':
+                node = self._specialize_if(node)
+            elif directive in ('eval', 'set'):
+                node = self._replace_fields(node, expr=self._fold(node.expr))
+            elif directive == 'assert':
+                if self._get_truth(node.cond):
+                    node = self._replace_fields(node, cond='True')
+            elif directive == 'for':
+                node = self._replace_fields(
+                    node, iterator=self._fold(node.iterator),
+                    content=self._specialize(node.content))
+            elif directive in ('call', 'block'):
+                node = self._replace_fields(
+                    node, args=[self._specialize(arg) for arg in node.args])
+            elif directive in ('def', 'include', 'mute', 'cache', 'output'):
+                node = self._replace_fields(
+                    node, content=self._specialize(node.content))
+            specialized.append(node)
+        return specialized
+
+
+    def _specialize_if(self, node):
+        spans = []
+        conds = []
+        contents = []
+        for cond, content, span in zip(node.conds, node.contents, node.spans):
+            truth = self._get_truth(cond)
+            if truth is False:
+                continue
+            spans.append(span)
+            conds.append('True' if truth else cond)
+            contents.append(self._specialize(content))
+            if truth:
+                break
+        spans.append(node.spans[-1])
+        return self._replace_fields(node, spans=spans, conds=conds,
+                                    contents=contents)
+
+
+    @staticmethod
+    def _replace_fields(node, **fields):
+        values = [fields.get(name, getattr(node, name)) for name in node._FIELDS]
+        return _node_from_tuple([node.directive] + values)
+
+
+    def _get_truth(self, expr):
+        '''Returns the truth value of an expression or None if unknown.'''
+        value = self._evaluate(expr)
+        if value is _UNKNOWN_VALUE:
+            return None
+        try:
+            return bool(value)
+        except Exception:
+            return None
+
+
+    def _fold(self, expr):
+        '''Returns an expression, replaced by a literal if possible.'''
+        value = self._evaluate(expr)
+        if value is _UNKNOWN_VALUE:
+            return expr
+        literal = _get_literal_expression(value)
+        return expr if literal is None else literal
+
+
+    def _evaluate(self, expr):
+        if expr is None:
+            return _UNKNOWN_VALUE
+        value = self._folded.get(expr, None)
+        if value is not None:
+            return value[0]
+        value = _UNKNOWN_VALUE
+        if self._is_foldable(expr):
+            try:
+                value = self._folder.evaluate(expr)
+            except Exception:
+                # Error must be raised at its position during rendering
+                pass
+        self._folded[expr] = (value,)
+        return value
+
+
+    def _is_foldable(self, expr):
+        try:
+            tree = ast.parse(expr.lstrip(' \t'), mode='eval')
+        except SyntaxError:
+            return False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id not in self._foldable:
+                    return False
+            elif isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name):
+                    return False
+                if node.func.id in _VARIABLE_FUNCTIONS:
+                    varname = _get_string_constant(node.args[0]) \
+                        if node.args else None
+                    if varname not in self._fixednames:
+                        return False
+            elif not isinstance(node, _FOLDABLE_AST_NODES) \
+                 and node.__class__.__name__ not in _FOLDABLE_AST_NODE_NAMES:
+                return False
+        return True
+
+
+
+class Renderer:
+
+    ''''Renders a tree.
+
+    Args:
+        evaluator (Evaluator, optional): Evaluator to use when rendering eval
+            directives. If None (default), Evaluator() is used.
+        linenums (bool, optional): Whether linenums should be generated,
+            defaults to False.
+        contlinenums (bool, optional): Whether linenums for continuation
+            should be generated, defaults to False.
+        linenumformat (str, optional): 'std', 'cpp' or 'gfortran5' depending
+            what kind of line directives should be created. Default: 'cpp'.
+            Format 'std' emits #line pragmas, 'cpp' resembles GNU cpps special
             format, and 'gfortran5' adds to cpp a workaround for a bug introduced in GFortran 5.
+            Format 'records' emits internal line records, which must be
+            converted into a source map (SourceMap.from_output()) or into line
+            markers before output.
         linefolder (callable): Callable to use when folding a line.
         filevarroot (str, optional): render _FILE_ and _THIS_FILE_ as paths relative to this
             root directory (default: paths are not converted explicitely to relative paths)
+        macrocachesize (int, optional): Maximal nr. of results memoized for
+            each macro declared as pure (default: 256). If zero, results of
+            pure macros are not memoized.
+        blockcachedir (str, optional): Directory where the output of cache
+            directives should be stored, so that it can be reused in
+            subsequent runs. Default: None (output is only cached in memory).
+        lazyargs (bool, optional): Whether arguments passed to macros in the
+            body of call directives should be passed lazily, even if the macro
+            was not declared as lazy (which renders them when entered).
+            Default: False.
+        loopworkers (int, optional): Number of processes rendering the
+            iterations of loops declared as parallel. Default: None (number of
+            CPUs). If less than two, all loops are rendered serially.
     '''
 
     def __init__(self, evaluator=None, linenums=False, contlinenums=False,
-                 linenumformat=None, linefolder=None, filevarroot=None):
+                 linenumformat=None, linefolder=None, filevarroot=None,
+                 macrocachesize=256, blockcachedir=None, lazyargs=False,
+                 loopworkers=None):
         # Evaluator to use for Python expressions
         self._evaluator = Evaluator() if evaluator is None else evaluator
         self._evaluator.updateglobals(_SYSTEM_=platform.system(),
@@ -1352,10 +2320,16 @@ class Renderer:
         # Whether line numbering directives in continuation lines are needed.
         self._contlinenums = contlinenums
 
-        # Line number formatter function and whether gfortran5 fix is needed
+        # Line number format (also distinguishing cached outputs), formatter
+        # function and whether gfortran5 fix is needed
+        self._linenumformat = linenumformat
         if linenumformat is None or linenumformat in ('cpp', 'gfortran5'):
             self._linenumdir = linenumdir_cpp
             self._linenum_gfortran5 = linenumformat == 'gfortran5'
+        elif linenumformat == 'records':
+            # Flag of main file is recorded and dropped later if not needed
+            self._linenumdir = _linenumdir_record
+            self._linenum_gfortran5 = True
         else:
             self._linenumdir = linenumdir_std
             self._linenum_gfortran5 = False
@@ -1366,6 +2340,16 @@ class Renderer:
         else:
             self._linefolder = linefolder
 
+        # Lines up to this length are left unchanged by the folder (-1: unknown)
+        self._foldlimit = getattr(self._linefolder, 'maxlen', -1)
+
+        # Folded lines by their content (first in, first out). As the folder
+        # does not change, the content determines the result. The cache is
+        # switched off (set to None), if it is hardly ever hit.
+        self._foldcache = collections.OrderedDict()
+        self._foldcachehits = 0
+        self._foldcachemisses = 0
+
         if filevarroot is None:
             self._convert_file_path = lambda path: path
         else:
@@ -1373,6 +2357,60 @@ class Renderer:
                 lambda path: pathlib.Path(path).relative_to(filevarroot)
             )
 
+        # Maximal nr. of memoized results per pure macro
+        self._macrocachesize = macrocachesize
+
+        # Macros declared as pure (in order of their definition)
+        self._pure_macros = []
+
+        # Whether call body arguments of all macros are rendered lazily
+        self._lazyargs = lazyargs
+
+        # Nr. of processes for parallel loops (only available if processes
+        # can be forked, as they must inherit the state of the evaluator)
+        if loopworkers is None:
+            loopworkers = os.cpu_count() or 1
+        if not hasattr(os, 'fork'):
+            loopworkers = 1
+        self._loopworkers = loopworkers
+
+        # Pool of worker processes for parallel loops (kept during a render)
+        # and the state it was forked in (variables and loop data)
+        self._looppool = None
+        self._loopforkstate = None
+
+        # Nr. of nested render() calls
+        self._renderdepth = 0
+
+        # Rendered output of cache directives by key digest and the directory
+        # to store them in for subsequent runs
+        self._block_cache = {}
+        self._blockcachedir = blockcachedir
+
+        # Digest of the content and position of the cache directives by the
+        # identity of their content (kept along with the content, so that the
+        # identity is not reused during the render)
+        self._block_digests = {}
+
+        # Rendered content of output directives by the (unresolved) path of
+        # the file it should be written to
+        self._output_files = {}
+
+        # Tracker notified about the buffers of rendered trees (or None)
+        self._memorytracker = None
+
+        # Tracker collecting the output produced by each source line (or None)
+        self._expansiontracker = None
+
+        # Hooks notified about rendering events (or None)
+        self._hooks = None
+
+        # Whether trees must be rendered by _render_instrumented()
+        self._instrumented = False
+
+        # Dispatch table for rendering the nodes of the tree
+        self._node_renderers = self._get_node_renderers()
+
 
     def render(self, tree, divert=False, fixposition=False):
         '''Renders a tree.
@@ -1392,9 +2430,23 @@ class Renderer:
         self._diverted = divert
         fixedposition_old = self._fixedposition
         self._fixedposition = self._fixedposition or fixposition
-        output, eval_inds, eval_pos = self._render(tree)
+        expansiontracker = self._expansiontracker
+        if expansiontracker is not None:
+            expansiontracker.renderdepth += 1
+        self._renderdepth += 1
+        try:
+            output, eval_inds, eval_pos = self._render(tree)
+        finally:
+            if expansiontracker is not None:
+                expansiontracker.renderdepth -= 1
+            self._renderdepth -= 1
+            if not self._renderdepth:
+                self._close_loop_pool()
+                self._block_digests = {}
         if not self._diverted and eval_inds:
             self._postprocess_eval_lines(output, eval_inds, eval_pos)
+        if self._memorytracker is not None:
+            self._memorytracker.finish_render(tree, output, eval_inds, eval_pos)
         self._diverted = diverted
         self._fixedposition = fixedposition_old
         txt = ''.join(output)
@@ -1402,61 +2454,196 @@ class Renderer:
         return txt
 
 
+    def set_memory_tracker(self, tracker):
+        '''Sets the tracker to notify about the buffers of rendered trees.
+
+        Args:
+            tracker (_MemoryTracker): Tracker or None.
+        '''
+        self._memorytracker = tracker
+
+
+    def set_expansion_tracker(self, tracker):
+        '''Sets the tracker collecting the output produced by each source
+        line.
+
+        Args:
+            tracker (_ExpansionTracker): Tracker or None.
+        '''
+        self._expansiontracker = tracker
+        self._instrumented = tracker is not None or self._hooks is not None
+
+
+    def set_hooks(self, hooks):
+        '''Sets the hooks to notify about rendering events.
+
+        Args:
+            hooks (FyppHooks): Hooks or None.
+        '''
+        self._hooks = hooks
+        self._instrumented = hooks is not None \
+            or self._expansiontracker is not None
+
+
+    @property
+    def hooks(self):
+        'Hooks notified about rendering events (or None).'
+        return self._hooks
+
+
+    def pop_output_files(self):
+        '''Returns the content diverted by output directives and forgets it.
+
+        Returns:
+            dict: Rendered content for each path passed to an output directive
+            (in the order of their first appearance). The content of all
+            directives with the same path is concatenated.
+        '''
+        outputfiles = self._output_files
+        self._output_files = {}
+        return outputfiles
+
+
+    def get_macro_cache_stats(self):
+        '''Returns the memoization statistics of the macros declared as pure.
+
+        Returns:
+            list of tuple: Name, file, line (starting with zero) of the
+            definition and the result of the macros cache_info() method for
+            each pure macro defined so far.
+        '''
+        return [(macro.name, macro.fname, macro.spans[0][0], macro.cache_info())
+                for macro in self._pure_macros]
+
+
     def _render(self, tree):
+        if self._instrumented:
+            return self._render_instrumented(tree)
         output = []
         eval_inds = []
         eval_pos = []
+        node_renderers = self._node_renderers
         for node in tree:
-            cmd = node[0]
-            if cmd == 'txt':
-                output.append(node[3])
-            elif cmd == 'if':
-                out, ieval, peval = self._get_conditional_content(*node[1:5])
-                eval_inds += _shiftinds(ieval, len(output))
-                eval_pos += peval
-                output += out
-            elif cmd == 'eval':
-                out, ieval, peval = self._get_eval(*node[1:4])
-                eval_inds += _shiftinds(ieval, len(output))
-                eval_pos += peval
-                output += out
-            elif cmd == 'def':
-                result = self._define_macro(*node[1:6])
-                output.append(result)
-            elif cmd == 'set':
-                result = self._define_variable(*node[1:5])
+            nodeclass = node.__class__
+            if nodeclass is _TextNode:
+                output.append(node.txt)
+                continue
+            renderer = node_renderers.get(nodeclass)
+            if renderer is None:
+                node = _node_from_tuple(node)
+                if node.__class__ is _TextNode:
+                    output.append(node.txt)
+                    continue
+                renderer = node_renderers[node.__class__]
+            render_node, get_args = renderer
+            result = render_node(*get_args(node))
+            if result.__class__ is str:
                 output.append(result)
-            elif cmd == 'del':
-                self._delete_variable(*node[1:4])
-            elif cmd == 'for':
-                out, ieval, peval = self._get_iterated_content(*node[1:6])
-                eval_inds += _shiftinds(ieval, len(output))
-                eval_pos += peval
+            elif result is not None:
+                out, ieval, peval = result
+                if ieval:
+                    eval_inds += _shiftinds(ieval, len(output))
+                    eval_pos += peval
                 output += out
-            elif cmd == 'call' or cmd == 'block':
-                out, ieval, peval = self._get_called_content(*node[1:7])
-                eval_inds += _shiftinds(ieval, len(output))
-                eval_pos += peval
-                output += out
-            elif cmd == 'include':
-                out, ieval, peval = self._get_included_content(*node[1:5])
-                eval_inds += _shiftinds(ieval, len(output))
-                eval_pos += peval
+        return output, eval_inds, eval_pos
+
+
+    def _get_node_renderers(self):
+        '''Returns the dispatch table for rendering the various nodes.
+
+        Each entry maps a node class to a tuple containing the rendering method
+        and a getter extracting its arguments from the node. The method returns
+        either a string, None, or a tuple containing the output list, the
+        indices of evaluated expressions in the output and their position in
+        the source.
+        '''
+        def delete_variable(fname, span, name):
+            self._delete_variable(fname, span, name)
+
+        def add_global(fname, span, name):
+            self._add_global(fname, span, name)
+
+        methods = {
+            _IfNode: self._get_conditional_content,
+            _EvalNode: self._get_eval,
+            _DefNode: self._define_macro,
+            _SetNode: self._define_variable,
+            _DelNode: delete_variable,
+            _ForNode: self._get_iterated_content,
+            _CallNode: self._get_called_content,
+            _IncludeNode: self._get_included_content,
+            _CommentNode: self._get_comment,
+            _MuteNode: self._get_muted_content,
+            _CacheNode: self._get_cached_content,
+            _OutputNode: self._get_diverted_output,
+            _StopNode: self._handle_stop,
+            _AssertNode: self._handle_assert,
+            _GlobalNode: add_global,
+        }
+        return {nodeclass: (method, operator.attrgetter(*nodeclass._FIELDS))
+                for nodeclass, method in methods.items()}
+
+
+    def _render_instrumented(self, tree):
+        '''Renders a tree as _render(), but notifies the hooks about each node
+        and attributes the output of each node (without the output of its
+        child nodes) to its source line, if an expansion tracker is set.'''
+        output = []
+        eval_inds = []
+        eval_pos = []
+        node_renderers = self._node_renderers
+        hooks = self._hooks
+        tracker = self._expansiontracker
+        # Output of nested render() calls (e.g. of macros) is attributed to
+        # the node triggering them
+        if tracker is not None and tracker.renderdepth != 1:
+            tracker = None
+        for node in tree:
+            if not isinstance(node, _Node):
+                node = _node_from_tuple(node)
+            nodeclass = node.__class__
+            if hooks is not None:
+                hooks.render_node_begin(node)
+            if nodeclass is _TextNode:
+                out = [node.txt]
+                if tracker is not None:
+                    tracker.attribute(node.fname, node.span[0], out,
+                                      tracker.attributed)
                 output += out
-            elif cmd == 'comment':
-                output.append(self._get_comment(*node[1:3]))
-            elif cmd == 'mute':
-                output.append(self._get_muted_content(*node[1:4]))
-            elif cmd == 'stop':
-                self._handle_stop(*node[1:4])
-            elif cmd == 'assert':
-                result = self._handle_assert(*node[1:4])
-                output.append(result)
-            elif cmd == 'global':
-                self._add_global(*node[1:4])
+                if hooks is not None:
+                    hooks.render_node_end(node)
+                continue
+            render_node, get_args = node_renderers[nodeclass]
+            if tracker is None:
+                result = render_node(*get_args(node))
             else:
-                msg = "internal error: unknown command '{0}'".format(cmd)
-                raise FyppFatalError(msg)
+                attributed = tracker.attributed
+                # Muted output is dropped, so its nodes must not be attributed
+                muted = nodeclass is _MuteNode
+                tracker.renderdepth += muted
+                try:
+                    result = render_node(*get_args(node))
+                finally:
+                    tracker.renderdepth -= muted
+            if result.__class__ is str:
+                out = [result]
+            elif result is None:
+                out = []
+            else:
+                out, ieval, peval = result
+                if ieval:
+                    eval_inds += _shiftinds(ieval, len(output))
+                    eval_pos += peval
+            if tracker is not None:
+                span = node.span if hasattr(node, 'span') else node.spans[0]
+                if span is None:
+                    # Root node of the processed input (an include node)
+                    tracker.attribute(node.includefname, 0, out, attributed)
+                else:
+                    tracker.attribute(node.fname, span[0], out, attributed)
+            output += out
+            if hooks is not None:
+                hooks.render_node_end(node)
         return output, eval_inds, eval_pos
 
 
@@ -1504,7 +2691,8 @@ class Renderer:
         return out, ieval, peval
 
 
-    def _get_iterated_content(self, fname, spans, loopvars, loopiter, content):
+    def _get_iterated_content(self, fname, spans, loopvars, loopiter, content,
+                              parallel=False):
         out = []
         ieval = []
         peval = []
@@ -1515,15 +2703,25 @@ class Renderer:
                 .format(loopiter)
             raise FyppFatalError(msg, fname, spans[0]) from exc
         multiline = (spans[0][0] != spans[-1][1])
-        for var in iterobj:
-            if len(loopvars) == 1:
-                self._define(loopvars[0], var)
-            else:
-                for varname, value in zip(loopvars, var):
-                    self._define(varname, value)
+        results = None
+        names = set()
+        checkedmacros = set()
+        if parallel and self._loopworkers > 1 and _LOOP_WORKER_STATE is None\
+                and not self._is_observed() and\
+                not self._has_side_effects(content, True, checkedmacros,
+                                           names):
+            items = list(iterobj)
+            iterobj = items
+            results = self._render_iterations_in_parallel(
+                loopvars, items, content, names, checkedmacros)
+            if results is not None and items:
+                self._define_loop_variables(loopvars, items[-1])
+        if results is None:
+            results = (self._render_iteration(loopvars, var, content)
+                       for var in iterobj)
+        for outcont, ievalcont, pevalcont in results:
             if self._linenums and not self._diverted and multiline:
                 out.append(self._linenumdir(spans[0][1], fname))
-            outcont, ievalcont, pevalcont = self._render(content)
             ieval += _shiftinds(ievalcont, len(out))
             peval += pevalcont
             out += outcont
@@ -1532,12 +2730,272 @@ class Renderer:
         return out, ieval, peval
 
 
+    def _is_observed(self):
+        '''Whether the rendering is observed (by hooks, metrics, trackers or
+        the recording of the read variables). Loops are then rendered serially,
+        as events in forked workers would not reach the observers.'''
+        return self._instrumented or self._memorytracker is not None\
+            or self._evaluator.recording_variables
+
+
+    def _define_loop_variables(self, loopvars, var):
+        if len(loopvars) == 1:
+            self._define(loopvars[0], var)
+        else:
+            for varname, value in zip(loopvars, var):
+                self._define(varname, value)
+
+
+    def _render_iteration(self, loopvars, var, content):
+        self._define_loop_variables(loopvars, var)
+        return self._render(content)
+
+
+    def _render_iterations_in_parallel(self, loopvars, items, content, names,
+                                       checkedmacros):
+        '''Renders the loop iterations in forked worker processes.
+
+        The worker pool is kept until the outermost render() call returns. The
+        current values of the variables the loop reads are sent to the workers
+        along with the loop. If they can not be sent (e.g. macros or lambdas
+        defined after the workers had been forked), the pool is forked again.
+
+        Returns the rendered iterations or None, if they could not be rendered
+        in parallel (e.g. due to an error, which should be then reproduced by
+        rendering the loop serially).
+        '''
+        nworkers = min(self._loopworkers, len(items))
+        if nworkers < 2:
+            return None
+        # Several chunks per worker to balance iterations of different costs
+        nchunks = min(4 * nworkers, len(items))
+        bounds = [len(items) * ichunk // nchunks for ichunk in range(nchunks + 1)]
+        chunks = list(zip(bounds[:-1], bounds[1:]))
+        tasks = None
+        if self._looppool is not None:
+            tasks = self._get_loop_tasks(loopvars, items, content, names,
+                                         checkedmacros, chunks)
+        try:
+            if tasks is None:
+                self._close_loop_pool()
+                self._open_loop_pool(loopvars, items, content)
+                tasks = [(None, chunk) for chunk in chunks]
+            chunkresults = self._looppool.map(_render_loop_chunk, tasks)
+        except Exception:
+            self._close_loop_pool()
+            return None
+        if any(chunkresult is None for chunkresult in chunkresults):
+            # Workers may have been left in an undefined state
+            self._close_loop_pool()
+            return None
+        return [result for chunkresult in chunkresults
+                for result in chunkresult]
+
+
+    def _open_loop_pool(self, loopvars, items, content):
+        import multiprocessing
+        evaluator = self._evaluator
+        visiblescope = dict(evaluator.globalscope)
+        if evaluator.localscope is not None:
+            visiblescope.update(evaluator.localscope)
+        # Workers inherit the state at this point, including the loop data
+        self._loopforkstate = (dict(evaluator.globalscope), visiblescope,
+                               evaluator.localscope is None,
+                               (loopvars, items, content))
+        context = multiprocessing.get_context('fork')
+        self._looppool = context.Pool(self._loopworkers,
+                                      initializer=_init_loop_worker,
+                                      initargs=(self,))
+
+
+    def _close_loop_pool(self):
+        if self._looppool is not None:
+            self._looppool.terminate()
+            self._looppool.join()
+        self._looppool = None
+        self._loopforkstate = None
+
+
+    def _get_loop_tasks(self, loopvars, items, content, names, checkedmacros,
+                        chunks):
+        '''Returns the tasks for rendering the loop in the existing worker pool
+        or None, if the workers can not be brought into the current state.'''
+        import pickle
+        forkglobals, forkscope, forkedglobal, _ = self._loopforkstate
+        globalscope = self._evaluator.globalscope
+        localscope = self._evaluator.localscope
+        # Workers can open a local scope, but not leave the one they were
+        # forked in. Variables accessed by name are not known in advance.
+        if localscope is None and not forkedglobal \
+                or not _VARIABLE_FUNCTIONS.isdisjoint(names) \
+                or not _SCOPE_ACCESSING_FUNCTIONS.isdisjoint(names):
+            return None
+        globalvalues = {}
+        localvalues = {}
+        forklocals = []
+        unchecked = list(names)
+        while unchecked:
+            name = unchecked.pop()
+            if localscope is not None and name in localscope:
+                value = localscope[name]
+                unchanged = name in forkscope and forkscope[name] is value
+            elif name in globalscope:
+                value = globalscope[name]
+                unchanged = name in forkglobals and forkglobals[name] is value
+            elif name in forkscope:
+                return None
+            else:
+                continue
+            if unchanged and _is_immutable_for_workers(value):
+                if isinstance(value, _Macro) \
+                        and id(value) not in checkedmacros:
+                    checkedmacros.add(id(value))
+                    macronames = set()
+                    if self._has_side_effects(value.content, False,
+                                              checkedmacros, macronames):
+                        return None
+                    unchecked += macronames - names
+                    names.update(macronames)
+                elif isinstance(value, types.FunctionType):
+                    codenames = _get_code_names(value.__code__)
+                    unchecked += codenames - names
+                    names.update(codenames)
+                if localscope is not None and name in localscope:
+                    forklocals.append(name)
+            elif isinstance(value, (_Macro, _LazyArgument, types.ModuleType)):
+                return None
+            elif localscope is not None and name in localscope:
+                localvalues[name] = value
+            else:
+                globalvalues[name] = value
+        if localscope is None:
+            localvalues = None
+        try:
+            payload = pickle.dumps(
+                (loopvars, content, globalvalues, localvalues, forklocals,
+                 self._diverted, self._fixedposition))
+            return [(payload, pickle.dumps(items[start:end]))
+                    for start, end in chunks]
+        except Exception:
+            return None
+
+
+    def _render_loop_task(self, payload, chunk):
+        '''Renders a chunk of loop iterations in a worker process.'''
+        import pickle
+        globalscope = self._evaluator.globalscope
+        savedglobals = dict(globalscope)
+        localvalues = None
+        try:
+            if payload is None:
+                loopvars, items, content = self._loopforkstate[3]
+                items = items[chunk[0]:chunk[1]]
+            else:
+                loopvars, content, globalvalues, localvalues, forklocals, \
+                    self._diverted, self._fixedposition = pickle.loads(payload)
+                items = pickle.loads(chunk)
+                globalscope.update(globalvalues)
+                if localvalues is not None:
+                    forkscope = self._loopforkstate[1]
+                    for name in forklocals:
+                        localvalues[name] = forkscope[name]
+                    self._evaluator.openscope(customlocals=localvalues)
+            return [self._render_iteration(loopvars, var, content)
+                    for var in items]
+        finally:
+            # Variables defined by the iterations must not leak into the next
+            # chunk
+            globalscope.clear()
+            globalscope.update(savedglobals)
+            if localvalues is not None:
+                self._evaluator.closescope()
+
+
+    def _has_side_effects(self, tree, inscope, checkedmacros, names=None):
+        '''Checks conservatively, whether rendering a tree may have side effects.
+
+        Args:
+            tree (list): Tree to check.
+            inscope (bool): Whether the tree is rendered in the scope of the
+                parallel loop (and not in a scope of its own, like macro
+                bodies), so that changing variables is a side effect as well.
+            checkedmacros (set): Identity of the macros checked already.
+            names (set): Set to add the identifiers occuring in the tree and in
+                the macros it calls to (or None).
+        '''
+        for node in tree:
+            if not isinstance(node, _Node):
+                node = _node_from_tuple(node)
+            directive = node.directive
+            if directive in _GLOBAL_EFFECT_NODES or \
+                    inscope and directive in _SCOPE_CHANGING_NODES:
+                return True
+            if directive in ('txt', 'comment'):
+                continue
+            exprs = []
+            subtrees = []
+            if directive == 'eval':
+                exprs = [node.expr]
+            elif directive == 'if':
+                exprs = [cond for cond in node.conds if cond is not None]
+                subtrees = node.contents
+            elif directive == 'for':
+                exprs = [node.iterator]
+                subtrees = [node.content]
+            elif directive in ('call', 'block'):
+                exprs = [node.name, node.argexpr or '']
+                # Arguments are rendered in a scope of their own
+                for subtree in node.args:
+                    if self._has_side_effects(subtree, False, checkedmacros,
+                                              names):
+                        return True
+            elif directive in ('include', 'mute'):
+                subtrees = [node.content]
+            elif directive == 'stop':
+                exprs = [node.msg]
+            elif directive == 'assert':
+                exprs = [node.cond]
+            for expr in exprs:
+                if self._expr_has_side_effects(expr, inscope, checkedmacros,
+                                               names):
+                    return True
+            for subtree in subtrees:
+                if self._has_side_effects(subtree, inscope, checkedmacros,
+                                          names):
+                    return True
+        return False
+
+
+    def _expr_has_side_effects(self, expr, inscope, checkedmacros, names):
+        globalscope = self._evaluator.globalscope
+        localscope = self._evaluator.localscope or {}
+        for name in _IDENTIFIER_REGEXP.findall(expr):
+            if names is not None:
+                names.add(name)
+            if name == 'globalvar' or \
+                    inscope and name in ('setvar', 'delvar'):
+                return True
+            value = localscope.get(name, globalscope.get(name))
+            if isinstance(value, _Macro) and id(value) not in checkedmacros:
+                checkedmacros.add(id(value))
+                if self._has_side_effects(value.content, False, checkedmacros,
+                                          names):
+                    return True
+        return False
+
+
     def _get_called_content(self, fname, spans, name, argexpr, contents,
                             argnames):
-        posargs, kwargs = self._get_call_arguments(fname, spans, argexpr,
-                                                   contents, argnames)
         try:
             callobj = self._evaluate(name, fname, spans[0][0])
+        except Exception as exc:
+            msg = "exception occurred when calling '{0}'".format(name)
+            raise FyppFatalError(msg, fname, spans[0]) from exc
+        lazy = isinstance(callobj, _Macro) and (self._lazyargs or callobj.lazy)
+        posargs, kwargs = self._get_call_arguments(fname, spans, argexpr,
+                                                   contents, argnames, lazy)
+        self._update_predef_globals(fname, spans[0][0])
+        try:
             result = callobj(*posargs, **kwargs)
         except Exception as exc:
             msg = "exception occurred when calling '{0}'".format(name)
@@ -1557,7 +3015,8 @@ class Renderer:
         return out, ieval, peval
 
 
-    def _get_call_arguments(self, fname, spans, argexpr, contents, argnames):
+    def _get_call_arguments(self, fname, spans, argexpr, contents, argnames,
+                            lazy=False):
         if argexpr is None:
             posargs = []
             kwargs = {}
@@ -1576,12 +3035,10 @@ class Renderer:
         # Render arguments passed in call body
         args = []
         for content in contents:
-            self._evaluator.openscope()
-            rendered = self.render(content, divert=True)
-            self._evaluator.closescope()
-            if rendered.endswith('\n'):
-                rendered = rendered[:-1]
-            args.append(rendered)
+            if lazy:
+                args.append(self._get_lazy_argument(content))
+            else:
+                args.append(self._render_call_argument(content))
 
         # Separate arguments in call body into positional and keyword ones:
         if argnames:
@@ -1600,8 +3057,37 @@ class Renderer:
         return posargs, kwargs
 
 
+    def _render_call_argument(self, content, localscope=None):
+        self._evaluator.openscope(customlocals=localscope)
+        rendered = self.render(content, divert=True)
+        self._evaluator.closescope()
+        if rendered.endswith('\n'):
+            rendered = rendered[:-1]
+        return rendered
+
+
+    def _get_lazy_argument(self, content):
+        # The argument may be rendered within the macro, therefore, the local
+        # scope and the position handling of the call have to be restored
+        localscope = self._evaluator.localscope
+        localscope = {} if localscope is None else localscope
+        fixedposition = self._fixedposition
+
+        def render_argument():
+            fixedposition_old = self._fixedposition
+            self._fixedposition = fixedposition
+            rendered = self._render_call_argument(content, localscope)
+            self._fixedposition = fixedposition_old
+            return rendered
+
+        return _LazyArgument(render_argument)
+
+
     def _get_included_content(self, fname, spans, includefname, content):
         includefile = spans[0] is not None
+        linenr = spans[0][0] if includefile else None
+        if self._hooks is not None:
+            self._hooks.include_begin(fname, linenr, includefname)
         out = []
         if self._linenums and not self._diverted:
             if includefile or self._linenum_gfortran5:
@@ -1613,10 +3099,13 @@ class Renderer:
         out += outcont
         if self._linenums and not self._diverted and includefile:
             out += self._linenumdir(spans[0][1], fname, _LINENUM_RETURN_TO_FILE)
+        if self._hooks is not None:
+            self._hooks.include_end(fname, linenr, includefname)
         return out, ieval, peval
 
 
-    def _define_macro(self, fname, spans, name, argexpr, content):
+    def _define_macro(self, fname, spans, name, argexpr, content, pure=False,
+                      lazy=False):
         if argexpr is None:
             args = []
             defaults = {}
@@ -1645,15 +3134,19 @@ class Renderer:
                     msg = "invalid argument name '{0}'".format(arg)
                     raise FyppFatalError(msg, fname, spans[0])
         result = ''
+        cachesize = self._macrocachesize if pure else 0
         try:
             macro = _Macro(
                 name, fname, spans, args, defaults, varpos, varkw, content,
-                self, self._evaluator, self._evaluator.localscope)
+                self, self._evaluator, self._evaluator.localscope, cachesize,
+                lazy)
             self._define(name, macro)
         except Exception as exc:
             msg = "exception occurred when defining macro '{0}'"\
                 .format(name)
             raise FyppFatalError(msg, fname, spans[0]) from exc
+        if pure:
+            self._pure_macros.append(macro)
         if self._linenums and not self._diverted:
             result = self._linenumdir(spans[1][1], fname)
         return result
@@ -1718,6 +3211,139 @@ class Renderer:
         return ''
 
 
+    def _get_cached_content(self, fname, spans, keyexpr, content):
+        try:
+            key = self._evaluate(keyexpr, fname, spans[0][0])
+        except Exception as exc:
+            msg = "exception occurred when evaluating cache key '{0}'"\
+                .format(keyexpr)
+            raise FyppFatalError(msg, fname, spans[0]) from exc
+        # Cached output would not tell, which variables the block reads
+        if self._evaluator.recording_variables:
+            return self._get_block_content(fname, spans, content)
+        # Output depends on the block content, the position, the rendering
+        # mode and the key, so all of them have to be part of the digest
+        contentdigest = self._block_digests.get(id(content))
+        if contentdigest is None:
+            fullcontent = repr((VERSION, fname, spans, content))
+            contentdigest = (
+                hashlib.sha256(fullcontent.encode('utf-8')).hexdigest(),
+                content)
+            self._block_digests[id(content)] = contentdigest
+        fullkey = repr((contentdigest[0], self._diverted, self._linenums,
+                        self._linenumformat, key))
+        digest = hashlib.sha256(fullkey.encode('utf-8')).hexdigest()
+        cached = self._block_cache.get(digest)
+        if cached is None and self._blockcachedir is not None:
+            # Keys with arbitrary repr() could match in a later run by chance
+            if not _has_literal_repr(key):
+                msg = "cache key '{0}' must be a literal (e.g. numbers, "\
+                    "strings, tuples) to be stored in the block cache "\
+                    "directory".format(keyexpr)
+                raise FyppFatalError(msg, fname, spans[0])
+            cached = self._load_persistent_block(digest)
+        if cached is None and self._blockcachedir is not None:
+            # Values are taken from before the rendering, as the block may
+            # change variables it reads (e.g. loop variables)
+            globalscope = dict(self._evaluator.globalscope)
+            localscope = self._evaluator.localscope
+            if localscope is not None:
+                localscope = dict(localscope)
+            self._evaluator.start_recording_variables()
+            try:
+                cached = self._get_block_content(fname, spans, content)
+            finally:
+                names = self._evaluator.stop_recording_variables()
+            dependencies = self._get_block_dependencies(names, globalscope,
+                                                        localscope)
+            # Blocks reading values not comparable across runs stay in memory
+            if dependencies is not None:
+                _store_cached_block(self._blockcachedir, digest, cached,
+                                    dependencies)
+        elif cached is None:
+            cached = self._get_block_content(fname, spans, content)
+        self._block_cache[digest] = cached
+        out, ieval, peval = cached
+        return list(out), list(ieval), list(peval)
+
+
+    def _load_persistent_block(self, digest):
+        '''Returns the output of a cache block stored in the block cache
+        directory, if the variables it read have still the same values.'''
+        stored = _load_cached_block(self._blockcachedir, digest)
+        if stored is None:
+            return None
+        cached, dependencies = stored
+        current = self._get_block_dependencies(
+            dependencies, self._evaluator.globalscope,
+            self._evaluator.localscope)
+        if current != dependencies:
+            return None
+        return cached
+
+
+    @staticmethod
+    def _get_block_dependencies(names, globalscope, localscope):
+        '''Returns the values of the variables read by a cache block in a form
+        comparable across runs or None, if a value has no such form.'''
+        dependencies = {}
+        for name in names:
+            if localscope is not None and name in localscope:
+                value = localscope[name]
+            elif name in globalscope:
+                value = globalscope[name]
+            else:
+                dependencies[name] = None
+                continue
+            if isinstance(value, _Macro):
+                # Names read by the macro body are recorded by themselves
+                if value.localscope:
+                    return None
+                definition = repr((VERSION, value.fname, value.spans,
+                                   value.signature, value.content))
+                dependencies[name] = 'macro:' + hashlib.sha256(
+                    definition.encode('utf-8')).hexdigest()
+            elif _has_literal_repr(value):
+                dependencies[name] = 'value:' + repr(value)
+            else:
+                return None
+        return dependencies
+
+
+    def _get_diverted_output(self, fname, spans, pathexpr, content):
+        try:
+            path = self._evaluate(pathexpr, fname, spans[0][0])
+        except Exception as exc:
+            msg = "exception occurred when evaluating output path '{0}'"\
+                .format(pathexpr)
+            raise FyppFatalError(msg, fname, spans[0]) from exc
+        if not isinstance(path, str) or not path:
+            msg = "output path '{0}' does not evaluate to a non-empty string"\
+                .format(pathexpr)
+            raise FyppFatalError(msg, fname, spans[0])
+        # Content goes to its own file, so it needs line numbering and
+        # postprocessing even if the enclosing output is diverted
+        txt = self.render(content)
+        if self._linenums:
+            txt = self._linenumdir(spans[0][1], fname) + txt
+        self._output_files[path] = self._output_files.get(path, '') + txt
+        if self._linenums and not self._diverted:
+            return self._linenumdir(spans[-1][1], fname)
+        return ''
+
+
+    def _get_block_content(self, fname, spans, content):
+        out = []
+        if self._linenums and not self._diverted:
+            out.append(self._linenumdir(spans[0][1], fname))
+        outcont, ieval, peval = self._render(content)
+        ieval = _shiftinds(ieval, len(out))
+        out += outcont
+        if self._linenums and not self._diverted:
+            out.append(self._linenumdir(spans[-1][1], fname))
+        return out, ieval, peval
+
+
     def _handle_stop(self, fname, span, msgstr):
         try:
             msg = str(self._evaluate(msgstr, fname, span[0]))
@@ -1745,9 +3371,21 @@ class Renderer:
 
 
     def _evaluate(self, expr, fname, linenr):
-        self._update_predef_globals(fname, linenr)
-        result = self._evaluator.evaluate(expr)
-        self._update_predef_globals(fname, linenr)
+        hooks = self._hooks
+        if hooks is not None:
+            hooks.eval_begin(expr, fname, linenr)
+        # Trivial expressions can neither call macros nor change the scope,
+        # so predefined variables only need updates if they are being read.
+        trivial = _get_trivial_evaluator(expr)
+        if trivial is not None \
+           and _POSITION_DEPENDENT_NAMES.isdisjoint(trivial[0]):
+            result = self._evaluator.evaluate(expr)
+        else:
+            self._update_predef_globals(fname, linenr)
+            result = self._evaluator.evaluate(expr)
+            self._update_predef_globals(fname, linenr)
+        if hooks is not None:
+            hooks.eval_end(expr, fname, linenr)
         return result
 
 
@@ -1864,9 +3502,29 @@ class Renderer:
 
 
     def _foldline(self, line):
-        if _COMMENTLINE_REGEXP.match(line) is None:
-            return self._linefolder(line)
-        return [line]
+        if len(line) <= self._foldlimit:
+            return [line]
+        foldcache = self._foldcache
+        if foldcache is not None:
+            folded = foldcache.get(line)
+            if folded is not None:
+                self._foldcachehits += 1
+                return folded
+        # Equivalent to matching _COMMENTLINE_REGEXP, but faster
+        if line.lstrip(' \t')[:1] != '!':
+            folded = self._linefolder(line)
+        else:
+            folded = [line]
+        if foldcache is not None:
+            foldcache[line] = folded
+            if len(foldcache) > _FOLD_CACHE_SIZE:
+                foldcache.popitem(last=False)
+                # Lines hardly ever repeat, caching does not pay off
+                self._foldcachemisses += 1
+                if self._foldcachemisses > 16 * self._foldcachehits \
+                        + _FOLD_CACHE_SIZE:
+                    self._foldcache = None
+        return folded
 
 
 class Evaluator:
@@ -1961,6 +3619,9 @@ class Evaluator:
         # Current scope (globals + locals in all embedding and in current scope)
         self._scope = self._globals
 
+        # Names of the variables read so far (None, if not recorded)
+        self._usedvars = None
+
         # Turn on restricted mode
         self._restrict_builtins()
 
@@ -1974,7 +3635,18 @@ class Evaluator:
         Return:
             Python object: Result of the expression evaluation.
         '''
-        result = eval(expr, self._scope)
+        if self._usedvars is not None:
+            self._usedvars.update(_get_expression_names(expr))
+        trivial = _get_trivial_evaluator(expr)
+        if trivial is not None:
+            names, getter = trivial
+            scope = self._scope
+            for name in names:
+                if name not in scope:
+                    break
+            else:
+                return getter(scope)
+        result = eval(_compile_expression(expr), self._scope)
         return result
 
 
@@ -2152,6 +3824,44 @@ class Evaluator:
             self._scope = self._globals
 
 
+    def start_recording_variables(self):
+        '''Starts recording the names of the variables read.
+
+        All names read by evaluated expressions and all names queried via the
+        defined() and getvar() functions are recorded, independent of whether
+        a variable with that name exists. Accesses from within Python
+        functions (e.g. via globals()) are not recorded.
+        '''
+        self._usedvars = set()
+
+
+    def record_variables(self, names):
+        '''Records variable names as read (if recording was started).
+
+        Args:
+            names (iterable of str): Names of the variables.
+        '''
+        if self._usedvars is not None:
+            self._usedvars.update(names)
+
+
+    def stop_recording_variables(self):
+        '''Stops recording the names of the variables read.
+
+        Returns:
+            set: Names recorded since start_recording_variables() was called.
+        '''
+        usedvars = self._usedvars
+        self._usedvars = None
+        return usedvars if usedvars is not None else set()
+
+
+    @property
+    def recording_variables(self):
+        'Whether the names of the variables read are being recorded.'
+        return self._usedvars is not None
+
+
     @property
     def globalscope(self):
         'Dictionary of the global scope.'
@@ -2209,6 +3919,8 @@ class Evaluator:
 
 
     def _func_defined(self, var):
+        if self._usedvars is not None:
+            self._usedvars.add(var)
         defined = var in self._scope
         return defined
 
@@ -2230,6 +3942,8 @@ class Evaluator:
 
 
     def _func_getvar(self, name, defvalue=None):
+        if self._usedvars is not None:
+            self._usedvars.add(name)
         if name in self._scope:
             return self._scope[name]
         return defvalue
@@ -2251,6 +3965,102 @@ class Evaluator:
 
 
 
+class _LazyArgument:
+
+    '''Represents an argument passed in the body of a call directive, which
+    is only rendered when its content is needed the first time.
+
+    It behaves like a string: str() returns the rendered content, and string
+    methods and operators are applied to it. The content is rendered only once.
+
+    Args:
+        renderfunc (callable): Function without arguments returning the
+            rendered content.
+    '''
+
+    __slots__ = ('_renderfunc', '_data')
+
+    def __init__(self, renderfunc):
+        self._renderfunc = renderfunc
+        self._data = None
+
+
+    @property
+    def data(self):
+        'Rendered content of the argument.'
+        if self._data is None:
+            self._data = self._renderfunc()
+            self._renderfunc = None
+        return self._data
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+    def __str__(self):
+        return self.data
+
+    def __repr__(self):
+        return repr(self.data)
+
+    def __format__(self, spec):
+        return format(self.data, spec)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        return bool(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __contains__(self, item):
+        if isinstance(item, _LazyArgument):
+            item = item.data
+        return item in self.data
+
+    def __getitem__(self, ind):
+        return self.data[ind]
+
+    def __add__(self, other):
+        return self.data + other
+
+    def __radd__(self, other):
+        return other + self.data
+
+    def __mul__(self, num):
+        return self.data * num
+
+    __rmul__ = __mul__
+
+    def __mod__(self, args):
+        return self.data % args
+
+    def __eq__(self, other):
+        return self.data == other
+
+    def __ne__(self, other):
+        return self.data != other
+
+    def __lt__(self, other):
+        return self.data < other
+
+    def __le__(self, other):
+        return self.data <= other
+
+    def __gt__(self, other):
+        return self.data > other
+
+    def __ge__(self, other):
+        return self.data >= other
+
+    def __hash__(self):
+        return hash(self.data)
+
+
 class _Macro:
 
     '''Represents a user defined macro.
@@ -2270,10 +4080,17 @@ class _Macro:
         localscope (dict): Dictionary with local variables, which should be used
             the local scope, when the macro is called. Default: None (empty
             local scope).
+        cachesize (int): Maximal number of results to memoize. Results are
+            cached by the (hashable) call arguments, so this should only be
+            non-zero for macros without side effects, whose result solely
+            depends on their arguments. Default: 0 (no memoization).
+        lazy (bool): Whether arguments passed in the body of call directives
+            should only be rendered when first used. Default: False.
     '''
 
     def __init__(self, name, fname, spans, argnames, defaults, varpos, varkw,
-                 content, renderer, evaluator, localscope=None):
+                 content, renderer, evaluator, localscope=None, cachesize=0,
+                 lazy=False):
         self._name = name
         self._fname = fname
         self._spans = spans
@@ -2285,16 +4102,129 @@ class _Macro:
         self._renderer = renderer
         self._evaluator = evaluator
         self._localscope = localscope if localscope is not None else {}
+        self._cachesize = cachesize
+        self._cache = collections.OrderedDict() if cachesize > 0 else None
+        self._lazy = lazy
+        self._hits = 0
+        self._misses = 0
+        self._uncached = 0
 
 
-    def __call__(self, *args, **keywords):
-        argdict = self._process_arguments(args, keywords)
-        self._evaluator.openscope(customlocals=self._localscope)
-        self._evaluator.updatelocals(**argdict)
-        output = self._renderer.render(self._content, divert=True,
-                                       fixposition=True)
-        self._evaluator.closescope()
-        if output.endswith('\n'):
+    @property
+    def name(self):
+        'Name of the macro.'
+        return self._name
+
+
+    @property
+    def fname(self):
+        'File where the macro was defined.'
+        return self._fname
+
+
+    @property
+    def spans(self):
+        'Line spans of the macro definition.'
+        return self._spans
+
+
+    @property
+    def lazy(self):
+        'Whether call body arguments are rendered when first used.'
+        return self._lazy
+
+
+    @property
+    def content(self):
+        'Content of the macro as tree.'
+        return self._content
+
+
+    @property
+    def localscope(self):
+        'Local variables visible in the macro (besides its arguments).'
+        return self._localscope
+
+
+    @property
+    def signature(self):
+        '''Argument names, default values and names of the variable positional
+        and keyword arguments.'''
+        return self._argnames, self._defaults, self._varpos, self._varkw
+
+
+    def __deepcopy__(self, memo):
+        # Macros are not changed after their definition
+        return self
+
+
+    def rebound(self, renderer, evaluator):
+        '''Returns a copy of the macro using a different renderer and
+        evaluator (with empty result cache).'''
+        return _Macro(self._name, self._fname, self._spans, self._argnames,
+                      self._defaults, self._varpos, self._varkw, self._content,
+                      renderer, evaluator, self._localscope, self._cachesize,
+                      self._lazy)
+
+
+    def cache_info(self):
+        '''Returns the statistics of the result memoization.
+
+        Returns:
+            dict: Number of cache hits ('hits'), cache misses ('misses'),
+            calls with unhashable arguments, which were not cached ('uncached'),
+            current and maximal number of cached results ('currsize' and
+            'maxsize').
+        '''
+        currsize = len(self._cache) if self._cache is not None else 0
+        return {'hits': self._hits, 'misses': self._misses,
+                'uncached': self._uncached, 'currsize': currsize,
+                'maxsize': self._cachesize}
+
+
+    def __call__(self, *args, **keywords):
+        hooks = self._renderer.hooks
+        if hooks is not None:
+            hooks.macro_call_begin(self._name, self._fname, self._spans[0][0])
+        # Macros not declared as lazy must receive strings, also if lazy
+        # arguments are passed on to them (e.g. by a lazy macro)
+        if not self._lazy:
+            args, keywords = _get_materialized_arguments(args, keywords)
+        # Memoized output would not tell, which variables the macro reads
+        cache = self._cache
+        if self._evaluator.recording_variables:
+            cache = None
+        if cache is not None:
+            try:
+                key = _get_macro_cache_key(args, keywords)
+                output = cache.get(key)
+            except TypeError:
+                cache = None
+        if cache is None:
+            self._uncached += 1
+            output = self._render(args, keywords)
+        elif output is not None:
+            self._hits += 1
+            cache.move_to_end(key)
+        else:
+            self._misses += 1
+            output = self._render(args, keywords)
+            cache[key] = output
+            if len(cache) > self._cachesize:
+                cache.popitem(last=False)
+        if hooks is not None:
+            hooks.macro_call_end(self._name, self._fname, self._spans[0][0])
+        return output
+
+
+    def _render(self, args, keywords):
+        argdict = self._process_arguments(args, keywords)
+        self._evaluator.openscope(customlocals=self._localscope)
+        self._evaluator.updatelocals(**argdict)
+        output = self._renderer.render(self._content, divert=True,
+                                       fixposition=True)
+        self._evaluator.closescope()
+        if output.endswith('\n'):
             return output[:-1]
         return output
 
@@ -2354,10 +4284,16 @@ class Processor:
             Evaluator().
         evaluator (Evaluator, optional): Evaluator to use for evaluating Python
             expressions. If None (default), `Evaluator()` is used.
+        specializer (_Specializer, optional): Specializer to apply to the
+            built trees before rendering them. If None (default), trees are
+            rendered as built.
+        memorytracker (_MemoryTracker, optional): Tracker to notify about the
+            end of the parsing and the rendering. If None (default), memory
+            usage is not tracked.
     '''
 
     def __init__(self, parser=None, builder=None, renderer=None,
-                 evaluator=None):
+                 evaluator=None, specializer=None, memorytracker=None):
         self._parser = Parser() if parser is None else parser
         self._builder = Builder() if builder is None else builder
         if renderer is None:
@@ -2365,6 +4301,10 @@ class Processor:
             self._renderer = Renderer(evaluator)
         else:
             self._renderer = renderer
+        self._specializer = specializer
+        self._memorytracker = memorytracker
+        self._renderer.set_memory_tracker(memorytracker)
+        self._hooks = None
 
         self._parser.handle_include = self._builder.handle_include
         self._parser.handle_endinclude = self._builder.handle_endinclude
@@ -2387,6 +4327,10 @@ class Processor:
         self._parser.handle_comment = self._builder.handle_comment
         self._parser.handle_mute = self._builder.handle_mute
         self._parser.handle_endmute = self._builder.handle_endmute
+        self._parser.handle_cache = self._builder.handle_cache
+        self._parser.handle_endcache = self._builder.handle_endcache
+        self._parser.handle_output = self._builder.handle_output
+        self._parser.handle_endoutput = self._builder.handle_endoutput
         self._parser.handle_stop = self._builder.handle_stop
         self._parser.handle_assert = self._builder.handle_assert
 
@@ -2400,7 +4344,15 @@ class Processor:
         Returns:
             str: Processed content.
         '''
+        # Builder may contain a partial tree, if an earlier processing failed
+        self._builder.reset()
+        if self._hooks is not None:
+            self._hooks.parse_begin(fname)
         self._parser.parsefile(fname)
+        if self._hooks is not None:
+            self._hooks.parse_end(fname, self._builder.tree)
+        if self._memorytracker is not None:
+            self._memorytracker.finish_parse(self._builder.tree)
         return self._render()
 
 
@@ -2413,16 +4365,203 @@ class Processor:
         Returns:
             str: Processed content.
         '''
+        self._builder.reset()
+        if self._hooks is not None:
+            self._hooks.parse_begin(STRING)
         self._parser.parse(txt)
+        if self._hooks is not None:
+            self._hooks.parse_end(STRING, self._builder.tree)
+        if self._memorytracker is not None:
+            self._memorytracker.finish_parse(self._builder.tree)
         return self._render()
 
 
+    def set_hooks(self, hooks):
+        '''Sets the hooks to notify about parsing and rendering events.
+
+        Args:
+            hooks (FyppHooks): Hooks or None.
+        '''
+        self._hooks = hooks
+        self._renderer.set_hooks(hooks)
+
+
     def _render(self):
-        output = self._renderer.render(self._builder.tree)
+        tree = self._builder.tree
+        if self._specializer is not None:
+            tree = self._specializer.specialize(tree)
+        if self._memorytracker is not None:
+            self._memorytracker.start_render(tree)
+        output = self._renderer.render(tree)
         self._builder.reset()
         return ''.join(output)
 
 
+class FyppHooks:
+
+    '''Base class for hooks notified about the processing steps of Fypp.
+
+    Hooks allow external tools (e.g. profilers) to observe the processing
+    without subclassing the components of Fypp. Derive from this class,
+    override the methods for the events of interest and register an instance
+    with ``Fypp.add_hooks()``::
+
+        class EvalTimer(fypp.FyppHooks):
+
+            def eval_begin(self, expr, fname, linenr):
+                self.start = time.perf_counter()
+
+            def eval_end(self, expr, fname, linenr):
+                print(expr, time.perf_counter() - self.start)
+
+        tool = fypp.Fypp()
+        tool.add_hooks(EvalTimer())
+
+    Each begin event is followed by the corresponding end event, unless the
+    processing stops with an error in between. Events nest in the order the
+    processing happens (e.g. the evals within a macro call are notified
+    between the begin and end events of the call). Results taken from the
+    output cache (``--cache-dir``) are not parsed or rendered, so only their
+    write events are notified. When files are processed by multiple workers,
+    the hooks are called from multiple threads and must be thread-safe.
+
+    Line numbers are zero based. All methods of this class do nothing.
+    '''
+
+    def parse_begin(self, fname):
+        '''Called before a file or a string is parsed.
+
+        Args:
+            fname (str): Name of the file or STDIN or STRING.
+        '''
+
+
+    def parse_end(self, fname, tree):
+        '''Called after a file or a string had been parsed.
+
+        Args:
+            fname (str): Name of the file or STDIN or STRING.
+            tree (list): Tree built from the input.
+        '''
+
+
+    def render_node_begin(self, node):
+        '''Called before a node of a tree is rendered.
+
+        Args:
+            node (object): Node of the tree (instance of one of the node
+                classes of the Builder).
+        '''
+
+
+    def render_node_end(self, node):
+        '''Called after a node of a tree had been rendered.
+
+        Args:
+            node (object): Node of the tree.
+        '''
+
+
+    def macro_call_begin(self, name, fname, linenr):
+        '''Called before a user defined macro is called.
+
+        Args:
+            name (str): Name of the macro.
+            fname (str): File where the macro was defined.
+            linenr (int): Line where the macro definition starts.
+        '''
+
+
+    def macro_call_end(self, name, fname, linenr):
+        '''Called after a user defined macro had been called.
+
+        Args:
+            name (str): Name of the macro.
+            fname (str): File where the macro was defined.
+            linenr (int): Line where the macro definition starts.
+        '''
+
+
+    def include_begin(self, fname, linenr, includefname):
+        '''Called before the content of a file is rendered.
+
+        Args:
+            fname (str): File containing the include directive.
+            linenr (int): Line of the include directive or None for the
+                processed input itself.
+            includefname (str): Name of the included file.
+        '''
+
+
+    def include_end(self, fname, linenr, includefname):
+        '''Called after the content of a file had been rendered.
+
+        Args:
+            fname (str): File containing the include directive.
+            linenr (int): Line of the include directive or None for the
+                processed input itself.
+            includefname (str): Name of the included file.
+        '''
+
+
+    def eval_begin(self, expr, fname, linenr):
+        '''Called before an expression is evaluated.
+
+        Args:
+            expr (str): Expression to evaluate.
+            fname (str): File containing the expression.
+            linenr (int): Line of the expression.
+        '''
+
+
+    def eval_end(self, expr, fname, linenr):
+        '''Called after an expression had been evaluated.
+
+        Args:
+            expr (str): Evaluated expression.
+            fname (str): File containing the expression.
+            linenr (int): Line of the expression.
+        '''
+
+
+    def write_begin(self, outfile):
+        '''Called before an output file is written.
+
+        Args:
+            outfile (str): Name of the output file ('-' for stdout).
+        '''
+
+
+    def write_end(self, outfile):
+        '''Called after an output file had been written.
+
+        Args:
+            outfile (str): Name of the output file ('-' for stdout).
+        '''
+
+
+
+class _HookDispatcher:
+
+    '''Notifies several hooks about each event.
+
+    Args:
+        hooks (list of FyppHooks): Hooks to notify in the given order.
+    '''
+
+    def __init__(self, hooks):
+        for event in _HOOK_EVENTS:
+            methods = tuple(getattr(hook, event) for hook in hooks)
+            setattr(self, event, functools.partial(self._dispatch, methods))
+
+
+    @staticmethod
+    def _dispatch(methods, *args):
+        for method in methods:
+            method(*args)
+
+
+
 class Fypp:
 
     '''Fypp preprocessor.
@@ -2500,18 +4639,27 @@ class Fypp:
     def __init__(self, options=None, evaluator_factory=Evaluator,
                  parser_factory=Parser, builder_factory=Builder,
                  renderer_factory=Renderer):
-        syspath = self._get_syspath_without_scriptdir()
-        self._adjust_syspath(syspath)
         if options is None:
             options = FyppOptions()
         if inspect.signature(evaluator_factory) == inspect.signature(Evaluator):
             evaluator = evaluator_factory()
         else:
             raise FyppFatalError('evaluator_factory has incorrect signature')
+        self._options = options
+        self._evaluator_factory = evaluator_factory
+        self._parser_factory = parser_factory
+        self._builder_factory = builder_factory
+        self._renderer_factory = renderer_factory
         self._encoding = options.encoding
-        if options.modules:
-            self._import_modules(options.modules, evaluator, syspath,
-                                 options.moduledirs)
+        with _SYSPATH_LOCK:
+            syspath = self._get_syspath_without_scriptdir()
+            self._adjust_syspath(syspath)
+            if options.modules:
+                self._import_modules(options.modules, evaluator, syspath,
+                                     options.moduledirs)
+        predefined = dict(evaluator.globalscope)
+        for fname in options.defines_files:
+            self._apply_definition_file(fname, evaluator)
         evaluate = options.define_mode == 'eval'
         if options.defines:
             self._apply_definitions(options.defines, evaluator, evaluate)
@@ -2519,13 +4667,57 @@ class Fypp:
             self._apply_definitions(options.defines_str, evaluator, False)
         if options.defines_eval:
             self._apply_definitions(options.defines_eval, evaluator, True)
-        if inspect.signature(parser_factory) == inspect.signature(Parser):
-            parser = parser_factory(includedirs=options.includes,
-                                    encoding=self._encoding)
+        self._definitions = {
+            name: value for name, value in evaluator.globalscope.items()
+            if name not in predefined or value is not predefined[name]}
+        self._defineusage = None
+        self._memorytracker = _MemoryTracker() if options.memory_report \
+            else None
+        self._expansiontracker = None
+        if options.expansion_report is not None \
+           or options.expansion_json is not None:
+            self._expansiontracker = _ExpansionTracker()
+        self._sourcemap = None
+        self._outputfiles = []
+        self._create_parent_folder = options.create_parent_folder
+        self._metricscollector = None
+        self._hooks = []
+        if options.metrics_file is not None:
+            self._metricscollector = _MetricsCollector()
+            self._hooks.append(self._metricscollector)
+        # Shared with the thread copies, which append the records of their
+        # files to it
+        self._metrics = []
+        self._dependencies = [] if options.depfile is not None else None
+        self._cachedincludes = None
+        self._create_components(evaluator, options.loop_workers)
+        self._snapshot = None
+        self._preloaded = []
+        for fname in options.preload:
+            self.preload(fname)
+        if options.cache_dir is not None:
+            self._outputcache = _OutputCache(
+                options.cache_dir,
+                self._get_output_cache_config(options, self._preloaded))
+        else:
+            self._outputcache = None
+        self._processed = False
+        self._abortevent = None
+
+
+    def _create_components(self, evaluator, loopworkers):
+        '''Creates parser, builder, renderer and processor around an
+        evaluator.'''
+        options = self._options
+        if inspect.signature(self._parser_factory) == inspect.signature(Parser):
+            parser = self._parser_factory(includedirs=options.includes,
+                                          encoding=self._encoding,
+                                          mmapthreshold=options.mmap_threshold)
         else:
             raise FyppFatalError('parser_factory has incorrect signature')
-        if inspect.signature(builder_factory) == inspect.signature(Builder):
-            builder = builder_factory()
+        if inspect.signature(self._builder_factory) \
+                == inspect.signature(Builder):
+            builder = self._builder_factory()
         else:
             raise FyppFatalError('builder_factory has incorrect signature')
 
@@ -2543,15 +4735,38 @@ class Fypp:
             linefolder = PlaceholderLineFolder()
         linenums = options.line_numbering
         contlinenums = (options.line_numbering_mode != 'nocontlines')
-        self._create_parent_folder = options.create_parent_folder
-        if inspect.signature(renderer_factory) == inspect.signature(Renderer):
-            renderer = renderer_factory(
+        linenumformat = options.line_marker_format
+        self._sourcemapformat = options.source_map
+        self._minimalmarkerformat = None
+        if self._sourcemapformat is not None:
+            linenums = True
+            linenumformat = 'records'
+        elif linenums and options.line_numbering_mode == 'minimal':
+            self._minimalmarkerformat = linenumformat
+            linenumformat = 'records'
+        if inspect.signature(self._renderer_factory) \
+                == inspect.signature(Renderer):
+            renderer = self._renderer_factory(
                 evaluator, linenums=linenums, contlinenums=contlinenums,
-                linenumformat=options.line_marker_format, linefolder=linefolder,
-                filevarroot=options.file_var_root)
+                linenumformat=linenumformat, linefolder=linefolder,
+                filevarroot=options.file_var_root,
+                macrocachesize=options.macro_cache_size,
+                blockcachedir=options.block_cache_dir,
+                lazyargs=options.lazy_arguments,
+                loopworkers=loopworkers)
         else:
             raise FyppFatalError('renderer_factory has incorrect signature')
-        self._preprocessor = Processor(parser, builder, renderer)
+        self._parser = parser
+        self._evaluator = evaluator
+        self._renderer = renderer
+        specializer = None
+        if options.specialize and self._definitions:
+            specializer = _Specializer(evaluator, self._definitions)
+        renderer.set_expansion_tracker(self._expansiontracker)
+        self._preprocessor = Processor(parser, builder, renderer,
+                                       specializer=specializer,
+                                       memorytracker=self._memorytracker)
+        self._preprocessor.set_hooks(self._get_hook_dispatcher())
 
 
     def process_file(self, infile, outfile=None):
@@ -2562,24 +4777,106 @@ class Fypp:
                 '-', input is read from stdin.
             outfile (str, optional): Name of the file to write the result to.
                 If its value is '-', result is written to stdout. If not
-                present, result will be returned as string.
+                present, result will be returned as string. If a source map
+                was requested, it is written to a file with the name of the
+                output file extended by '.map'. Files requested by output
+                directives are only written, if outfile is present. Relative
+                paths are interpreted relative to the folder of the output
+                file (or to the current folder, if result is written to
+                stdout).
             env (dict, optional): Additional definitions for the evaluator.
 
         Returns:
             str: Result of processed input, if no outfile was specified.
         '''
+        collector = self._metricscollector
+        if collector is not None:
+            collector.start()
+        status = ERROR_EXIT_CODE
+        try:
+            result = self._process_file(infile, outfile)
+            status = 0
+            return result
+        except FyppStopRequest:
+            status = USER_ERROR_EXIT_CODE
+            raise
+        finally:
+            if self._memorytracker is not None:
+                self._memorytracker.stop()
+            if collector is not None:
+                self._metrics.append(collector.get_record(
+                    STDIN if infile == '-' else infile, outfile, status))
+
+
+    def _process_file(self, infile, outfile):
         infile = STDIN if infile == '-' else infile
-        output = self._preprocessor.process_file(infile)
+        # Evaluator state from previous runs is not part of the cache key.
+        # Cached outputs do not tell, which variables they had read or which
+        # lines produced them.
+        usecache = (self._outputcache is not None and infile != STDIN
+                    and (not self._processed or self._snapshot is not None)
+                    and not self._options.define_usage
+                    and self._expansiontracker is None)
+        self._processed = True
+        self._cachedincludes = None
+        self._restore_snapshot()
+        self._renderer.pop_output_files()
+        self._start_recording_variables()
+        if self._memorytracker is not None:
+            self._memorytracker.start()
+        if self._expansiontracker is not None:
+            self._expansiontracker.start()
+        if usecache:
+            output, outputfiles = self._get_cached_output(infile)
+        else:
+            output = self._preprocessor.process_file(infile)
+            outputfiles = self._renderer.pop_output_files()
+        self._stop_recording_variables()
+        if self._memorytracker is not None:
+            self._memorytracker.finish_join(output)
+        tofile = outfile not in (None, '-')
+        output, self._sourcemap = self._resolve_line_records(
+            output, outfile if tofile else None)
+        if self._metricscollector is not None:
+            self._metricscollector.set_output(
+                len(output.encode(self._encoding)),
+                len(self.get_included_files()))
+        outdir = os.path.dirname(outfile) if tofile else ''
+        self._outputfiles = self._resolve_output_files(outputfiles, outdir)
+        self._check_abort()
+        if outfile is not None:
+            self._write_output_files()
         if outfile is None:
+            self._finish_memory_tracking()
             return output
+        hooks = self._get_hook_dispatcher()
+        if hooks is not None:
+            hooks.write_begin(outfile)
         if outfile == '-':
-            outfile = sys.stdout
+            sys.stdout.write(output)
         else:
-            outfile = _open_output_file(outfile, self._encoding,
-                                        self._create_parent_folder)
-        outfile.write(output)
-        if outfile != sys.stdout:
-            outfile.close()
+            if self._sourcemap is not None:
+                self._sourcemap.write(outfile + '.map', self._sourcemapformat)
+            if self._defineusage is not None:
+                _write_file_if_changed(
+                    outfile + '.defines.json',
+                    json.dumps(self._defineusage, indent=2, sort_keys=True)
+                    + '\n', 'utf-8', self._create_parent_folder)
+            if self._options.write_if_changed:
+                _write_file_if_changed(outfile, output, self._encoding,
+                                       self._create_parent_folder)
+            else:
+                with _open_output_file(outfile, self._encoding,
+                                       self._create_parent_folder) as outfp:
+                    outfp.write(output)
+            if self._dependencies is not None:
+                prereqs = [infile] + [fname for fname, _
+                                      in self.get_included_files()]
+                self._dependencies.append(
+                    (outfile, list(dict.fromkeys(prereqs))))
+        if hooks is not None:
+            hooks.write_end(outfile)
+        self._finish_memory_tracking()
         return None
 
 
@@ -2593,7 +4890,388 @@ class Fypp:
         Returns:
             str: Processed content.
         '''
-        return self._preprocessor.process_text(txt)
+        self._restore_snapshot()
+        self._renderer.pop_output_files()
+        self._start_recording_variables()
+        if self._memorytracker is not None:
+            self._memorytracker.start()
+        if self._expansiontracker is not None:
+            self._expansiontracker.start(txt)
+        if self._metricscollector is not None:
+            self._metricscollector.start()
+        try:
+            output = self._preprocessor.process_text(txt)
+            self._stop_recording_variables()
+            if self._memorytracker is not None:
+                self._memorytracker.finish_join(output)
+            output, self._sourcemap = self._resolve_line_records(output)
+            self._outputfiles = self._resolve_output_files(
+                self._renderer.pop_output_files(), '')
+            self._finish_memory_tracking()
+        finally:
+            if self._memorytracker is not None:
+                self._memorytracker.stop()
+        return output
+
+
+    def process_files(self, filepairs, workers=None):
+        '''Processes several files concurrently in a pool of threads.
+
+        Each thread uses its own copy of the Fypp components. The processing
+        of each file starts with the definitions present when this method is
+        called (including the ones of preloaded libraries), but definitions
+        made while processing a file are not seen by the other files.
+        Include files are looked up and parsed only once for all files, so
+        they should not change during the processing. Loops declared as
+        parallel are rendered serially.
+
+        Args:
+            filepairs (list of tuple): Name of the input and output file for
+                each file to process (see process_file()).
+            workers (int, optional): Maximal number of threads. Default: None
+                (chosen by concurrent.futures.ThreadPoolExecutor).
+
+        Returns:
+            list: None for each file processed successfully, and the raised
+            FyppError for each failing one (in the order of filepairs).
+        '''
+        threadcopies = _ThreadCopies(self, includecache={})
+
+        def process_file(filepair):
+            try:
+                threadcopies.call('process_file', *filepair)
+            except FyppError as exc:
+                return exc
+            return None
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(process_file, filepairs))
+
+
+    def get_metrics(self):
+        '''Returns the metrics of the files processed so far.
+
+        Metrics are only collected, if a metrics file was requested (see
+        metrics_file attribute of FyppOptions).
+
+        Returns:
+            list of dict: Record for each call of process_file() (including
+            the ones made by process_files()) in the order the processing
+            finished, or an empty list if no metrics were collected. Each
+            record contains the name of the input ('input') and the output
+            file ('output', None if result was returned), the exit status of
+            the processing ('status', 0 on success), the size of the input
+            ('input_bytes', None for stdin) and the output ('output_bytes') in
+            bytes, the number of included files ('includes'), the number of
+            evaluated expressions ('evals'), of macro calls ('macro_calls')
+            and of rendered loop directives ('loops'), the time spent on
+            parsing ('parse_time'), rendering ('render_time') and writing
+            ('write_time') in seconds, whether the output was taken from the
+            output cache ('cache_hit') and the time the processing finished
+            ('timestamp', seconds since the epoch). The output size and the
+            number of included files are None, if the processing failed.
+        '''
+        return list(self._metrics)
+
+
+    def get_dependencies(self):
+        '''Returns the dependencies of the output files written so far.
+
+        Dependencies are only collected, if a dependency file was requested
+        (see depfile attribute of FyppOptions).
+
+        Returns:
+            list of tuple: Name of each output file written by process_file()
+            (including the ones written by process_files()) and the list of
+            the input file and the files included while processing it.
+        '''
+        if self._dependencies is None:
+            return []
+        return list(self._dependencies)
+
+
+    def add_hooks(self, hooks):
+        '''Registers hooks to notify about the processing steps.
+
+        Hooks must be registered before files are processed with
+        process_files(). If no hooks are registered, the processing does not
+        call any hook methods.
+
+        Args:
+            hooks (FyppHooks): Hooks to notify. Hooks registered earlier are
+                notified first.
+        '''
+        self._hooks = self._hooks + [hooks]
+        self._preprocessor.set_hooks(self._get_hook_dispatcher())
+
+
+    def remove_hooks(self, hooks):
+        '''Unregisters hooks registered with add_hooks().
+
+        Args:
+            hooks (FyppHooks): Hooks to remove.
+        '''
+        self._hooks = [hook for hook in self._hooks if hook is not hooks]
+        self._preprocessor.set_hooks(self._get_hook_dispatcher())
+
+
+    def get_source_map(self):
+        '''Returns the source map of the last processed input.
+
+        Returns:
+            SourceMap: Source map or None, if no source map was requested
+            (see the source_map attribute of FyppOptions).
+        '''
+        return self._sourcemap
+
+
+    def get_define_usage(self):
+        '''Returns the define-usage manifest of the last processed input.
+
+        Returns:
+            dict: Manifest or None, if no manifest was requested (see the
+            define_usage attribute of FyppOptions). The entry 'variables'
+            contains the sorted names of all variables read or queried (via
+            defined() and getvar()) during the processing, whether defined or
+            not. The entry 'definitions' maps the ones among them, which were
+            defined via definition files and options, onto the repr() of their
+            values.
+        '''
+        return self._defineusage
+
+
+    def get_memory_report(self):
+        '''Returns the memory usage of the processing phases of the last
+        processed input.
+
+        Returns:
+            dict: Report or None, if no report was requested (see the
+            memory_report attribute of FyppOptions). The entry 'phases' lists
+            the name ('parse', 'render', 'join' and 'write'), the memory
+            retained at the end and the peak memory during each phase (in bytes,
+            relative to the start of the processing). The entries 'tree',
+            'output', 'evals' and 'macros' contain the node counts, depths and
+            sizes of the built tree, the output buffer, the eval index lists
+            and the macro objects in the global scope, respectively.
+        '''
+        if self._memorytracker is None:
+            return None
+        return self._memorytracker.get_report()
+
+
+    def get_expansion_report(self):
+        '''Returns the amount of output produced by the source lines of the
+        last processed input.
+
+        Output is measured in characters and lines before line folding. The
+        output of macros is attributed to the lines calling them.
+
+        Returns:
+            dict: Report or None, if no report was requested (see the
+            expansion_report and expansion_json attributes of FyppOptions).
+            The entry 'total' contains the number of characters ('chars') and
+            lines ('lines') of the output. The entry 'sites' lists the file,
+            line (starting with one) and the output produced for each source
+            line producing output (in decreasing order). The entry 'files'
+            lists for each file its size ('input_chars', 'input_lines'), the
+            output produced by its lines ('output_chars', 'output_lines') and
+            the expansion ratio of the characters ('ratio').
+        '''
+        if self._expansiontracker is None:
+            return None
+        return self._expansiontracker.get_report(self._encoding)
+
+
+    def get_output_files(self):
+        '''Returns the files requested by output directives in the last
+        processed input.
+
+        Returns:
+            dict: Processed content for each requested file. The paths are
+            relative to the folder of the output file (see process_file()).
+        '''
+        return {path: output for path, _, output, _ in self._outputfiles}
+
+
+    def preload(self, fname):
+        '''Processes a library file and keeps the resulting definitions.
+
+        The output of the file is discarded. The global definitions (including
+        the macros) present after its processing are stored, and each
+        subsequent processing starts with a copy of them. Include directives
+        referring to the library (or to any file included by it) are ignored
+        afterwards.
+
+        Note: The library should not depend on definitions made in the files
+        including it, as it is processed only once, before all other files.
+
+        Args:
+            fname (str): Name of the library file.
+        '''
+        self._restore_snapshot()
+        self._preprocessor.process_file(fname)
+        globalscope = self._evaluator.globalscope
+        self._snapshot = {name: value for name, value in globalscope.items()
+                          if name != '__builtins__'}
+        libfiles = [fname]
+        libfiles += [incfile for incfile, _ in self._parser.get_included_files()]
+        self._parser.skip_include_files(libfiles)
+        self._preloaded += libfiles
+
+
+    def get_macro_cache_stats(self):
+        '''Returns the memoization statistics of the macros declared as pure.
+
+        Returns:
+            list of tuple: Name, file, line (starting with zero) of the
+            definition and a dictionary with the cache statistics for each
+            pure macro defined so far.
+        '''
+        return self._renderer.get_macro_cache_stats()
+
+
+    def get_included_files(self):
+        '''Returns the files included while processing the last input.
+
+        Returns:
+            list of tuple: Path of each included file and the list of the
+            paths, which were probed without success before it was found.
+            (See Parser.get_included_files()).
+        '''
+        if self._cachedincludes is not None:
+            return list(self._cachedincludes)
+        return self._parser.get_included_files()
+
+
+    def _resolve_line_records(self, output, outfile=None):
+        sourcemap = None
+        if self._sourcemapformat is not None:
+            sourcemap, output = SourceMap.from_output(output, outfile)
+        elif self._minimalmarkerformat is not None:
+            output = _get_minimal_line_markers(output,
+                                               self._minimalmarkerformat)
+        return output, sourcemap
+
+
+    def _resolve_output_files(self, outputfiles, outdir):
+        resolved = []
+        for path, output in outputfiles.items():
+            fullpath = os.path.join(outdir, path)
+            output, sourcemap = self._resolve_line_records(output, fullpath)
+            resolved.append((path, fullpath, output, sourcemap))
+        return resolved
+
+
+    def _write_output_files(self):
+        hooks = self._get_hook_dispatcher()
+        for _, fullpath, output, sourcemap in self._outputfiles:
+            if hooks is not None:
+                hooks.write_begin(fullpath)
+            _write_file_if_changed(fullpath, output, self._encoding,
+                                   self._create_parent_folder)
+            if sourcemap is not None:
+                sourcemap.write(fullpath + '.map', self._sourcemapformat)
+            if hooks is not None:
+                hooks.write_end(fullpath)
+
+
+    def _get_thread_copy(self, snapshot, includecache=None):
+        '''Returns a copy of the instance with its own components, which
+        starts each processing with the given definitions.'''
+        tool = copy.copy(self)
+        # Memory tracing is process wide and can not be split among threads
+        tool._memorytracker = None
+        tool._expansiontracker = None
+        evaluator = self._evaluator_factory()
+        tool._create_components(evaluator, 1)
+        tool._parser.skip_include_files(self._preloaded)
+        if includecache is not None:
+            tool._parser.share_include_cache(includecache)
+        # Macros must render with the components of the copy
+        tool._snapshot = {
+            name: (value.rebound(tool._renderer, evaluator)
+                   if isinstance(value, _Macro) else value)
+            for name, value in snapshot.items()}
+        tool._sourcemap = None
+        tool._outputfiles = []
+        return tool
+
+
+    def _get_hook_dispatcher(self):
+        '''Returns the object notifying all registered hooks or None.'''
+        if not self._hooks:
+            return None
+        if len(self._hooks) == 1:
+            return self._hooks[0]
+        return _HookDispatcher(self._hooks)
+
+
+    def _start_recording_variables(self):
+        self._defineusage = None
+        if self._options.define_usage:
+            self._evaluator.start_recording_variables()
+
+
+    def _stop_recording_variables(self):
+        if not self._options.define_usage:
+            return
+        usedvars = self._evaluator.stop_recording_variables()
+        builtins = self._evaluator.globalscope.get('__builtins__', {})
+        usedvars = sorted(name for name in usedvars
+                          if name in self._definitions or name not in builtins)
+        self._defineusage = {
+            'variables': usedvars,
+            'definitions': {name: repr(self._definitions[name])
+                            for name in usedvars if name in self._definitions},
+        }
+
+
+    def _finish_memory_tracking(self):
+        if self._memorytracker is None:
+            return
+        self._memorytracker.finish_write(
+            [value for value in self._evaluator.globalscope.values()
+             if isinstance(value, _Macro)])
+
+
+    def _check_abort(self):
+        if self._abortevent is not None and self._abortevent.is_set():
+            raise FyppFatalError('processing cancelled')
+
+
+    def _restore_snapshot(self):
+        if self._snapshot is None:
+            return
+        globalscope = self._evaluator.globalscope
+        restrictedbuiltins = globalscope['__builtins__']
+        globalscope.clear()
+        globalscope['__builtins__'] = restrictedbuiltins
+        for name, value in self._snapshot.items():
+            globalscope[name] = _get_snapshot_copy(value)
+
+
+    def _get_cached_output(self, infile):
+        key = self._outputcache.get_key(infile)
+        cached = self._outputcache.lookup(key)
+        if cached is not None:
+            if self._metricscollector is not None:
+                self._metricscollector.set_cache_hit()
+            output, self._cachedincludes = cached
+            return output.decode(self._encoding), {}
+        # Outputs reading the date or time of their run must not be reused
+        self._evaluator.start_recording_variables()
+        try:
+            output = self._preprocessor.process_file(infile)
+        finally:
+            usedvars = self._evaluator.stop_recording_variables()
+        outputfiles = self._renderer.pop_output_files()
+        # Only the main output is stored, so inputs writing further files
+        # must be processed each time
+        if not outputfiles and usedvars.isdisjoint(_TIMESTAMP_NAMES):
+            self._outputcache.store(key, self._parser.get_included_files(),
+                                    output.encode(self._encoding))
+        return output, outputfiles
 
 
     @staticmethod
@@ -2615,31 +5293,799 @@ class Fypp:
             evaluator.define(name, value)
 
 
-    def _import_modules(self, modules, evaluator, syspath, moduledirs):
-        lookuppath = []
-        if moduledirs is not None:
-            lookuppath += [os.path.abspath(moddir) for moddir in moduledirs]
-        lookuppath.append(os.path.abspath('.'))
-        lookuppath += syspath
-        self._adjust_syspath(lookuppath)
-        for module in modules:
-            evaluator.import_module(module)
-        self._adjust_syspath(syspath)
+    @staticmethod
+    def _apply_definition_file(fname, evaluator):
+        definitions = _load_data_file(fname)
+        for name, value in definitions.items():
+            if not isinstance(name, str) \
+                    or not _IDENTIFIER_REGEXP.fullmatch(name):
+                msg = "invalid variable name '{0}' in file '{1}'"\
+                    .format(name, fname)
+                raise FyppFatalError(msg)
+            evaluator.define(name, value)
+
+
+    def _import_modules(self, modules, evaluator, syspath, moduledirs):
+        lookuppath = []
+        if moduledirs is not None:
+            lookuppath += [os.path.abspath(moddir) for moddir in moduledirs]
+        lookuppath.append(os.path.abspath('.'))
+        lookuppath += syspath
+        self._adjust_syspath(lookuppath)
+        for module in modules:
+            evaluator.import_module(module)
+        self._adjust_syspath(syspath)
+
+
+    @staticmethod
+    def _get_syspath_without_scriptdir():
+        '''Remove the folder of the fypp binary from the search path'''
+        syspath = list(sys.path)
+        scriptdir = os.path.abspath(os.path.dirname(sys.argv[0]))
+        if os.path.abspath(syspath[0]) == scriptdir:
+            del syspath[0]
+        return syspath
+
+
+    @staticmethod
+    def _adjust_syspath(syspath):
+        sys.path = syspath
+
+
+    @staticmethod
+    def _get_output_cache_config(options, preloaded):
+        '''Returns the digest of all settings, which may affect the output.'''
+        hasher = hashlib.sha256()
+        hasher.update(repr((VERSION, sys.version_info[:2], platform.system(),
+                            platform.machine())).encode('utf-8'))
+        settings = sorted((name, value) for name, value in vars(options).items()
+                          if name not in _OUTPUT_NEUTRAL_OPTIONS)
+        hasher.update(repr(settings).encode('utf-8'))
+        # Submodules of packages are covered as well, other modules imported
+        # by the modules are not
+        modnames = set(options.modules)
+        for modname in options.modules:
+            modnames.update(name for name in sys.modules
+                            if name.startswith(modname + '.'))
+        for modname in sorted(modnames):
+            module = sys.modules.get(modname)
+            modfile = getattr(module, '__file__', None)
+            moddigest = _get_file_digest(modfile) if modfile else None
+            hasher.update(repr((modname, moddigest)).encode('utf-8'))
+        for fname in options.defines_files + preloaded:
+            hasher.update(repr((fname, _get_file_digest(fname))).encode('utf-8'))
+        return hasher.hexdigest()
+
+
+class AsyncFypp:
+
+    '''Fypp preprocessor for asyncio applications.
+
+    The processing runs in a pool of threads, so that the event loop is not
+    blocked while files are read, rendered and written. Each thread uses its own
+    copy of the Fypp components::
+
+        async def generate(pairs):
+            async with fypp.AsyncFypp(options, maxconcurrency=4) as tool:
+                await asyncio.gather(*[tool.process_file(infile, outfile)
+                                       for infile, outfile in pairs])
+
+    The processing of each input starts with the definitions present after
+    the initialization (including the ones of preloaded libraries). If the
+    awaiting task is cancelled, the processing is aborted with a
+    FyppFatalError: processing not started yet is skipped, and processing
+    already running does not write any files. (The thread itself finishes the
+    rendering in the background.)
+
+    Args:
+        options (object): Settings for Fypp (see `Fypp`_).
+        maxconcurrency (int, optional): Maximal number of inputs processed at
+            the same time. Default: None (chosen by
+            concurrent.futures.ThreadPoolExecutor).
+        **factories: Factories for the components (see `Fypp`_).
+    '''
+
+    def __init__(self, options=None, maxconcurrency=None, **factories):
+        self._tool = Fypp(options, **factories)
+        self._threadcopies = _ThreadCopies(self._tool)
+        import concurrent.futures
+        self._executor = concurrent.futures.ThreadPoolExecutor(maxconcurrency)
+
+
+    async def process_file(self, infile, outfile=None):
+        '''Processes input file and writes result to output file.
+
+        Args:
+            infile (str): Name of the file to read and process.
+            outfile (str, optional): Name of the file to write the result to
+                (see Fypp.process_file()).
+
+        Returns:
+            str: Result of processed input, if no outfile was specified.
+
+        Raises:
+            FyppFatalError: If processing failed or was cancelled.
+            FyppStopRequest: If a stop was requested in the input.
+        '''
+        return await self._run('process_file', infile, outfile)
+
+
+    async def process_text(self, txt):
+        '''Processes a string.
+
+        Args:
+            txt (str): String to process.
+
+        Returns:
+            str: Processed content.
+
+        Raises:
+            FyppFatalError: If processing failed or was cancelled.
+            FyppStopRequest: If a stop was requested in the input.
+        '''
+        return await self._run('process_text', txt)
+
+
+    def close(self):
+        '''Shuts down the thread pool without waiting for running
+        processings.'''
+        self._executor.shutdown(wait=False)
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *excinfo):
+        self.close()
+
+
+    async def _run(self, method, *args):
+        import asyncio
+        abortevent = threading.Event()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, functools.partial(
+                self._threadcopies.call, method, *args, abortevent=abortevent))
+        try:
+            return await future
+        except asyncio.CancelledError as exc:
+            abortevent.set()
+            raise FyppFatalError('processing cancelled') from exc
+
+
+class _ThreadCopies:
+
+    '''Provides a copy of a Fypp instance for each thread.
+
+    Args:
+        tool (Fypp): Instance to copy. The copies start each processing with
+            the definitions present in it at the creation of this object.
+        includecache (dict): Cache for include files shared by all copies
+            (see Parser.share_include_cache()). Default: None (no caching).
+    '''
+
+    def __init__(self, tool, includecache=None):
+        self._tool = tool
+        if tool._snapshot is not None:
+            self._snapshot = tool._snapshot
+        else:
+            self._snapshot = {
+                name: value for name, value in tool._evaluator.globalscope.items()
+                if name != '__builtins__'}
+        self._includecache = includecache
+        self._threadlocal = threading.local()
+
+
+    def call(self, method, *args, abortevent=None):
+        '''Calls a method of the copy belonging to the current thread.
+
+        Args:
+            method (str): Name of the method.
+            *args: Arguments of the method.
+            abortevent (threading.Event): Event signalizing that the processing
+                should be aborted. Default: None (no abortion).
+
+        Returns:
+            Result of the method.
+        '''
+        if abortevent is not None and abortevent.is_set():
+            raise FyppFatalError('processing cancelled')
+        tool = getattr(self._threadlocal, 'tool', None)
+        if tool is None:
+            tool = self._tool._get_thread_copy(self._snapshot,
+                                               self._includecache)
+            self._threadlocal.tool = tool
+        tool._abortevent = abortevent
+        try:
+            return getattr(tool, method)(*args)
+        except FyppError:
+            # Components may be left in an inconsistent state
+            self._threadlocal.tool = None
+            raise
+        finally:
+            tool._abortevent = None
+
+
+class _OutputCache:
+
+    '''Content addressed cache for the output of processed files.
+
+    The key of an input file is derived from its content, its name and the
+    configuration digest. For each key, a manifest stores the include files
+    (with their digests) seen when the output was created. A cached output is
+    only used, if all include files are unchanged and none of the locations
+    probed before finding them has appeared meanwhile.
+
+    Args:
+        cachedir (str): Cache directory.
+        config (str): Digest of all settings affecting the output.
+    '''
+
+    # Maximal number of include configurations stored for a given key
+    _MAX_MANIFEST_ENTRIES = 8
+
+    def __init__(self, cachedir, config):
+        self._manifestdir = os.path.join(cachedir, 'manifests')
+        self._objectdir = os.path.join(cachedir, 'objects')
+        self._config = config
+
+
+    def get_key(self, infile):
+        '''Returns the cache key of an input file.
+
+        Args:
+            infile (str): Name of the input file.
+
+        Returns:
+            str: Cache key.
+        '''
+        hasher = hashlib.sha256()
+        hasher.update(repr((self._config, infile)).encode('utf-8'))
+        try:
+            with io.open(infile, 'rb') as fp:
+                hasher.update(fp.read())
+        except OSError as exc:
+            msg = "Failed to open file '{0}' for read".format(infile)
+            raise FyppFatalError(msg) from exc
+        return hasher.hexdigest()
+
+
+    def lookup(self, key):
+        '''Returns the cached output for a key.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            tuple: Encoded output (bytes) and the included files of the entry
+            (in the format of Parser.get_included_files()) or None, if no
+            valid entry was found.
+        '''
+        for entry in self._read_manifest(key):
+            if not self._is_entry_valid(entry):
+                continue
+            try:
+                with io.open(os.path.join(self._objectdir, entry['output']),
+                             'rb') as fp:
+                    output = fp.read()
+            except OSError:
+                continue
+            return output, [(fname, probed)
+                            for fname, _, probed in entry['deps']]
+        return None
+
+
+    def store(self, key, includes, output):
+        '''Stores the output for a key.
+
+        Args:
+            key (str): Cache key.
+            includes (list): Included files as returned by
+                Parser.get_included_files().
+            output (bytes): Encoded output.
+        '''
+        deps = []
+        for fname, probed in includes:
+            digest = _get_file_digest(fname)
+            if digest is None:
+                return
+            deps.append([fname, digest, probed])
+        outdigest = hashlib.sha256(output).hexdigest()
+        entries = [entry for entry in self._read_manifest(key)
+                   if entry.get('deps') != deps]
+        entries.insert(0, {'deps': deps, 'output': outdigest})
+        del entries[self._MAX_MANIFEST_ENTRIES:]
+        try:
+            os.makedirs(self._objectdir, exist_ok=True)
+            os.makedirs(self._manifestdir, exist_ok=True)
+            # Object must be in place before the manifest refers to it
+            _write_file_atomically(os.path.join(self._objectdir, outdigest),
+                                   output)
+            _write_file_atomically(
+                os.path.join(self._manifestdir, key + '.json'),
+                json.dumps(entries).encode('utf-8'))
+        except OSError as exc:
+            msg = "Failed to store output in cache folder '{0}'"\
+                .format(os.path.dirname(self._objectdir))
+            raise FyppFatalError(msg) from exc
+
+
+    def _read_manifest(self, key):
+        fname = os.path.join(self._manifestdir, key + '.json')
+        try:
+            with io.open(fname, 'r', encoding='utf-8') as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return []
+        if not isinstance(entries, list):
+            return []
+        return [entry for entry in entries if isinstance(entry, dict)]
+
+
+    @staticmethod
+    def _is_entry_valid(entry):
+        try:
+            for fname, digest, probed in entry['deps']:
+                if any(os.path.exists(fpath) for fpath in probed):
+                    return False
+                if _get_file_digest(fname) != digest:
+                    return False
+        except (KeyError, TypeError, ValueError):
+            return False
+        return 'output' in entry
+
+
+class _MetricsCollector(FyppHooks):
+
+    '''Collects the metrics of processed files from the hook events.
+
+    The collector may be shared by threads processing different files, as
+    the metrics of the file being processed are stored per thread.
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+
+
+    def start(self):
+        '''Starts collecting the metrics of a file in the current thread.'''
+        local = self._local
+        local.counts = {'evals': 0, 'macro_calls': 0, 'loops': 0}
+        local.times = {'parse': 0.0, 'render': 0.0, 'write': 0.0}
+        local.started = {}
+        local.cachehit = False
+        local.outputbytes = None
+        local.includes = None
+
+
+    def set_cache_hit(self):
+        '''Notes that the output was taken from the output cache.'''
+        self._local.cachehit = True
+
+
+    def set_output(self, outputbytes, includes):
+        '''Sets the size of the output and the number of included files.
+
+        Args:
+            outputbytes (int): Size of the encoded output.
+            includes (int): Number of files included by the parser.
+        '''
+        self._local.outputbytes = outputbytes
+        self._local.includes = includes
+
+
+    def get_record(self, infile, outfile, status):
+        '''Returns the metrics collected since start() in the current thread.
+
+        Args:
+            infile (str): Name of the processed file.
+            outfile (str): Name of the output file or None.
+            status (int): Exit status of the processing.
+
+        Returns:
+            dict: Metrics record (see Fypp.get_metrics()).
+        '''
+        local = self._local
+        inputbytes = None
+        if infile != STDIN:
+            try:
+                inputbytes = os.path.getsize(infile)
+            except OSError:
+                pass
+        record = {'input': infile, 'output': outfile, 'status': status,
+                  'input_bytes': inputbytes,
+                  'output_bytes': local.outputbytes,
+                  'includes': local.includes,
+                  'cache_hit': local.cachehit, 'timestamp': time.time()}
+        record.update(local.counts)
+        for phase, duration in local.times.items():
+            record[phase + '_time'] = duration
+        return record
+
+
+    def parse_begin(self, fname):
+        self._local.started['parse'] = time.perf_counter()
+
+
+    def parse_end(self, fname, tree):
+        self._add_time('parse')
+
+
+    def render_node_begin(self, node):
+        if node.__class__ is _ForNode:
+            self._local.counts['loops'] += 1
+
+
+    def macro_call_begin(self, name, fname, linenr):
+        self._local.counts['macro_calls'] += 1
+
+
+    def include_begin(self, fname, linenr, includefname):
+        # Only the rendering of the processed input itself is timed, as it
+        # contains the rendering of the included files
+        if linenr is None:
+            self._local.started['render'] = time.perf_counter()
+
+
+    def include_end(self, fname, linenr, includefname):
+        if linenr is None:
+            self._add_time('render')
+
+
+    def eval_begin(self, expr, fname, linenr):
+        self._local.counts['evals'] += 1
+
+
+    def write_begin(self, outfile):
+        self._local.started['write'] = time.perf_counter()
+
+
+    def write_end(self, outfile):
+        self._add_time('write')
+
+
+    def _add_time(self, phase):
+        local = self._local
+        local.times[phase] += time.perf_counter() - local.started.pop(phase)
+
+
+
+class _MemoryTracker:
+
+    '''Measures the memory usage of the processing phases with tracemalloc.
+
+    Tracing is started at the beginning of each processing (unless it is
+    active already) and stopped at its end, as it slows down the execution
+    considerably. Peaks are reset at the end of each phase (Python >= 3.9,
+    otherwise they include the peaks of the earlier phases).
+    '''
+
+    def __init__(self):
+        self._started = False
+        self._base = 0
+        self._phases = []
+        self._details = {}
+        self._rendertree = None
+
+
+    def start(self):
+        '''Starts tracking a processing.'''
+        import tracemalloc
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        self._reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        self._phases = []
+        self._details = {
+            'tree': {'nodes': 0, 'depth': 0, 'size': 0},
+            'output': {'items': 0, 'size': 0, 'joined': 0},
+            'evals': {'entries': 0, 'size': 0},
+            'macros': {'macros': 0, 'nodes': 0, 'size': 0},
+        }
+        self._rendertree = None
+
+
+    def stop(self):
+        '''Stops tracing, if it was started by start() (also if the processing
+        failed).'''
+        if self._started:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started = False
+
+
+    def finish_parse(self, tree):
+        '''Finishes the parse phase (including the building of the tree).'''
+        self._finish_phase('parse')
+        nodes, depth, size = _get_tree_stats(tree)
+        self._details['tree'] = {'nodes': nodes, 'depth': depth, 'size': size}
+
+
+    def start_render(self, tree):
+        '''Notes the tree, whose rendering marks the end of the render phase.'''
+        self._rendertree = tree
+
+
+    def finish_render(self, tree, output, eval_inds, eval_pos):
+        '''Finishes the render phase, if the tree is the one passed to
+        start_render() (and not the content of a directive).'''
+        if tree is not self._rendertree:
+            return
+        self._rendertree = None
+        self._finish_phase('render')
+        size = sys.getsizeof(output) + sum(sys.getsizeof(item)
+                                           for item in output)
+        self._details['output'].update(items=len(output), size=size)
+        size = sys.getsizeof(eval_inds) + sys.getsizeof(eval_pos) \
+            + sum(sys.getsizeof(pos) for pos in eval_pos)
+        self._details['evals'] = {'entries': len(eval_inds), 'size': size}
+
+
+    def finish_join(self, output):
+        '''Finishes the join phase, creating the output string.'''
+        self._finish_phase('join')
+        self._details['output']['joined'] = sys.getsizeof(output)
+
+
+    def finish_write(self, macros):
+        '''Finishes the write phase (including the conversion of line
+        records).'''
+        self._finish_phase('write')
+        nodes = size = 0
+        for macro in macros:
+            macronodes, _, macrosize = _get_tree_stats(macro.content)
+            nodes += macronodes
+            size += macrosize + sys.getsizeof(macro)
+        self._details['macros'] = {'macros': len(macros), 'nodes': nodes,
+                                   'size': size}
+        self.stop()
+
+
+    def get_report(self):
+        '''Returns the report of the last tracked processing (see
+        Fypp.get_memory_report()).'''
+        report = {'phases': list(self._phases)}
+        report.update(copy.deepcopy(self._details))
+        return report
+
+
+    def _finish_phase(self, name):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        self._phases.append((name, current - self._base, peak - self._base))
+        self._reset_peak()
+
+
+    @staticmethod
+    def _reset_peak():
+        import tracemalloc
+        # Only available from Python 3.9 on
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            reset_peak()
+
+
+def _get_tree_stats(tree):
+    '''Returns the number of nodes, the depth and the approximate size in bytes
+    of a tree (including its strings).'''
+    nodes = 0
+    depth = 0
+    size = sys.getsizeof(tree)
+    for node in tree:
+        nodes += 1
+        size += sys.getsizeof(node)
+        subtrees = []
+        for value in node:
+            if isinstance(value, str):
+                size += sys.getsizeof(value)
+            elif isinstance(value, list) and value \
+                 and isinstance(value[0], (list, _Node)):
+                # Lists of subtrees (e.g. if branches) or a subtree
+                if isinstance(value[0], list):
+                    subtrees += value
+                else:
+                    subtrees.append(value)
+        for subtree in subtrees:
+            subnodes, subdepth, subsize = _get_tree_stats(subtree)
+            nodes += subnodes
+            depth = max(depth, subdepth)
+            size += subsize
+    return nodes, depth + 1 if nodes else 0, size
+
+
+class _ExpansionTracker:
+
+    '''Attributes the rendered output to the source lines producing it.
+
+    The output of each node of the processed tree (including the trees of
+    included files) is attributed to the line the node starts in. The output
+    of child nodes is attributed to their own lines, while the output of
+    nested render calls (e.g. of macros, lazy arguments or output directives)
+    is attributed to the node triggering them. Output is measured in
+    characters and lines before line folding.
+
+    Attributes:
+        renderdepth (int): Nesting depth of the render calls of the renderer.
+            Output is only attributed within the outermost one.
+    '''
+
+    def __init__(self):
+        self.renderdepth = 0
+        self._sites = {}
+        self._chars = 0
+        self._lines = 0
+        self._text = None
+
+
+    def start(self, text=None):
+        '''Starts tracking a processing.
+
+        Args:
+            text (str, optional): Processed text, if it is not read from a file.
+        '''
+        self.renderdepth = 0
+        self._sites = {}
+        self._chars = 0
+        self._lines = 0
+        self._text = text
+
+
+    @property
+    def attributed(self):
+        'Number of characters and lines attributed so far.'
+        return self._chars, self._lines
+
+
+    def attribute(self, fname, linenr, out, attributed):
+        '''Attributes output to a source line.
+
+        Args:
+            fname (str): Source file.
+            linenr (int): Source line (starting with zero).
+            out (list of str): Output of the node, including the output of its
+                child nodes.
+            attributed (tuple): Value of the attributed property before the
+                node had been rendered.
+        '''
+        chars = 0
+        lines = 0
+        for item in out:
+            chars += len(item)
+            lines += item.count('\n')
+        # Output of the child nodes has been attributed already
+        chars -= self._chars - attributed[0]
+        lines -= self._lines - attributed[1]
+        if not chars and not lines:
+            return
+        site = self._sites.get((fname, linenr))
+        if site is None:
+            site = self._sites[fname, linenr] = [0, 0]
+        site[0] += chars
+        site[1] += lines
+        self._chars += chars
+        self._lines += lines
+
+
+    def get_report(self, encoding=None):
+        '''Returns the report of the last tracked processing (see
+        Fypp.get_expansion_report()).'''
+        sites = [{'file': fname, 'line': linenr + 1, 'chars': chars,
+                  'lines': lines}
+                 for (fname, linenr), (chars, lines) in self._sites.items()]
+        sites.sort(key=lambda site: (-site['chars'], site['file'],
+                                     site['line']))
+        files = {}
+        for site in sites:
+            fileinfo = files.get(site['file'])
+            if fileinfo is None:
+                inchars, inlines = self._get_input_size(site['file'], encoding)
+                fileinfo = files[site['file']] = {
+                    'file': site['file'], 'input_chars': inchars,
+                    'input_lines': inlines, 'output_chars': 0,
+                    'output_lines': 0}
+            fileinfo['output_chars'] += site['chars']
+            fileinfo['output_lines'] += site['lines']
+        for fileinfo in files.values():
+            inchars = fileinfo['input_chars']
+            fileinfo['ratio'] = fileinfo['output_chars'] / inchars \
+                if inchars else None
+        files = sorted(files.values(), key=lambda info: -info['output_chars'])
+        return {'total': {'chars': self._chars, 'lines': self._lines},
+                'sites': sites, 'files': files}
+
+
+    def _get_input_size(self, fname, encoding):
+        if fname == STRING and self._text is not None:
+            txt = self._text
+        else:
+            try:
+                with io.open(fname, 'r', encoding=encoding) as fp:
+                    txt = fp.read()
+            except (OSError, UnicodeDecodeError):
+                return None, None
+        nlines = txt.count('\n')
+        if txt and not txt.endswith('\n'):
+            nlines += 1
+        return len(txt), nlines
+
+
+class _FileWatcher:
+
+    '''Reprocesses input files, whenever any of the files they depend on
+    changes.
+
+    Changes are detected by polling the modification time and the size of the
+    input file, of the files it included during its last processing and of the
+    locations probed without success when searching for them. Each
+    reprocessing starts with a new Fypp instance, so that no state is carried
+    over from previous runs.
+
+    Args:
+        options (FyppOptions): Options to use for processing.
+        filepairs (list of tuple): Input and output file names.
+    '''
+
+    def __init__(self, options, filepairs):
+        self._options = options
+        self._filepairs = filepairs
+        # Signatures of the dependencies of each file pair
+        self._depstates = [None] * len(filepairs)
 
 
-    @staticmethod
-    def _get_syspath_without_scriptdir():
-        '''Remove the folder of the fypp binary from the search path'''
-        syspath = list(sys.path)
-        scriptdir = os.path.abspath(os.path.dirname(sys.argv[0]))
-        if os.path.abspath(syspath[0]) == scriptdir:
-            del syspath[0]
-        return syspath
+    def update(self):
+        '''Reprocesses the input files with changed dependencies.
 
+        Returns:
+            list of tuple: Output file name, processing time in seconds and
+            the raised FyppError (or None) for each processed file pair.
+        '''
+        results = []
+        for ipair, (infile, outfile) in enumerate(self._filepairs):
+            depstate = self._depstates[ipair]
+            if depstate is not None and all(
+                    _get_file_signature(fname) == signature
+                    for fname, signature in depstate.items()):
+                continue
+            starttime = time.perf_counter()
+            deps = [infile]
+            error = None
+            try:
+                tool = Fypp(self._options)
+                try:
+                    tool.process_file(infile, outfile)
+                finally:
+                    for fname, probed in tool.get_included_files():
+                        deps += probed
+                        deps.append(fname)
+            except FyppError as exc:
+                error = exc
+                # Keep watching files, which may have not been reached
+                if depstate is not None:
+                    deps += depstate.keys()
+            duration = time.perf_counter() - starttime
+            self._depstates[ipair] = {
+                fname: _get_file_signature(fname) for fname in deps}
+            results.append((outfile, duration, error))
+        return results
+
+
+    def run(self, interval):
+        '''Checks for changes and reprocesses files until interrupted.
 
-    @staticmethod
-    def _adjust_syspath(syspath):
-        sys.path = syspath
+        Args:
+            interval (float): Time in seconds between subsequent checks.
+        '''
+        while True:
+            for outfile, duration, error in self.update():
+                if error is not None:
+                    sys.stderr.write(_formatted_exception(error))
+                sys.stderr.write("{0} '{1}' in {2:.1f} ms\n".format(
+                    'Failed to update' if error is not None else 'Updated',
+                    outfile, duration * 1000.0))
+            sys.stderr.flush()
+            time.sleep(interval)
 
 
 class FyppOptions(optparse.Values):
@@ -2653,8 +6099,8 @@ class FyppOptions(optparse.Values):
             files. Default: []
         line_numbering (bool): Whether line numbering directives should appear
             in the output. Default: False
-        line_numbering_mode (str): Line numbering mode 'full' or 'nocontlines'.
-            Default: 'full'.
+        line_numbering_mode (str): Line numbering mode 'full', 'nocontlines'
+            or 'minimal'. Default: 'full'.
         line_marker_format (str): Line marker format. Currently 'std',
             'cpp' and 'gfortran5' are supported, where 'std' emits ``#line``
             pragmas similar to standard tools, 'cpp' produces line directives as
@@ -2678,6 +6124,92 @@ class FyppOptions(optparse.Values):
             setting.
         create_parent_folder (bool): Whether the parent folder for the output
             file should be created if it does not exist. Default: False.
+        write_if_changed (bool): Whether the output file should only be
+            written if its content changes, so that its modification time is
+            kept otherwise. Default: False.
+        depfile (str): File to write the dependencies of the output files
+            into in Makefile format (command line tool only, not in watch
+            mode). Default: None (no dependency file).
+        depfile_target (str): Target of a single rule in the dependency file,
+            listing the prerequisites of all output files (e.g. a stamp file
+            of the build system). Default: None (one rule per output file).
+        mmap_threshold (int): Input and include files with a size (in bytes)
+            of at least this value are memory mapped, and only the regions
+            containing directives are decoded and scanned as whole. Default:
+            None (files are read completely).
+        macro_cache_size (int): Maximal number of results memoized for each
+            macro declared as pure. If zero, no results are memoized.
+            Default: 256.
+        macro_cache_report (bool): Whether the memoization statistics of the
+            pure macros should be written to stderr after processing (command
+            line tool only). Default: False.
+        lazy_arguments (bool): Whether arguments passed to macros in the body
+            of call directives should be passed lazily to all macros. Macros
+            not declared as lazy render them when entered, so that they receive
+            strings. Default: False.
+        loop_workers (int): Number of processes rendering the iterations of
+            loops declared as parallel. Default: None (number of CPUs).
+        block_cache_dir (str): Directory to store the output of cache
+            directives in, so that it can be reused in subsequent runs.
+            Default: None (output of cache directives only cached in memory).
+        cache_dir (str): Directory to store the output of processed files in,
+            so that unchanged input files (with unchanged include files and
+            settings) are not processed again. Default: None (no output
+            caching).
+        watch (bool): Whether the input files should be reprocessed whenever
+            they or their include files change (command line tool only).
+            Default: False.
+        watch_interval (float): Interval in seconds between the checks for
+            changed files in watch mode. Default: 0.5.
+        jobs (int): Number of threads processing the input files concurrently
+            (command line tool only). If set, the positional arguments are
+            pairs of input and output files. Default: None (single file
+            processed).
+        preload (list of str): Library files to process once before the input
+            files. Each input file starts with a copy of the definitions made
+            by them, and include directives referring to them are ignored.
+            Default: [].
+        defines_files (list of str): Files with variable definitions. Each
+            file must contain a table mapping variable names to their values
+            in JSON ('.json'), TOML ('.toml', needs Python 3.11 or newer) or
+            Python literal (all other extensions) format. Definitions are
+            applied before the ones in defines, defines_str and defines_eval.
+            Default: [].
+        specialize (bool): Whether the variables defined via defines_files,
+            defines, defines_str and defines_eval should be considered as
+            fixed, so that expressions depending only on them are folded and
+            dead branches of if directives are removed before rendering.
+            Default: False.
+        define_usage (bool): Whether a define-usage manifest listing the
+            variables read during the processing should be written to a file
+            with the name of the output file extended by '.defines.json'. The
+            output cache (see cache_dir) is not used in this case.
+            Default: False.
+        memory_report (bool): Whether the memory usage of the processing
+            phases (measured with tracemalloc) should be written to stderr after
+            processing (command line tool only, not in watch mode or with
+            jobs). Default: False.
+        expansion_report (int): Number of source lines producing the most
+            output, which should be written to stderr after processing together
+            with the expansion ratio of each file (command line tool only, not
+            in watch mode or with jobs). Default: None (no report).
+        expansion_json (str): File to write the amount of output produced by
+            each source line and file into in JSON format (command line tool
+            only, not in watch mode or with jobs). Default: None (no report).
+        metrics_file (str): File to append a JSON record with the metrics of
+            each processed file to, one record per line (command line tool
+            only, not in watch mode). Default: None (no metrics).
+        options_files (list of str): Files with option settings, applied
+            before the command line options (command line tool only).
+            Default: [].
+        source_map (str): Format of the source map ('json' or 'binary') to
+            create instead of inline line numbering markers. The source map is
+            written to a file with the name of the output file extended by
+            '.map'. Default: None (no source map).
+        translate_locations (str): Source map file, used to translate the
+            output file locations in the input to source file locations
+            instead of processing the input (command line tool only).
+            Default: None.
     '''
 
     def __init__(self):
@@ -2699,7 +6231,63 @@ class FyppOptions(optparse.Values):
         self.fixed_format = False
         self.encoding = 'utf-8'
         self.create_parent_folder = False
+        self.write_if_changed = False
+        self.depfile = None
+        self.depfile_target = None
         self.file_var_root = None
+        self.mmap_threshold = None
+        self.macro_cache_size = 256
+        self.macro_cache_report = False
+        self.lazy_arguments = False
+        self.loop_workers = None
+        self.block_cache_dir = None
+        self.cache_dir = None
+        self.watch = False
+        self.preload = []
+        self.defines_files = []
+        self.options_files = []
+        self.source_map = None
+        self.translate_locations = None
+        self.watch_interval = 0.5
+        self.jobs = None
+        self.specialize = False
+        self.define_usage = False
+        self.memory_report = False
+        self.expansion_report = None
+        self.expansion_json = None
+        self.metrics_file = None
+
+
+    def update_from_file(self, fname):
+        '''Updates the options with the settings stored in a file.
+
+        The file must contain a table mapping option names (the attributes of
+        this class) to their values in JSON ('.json'), TOML ('.toml', needs
+        Python 3.11 or newer) or Python literal (all other extensions) format.
+        Values are read without evaluating them.
+
+        Args:
+            fname (str): Name of the options file.
+
+        Raises:
+            FyppFatalError: If the file can not be read, or if it contains
+                invalid or unknown options or values of wrong type.
+        '''
+        settings = _load_data_file(fname)
+        for name, value in settings.items():
+            if not isinstance(name, str) \
+                    or not _IDENTIFIER_REGEXP.fullmatch(name):
+                msg = "invalid option name '{0}' in file '{1}'"\
+                    .format(name, fname)
+                raise FyppFatalError(msg)
+            if name not in vars(self) or name == 'options_files':
+                msg = "unknown option '{0}' in file '{1}'".format(name, fname)
+                raise FyppFatalError(msg)
+            if not _is_valid_option_value(getattr(self, name), value):
+                msg = "invalid value for option '{0}' in file '{1}'"\
+                    .format(name, fname)
+                raise FyppFatalError(msg)
+            setattr(self, name, value)
 
 
 class FortranLineFolder:
@@ -2747,6 +6335,12 @@ class FortranLineFolder:
             self._fold_position_finder = self._get_smart_fold_pos
 
 
+    @property
+    def maxlen(self):
+        'Maximal line length, lines up to this length are not folded.'
+        return self._maxlen
+
+
     def __call__(self, line):
         '''Folds a line.
 
@@ -2822,6 +6416,203 @@ class PlaceholderLineFolder:
         return [line]
 
 
+class SourceMap:
+
+    '''Maps the lines of a processed output to their origin in the sources.
+
+    The map consists of segments, each describing a run of consecutive
+    output lines, which originate from consecutive lines of a source file.
+    It contains the same information as the line numbering markers.
+
+    Args:
+        sources (list of str): Names of the source files.
+        segments (list of tuple): Segments in ascending order. Each segment
+            is a tuple of the first output line of the run, the index of the
+            source file and the corresponding line in the source file (lines
+            starting with one). A segment extends until the start of the next
+            one.
+        outfile (str, optional): Name of the output file described by the
+            map.
+    '''
+
+    def __init__(self, sources, segments, outfile=None):
+        self.sources = sources
+        self.segments = segments
+        self.outfile = outfile
+        self._starts = [segment[0] for segment in segments]
+
+
+    def lookup(self, linenr):
+        '''Returns the origin of an output line.
+
+        Args:
+            linenr (int): Line in the output (starting with one).
+
+        Returns:
+            tuple: Name of the source file and the line in it (starting with
+            one) or None, if the line precedes all segments.
+        '''
+        iseg = bisect.bisect_right(self._starts, linenr) - 1
+        if iseg < 0:
+            return None
+        start, isource, sourceline = self.segments[iseg]
+        return self.sources[isource], sourceline + linenr - start
+
+
+    def dumps(self, fmt='json'):
+        '''Returns the encoded source map.
+
+        Args:
+            fmt (str): Format, either 'json' or 'binary'. The binary format
+                stores the run length of each segment and the difference of
+                its source line to the one of the previous segment as
+                variable length integers.
+
+        Returns:
+            bytes: Encoded source map.
+        '''
+        if fmt == 'json':
+            data = {'version': 1, 'file': self.outfile,
+                    'sources': self.sources,
+                    'segments': [list(segment) for segment in self.segments]}
+            return json.dumps(data, separators=(',', ':')).encode('utf-8')
+        values = [len(self.sources), len(self.segments)]
+        names = []
+        for name in [self.outfile or ''] + self.sources:
+            encoded = name.encode('utf-8')
+            values.append(len(encoded))
+            names.append(encoded)
+        prevstart = 1
+        prevline = 0
+        for start, isource, sourceline in self.segments:
+            diff = sourceline - prevline
+            values += [start - prevstart, isource,
+                       2 * diff if diff >= 0 else -2 * diff - 1]
+            prevstart = start
+            prevline = sourceline
+        header = _encode_varints(values[:2 + len(names)])
+        return b''.join([_SOURCE_MAP_MAGIC, header] + names
+                        + [_encode_varints(values[2 + len(names):])])
+
+
+    @classmethod
+    def loads(cls, data):
+        '''Creates a source map from its encoded form.
+
+        Args:
+            data (bytes): Source map in JSON or binary format.
+
+        Returns:
+            SourceMap: Source map.
+
+        Raises:
+            FyppFatalError: If data is not a valid source map.
+        '''
+        try:
+            if not data.startswith(_SOURCE_MAP_MAGIC):
+                content = json.loads(data.decode('utf-8'))
+                segments = [tuple(segment) for segment in content['segments']]
+                return cls(content['sources'], segments, content['file'])
+            (nsources, nsegments), pos = _decode_varints(
+                data, len(_SOURCE_MAP_MAGIC), 2)
+            namelens, pos = _decode_varints(data, pos, nsources + 1)
+            names = []
+            for namelen in namelens:
+                names.append(data[pos : pos + namelen].decode('utf-8'))
+                pos += namelen
+            values, pos = _decode_varints(data, pos, 3 * nsegments)
+            segments = []
+            start = 1
+            sourceline = 0
+            for ind in range(0, len(values), 3):
+                runlen, isource, diff = values[ind : ind + 3]
+                start += runlen
+                sourceline += diff // 2 if diff % 2 == 0 else -(diff + 1) // 2
+                segments.append((start, isource, sourceline))
+        except (ValueError, KeyError, TypeError, IndexError) as exc:
+            raise FyppFatalError('invalid source map') from exc
+        return cls(names[1:], segments, names[0] or None)
+
+
+    def write(self, fname, fmt='json'):
+        '''Writes the source map into a file.
+
+        Args:
+            fname (str): Name of the file.
+            fmt (str): Format, either 'json' or 'binary'.
+        '''
+        try:
+            with io.open(fname, 'wb') as fp:
+                fp.write(self.dumps(fmt))
+        except OSError as exc:
+            msg = "Failed to write source map '{0}'".format(fname)
+            raise FyppFatalError(msg) from exc
+
+
+    @classmethod
+    def read(cls, fname):
+        '''Reads a source map from a file.
+
+        Args:
+            fname (str): Name of the file (in JSON or binary format).
+
+        Returns:
+            SourceMap: Source map.
+        '''
+        try:
+            with io.open(fname, 'rb') as fp:
+                data = fp.read()
+        except OSError as exc:
+            msg = "Failed to open file '{0}' for read".format(fname)
+            raise FyppFatalError(msg) from exc
+        return cls.loads(data)
+
+
+    @classmethod
+    def from_output(cls, output, outfile=None):
+        '''Extracts the source map from output rendered with the line
+        numbering format 'records'.
+
+        Args:
+            output (str): Rendered output containing line records.
+            outfile (str, optional): Name of the output file.
+
+        Returns:
+            tuple: Source map and the output with the line records removed.
+        '''
+        sources = []
+        sourceinds = {}
+        segments = []
+        parts = []
+        linenr = 1
+        pos = 0
+        while True:
+            start = output.find(_LINE_RECORD, pos)
+            if start == -1:
+                parts.append(output[pos:])
+                break
+            part = output[pos:start]
+            parts.append(part)
+            linenr += part.count('\n')
+            pos = output.index('\n', start) + 1
+            record = output[start + len(_LINE_RECORD) : pos - 1]
+            sourceline, _, fname = record.split('\x00', 2)
+            sourceline = int(sourceline)
+            isource = sourceinds.get(fname)
+            if isource is None:
+                isource = sourceinds[fname] = len(sources)
+                sources.append(fname)
+            if segments:
+                prevstart, previsource, prevline = segments[-1]
+                if prevstart == linenr:
+                    del segments[-1]
+                elif (previsource == isource
+                      and prevline + linenr - prevstart == sourceline):
+                    continue
+            segments.append((linenr, isource, sourceline))
+        return cls(sources, segments, outfile), ''.join(parts)
+
+
 def get_option_parser():
     '''Returns an option parser for the Fypp command line tool.
 
@@ -2885,9 +6676,10 @@ def get_option_parser():
     msg = 'line numbering mode, \'full\' (default): line numbering '\
           'markers generated whenever source and output lines are out '\
           'of sync, \'nocontlines\': line numbering markers omitted '\
-          'for continuation lines'
+          'for continuation lines, \'minimal\': as \'full\', but only '\
+          'markers needed for correct attribution of the next line are kept'
     parser.add_option('-N', '--line-numbering-mode', metavar='MODE',
-                      choices=['full', 'nocontlines'],
+                      choices=['full', 'nocontlines', 'minimal'],
                       default=defs.line_numbering_mode,
                       dest='line_numbering_mode', help=msg)
 
@@ -2901,6 +6693,21 @@ def get_option_parser():
                       dest='line_marker_format',
                       default=defs.line_marker_format, help=msg)
 
+    msg = 'create a source map in format FMT (\'json\' or \'binary\') '\
+          'instead of emitting line numbering markers and write it to '\
+          'OUTFILE.map'
+    parser.add_option('--source-map', metavar='FMT',
+                      choices=['json', 'binary'], dest='source_map',
+                      default=defs.source_map, help=msg)
+
+    msg = 'translate locations (e.g. in compiler messages) in INFILE '\
+          'referring to the output file described by source map MAPFILE into '\
+          'the corresponding source file locations, and write the result to '\
+          'OUTFILE instead of preprocessing INFILE'
+    parser.add_option('--translate-locations', metavar='MAPFILE',
+                      dest='translate_locations',
+                      default=defs.translate_locations, help=msg)
+
     msg = 'maximal line length (default: 132), lines modified by the '\
           'preprocessor are folded if becoming longer'
     parser.add_option('-l', '--line-length', type=int, metavar='LEN',
@@ -2937,12 +6744,155 @@ def get_option_parser():
                       dest='create_parent_folder',
                       default=defs.create_parent_folder, help=msg)
 
+    msg = 'write the output file only if its content changes, keeping its '\
+          'modification time otherwise'
+    parser.add_option('--write-if-changed', action='store_true',
+                      dest='write_if_changed',
+                      default=defs.write_if_changed, help=msg)
+
+    msg = 'write a Makefile rule for each output file into FILE, listing the '\
+          'input file and the files it included as prerequisites (e.g. for '\
+          'the DEPFILE option of CMake)'
+    parser.add_option('--depfile', metavar='FILE', dest='depfile',
+                      default=defs.depfile, help=msg)
+
+    msg = 'write a single rule with target NAME into the dependency file, '\
+          'listing the prerequisites of all output files'
+    parser.add_option('--depfile-target', metavar='NAME',
+                      dest='depfile_target', default=defs.depfile_target,
+                      help=msg)
+
     msg = 'in variables _FILE_ and _THIS_FILE_, use relative paths with DIR '\
           'as root directory. Note: the input file and all included files '\
           'must be in DIR or in a directory below.'
     parser.add_option('--file-var-root', metavar='DIR', dest='file_var_root',
                       default=defs.file_var_root, help=msg)
 
+    msg = 'memory map input and include files with a size of at least SIZE '\
+          'bytes and only decode and scan the regions containing directives '\
+          'as whole (default: files are read completely)'
+    parser.add_option('--mmap-threshold', type=int, metavar='SIZE',
+                      dest='mmap_threshold', default=defs.mmap_threshold,
+                      help=msg)
+
+    msg = 'maximal number of results memoized for each macro declared as '\
+          'pure (default: 256, 0 turns memoization off)'
+    parser.add_option('--macro-cache-size', type=int, metavar='SIZE',
+                      dest='macro_cache_size', default=defs.macro_cache_size,
+                      help=msg)
+
+    msg = 'write memoization statistics of the macros declared as pure to '\
+          'stderr after processing'
+    parser.add_option('--macro-cache-report', action='store_true',
+                      dest='macro_cache_report',
+                      default=defs.macro_cache_report, help=msg)
+
+    msg = 'pass arguments in the body of call directives lazily to all macros '\
+          '(macros not declared as lazy render them when entered; default: '\
+          'only for macros declared as lazy)'
+    parser.add_option('--lazy-arguments', action='store_true',
+                      dest='lazy_arguments', default=defs.lazy_arguments,
+                      help=msg)
+
+    msg = 'number of processes rendering the iterations of loops declared as '\
+          'parallel (default: number of CPUs, values below 2 render all '\
+          'loops serially)'
+    parser.add_option('--loop-workers', type=int, metavar='NUM',
+                      dest='loop_workers', default=defs.loop_workers, help=msg)
+
+    msg = 'store the output of cache directives in directory DIR, so that '\
+          'it can be reused in subsequent runs (default: output is only '\
+          'cached in memory)'
+    parser.add_option('--block-cache-dir', metavar='DIR',
+                      dest='block_cache_dir', default=defs.block_cache_dir,
+                      help=msg)
+    msg = 'cache the output of processed files in directory DIR and reuse '\
+          'it, if the input file, its include files and all relevant '\
+          'settings are unchanged (default: no output caching)'
+    parser.add_option('--cache-dir', metavar='DIR', dest='cache_dir',
+                      default=defs.cache_dir, help=msg)
+
+    msg = 'process library file FILE once before processing the input and '\
+          'start processing with a copy of its definitions; include '\
+          'directives referring to FILE are ignored (can be specified '\
+          'multiple times)'
+    parser.add_option('--preload', action='append', metavar='FILE',
+                      dest='preload', default=defs.preload, help=msg)
+
+    msg = 'read variable definitions from FILE, containing a table mapping '\
+          'variable names to values in JSON (.json), TOML (.toml, needs '\
+          'Python 3.11 or newer) or Python literal (any other extension) '\
+          'format; applied before -D, -S and -E definitions (can be specified '\
+          'multiple times)'
+    parser.add_option('--defines-file', action='append', metavar='FILE',
+                      dest='defines_files', default=defs.defines_files,
+                      help=msg)
+
+    msg = 'treat variables defined by -D, -S, -E and --defines-file as fixed: '\
+          'expressions depending only on them are folded and dead branches '\
+          'of if directives (including their include files) are pruned before '\
+          'rendering'
+    parser.add_option('--specialize', action='store_true', dest='specialize',
+                      default=defs.specialize, help=msg)
+
+    msg = 'write the names of all variables read or queried during the '\
+          'processing into a JSON file next to the output file (output file '\
+          'name extended by \'.defines.json\')'
+    parser.add_option('--define-usage', action='store_true',
+                      dest='define_usage', default=defs.define_usage, help=msg)
+
+    msg = 'write the peak and retained memory of the parse, render, join and '\
+          'write phases, as well as the sizes of the tree, the output buffer '\
+          'and the macros to stderr after processing (measured with '\
+          'tracemalloc, slows down processing)'
+    parser.add_option('--memory-report', action='store_true',
+                      dest='memory_report', default=defs.memory_report,
+                      help=msg)
+
+    msg = 'write the NUM source lines producing the most output and the '\
+          'expansion ratio of each file to stderr after processing'
+    parser.add_option('--expansion-report', type=int, metavar='NUM',
+                      dest='expansion_report', default=defs.expansion_report,
+                      help=msg)
+
+    msg = 'write the amount of output produced by each source line and file '\
+          'into FILE in JSON format'
+    parser.add_option('--expansion-json', metavar='FILE',
+                      dest='expansion_json', default=defs.expansion_json,
+                      help=msg)
+
+    msg = 'append a JSON record with the sizes, counts of evaluations, macro '\
+          'calls and loops, phase durations, cache hit and exit status of '\
+          'each processed file to FILE (one record per line)'
+    parser.add_option('--metrics-file', metavar='FILE', dest='metrics_file',
+                      default=defs.metrics_file, help=msg)
+
+    msg = 'read option settings from FILE, containing a table mapping option '\
+          'names (as in the FyppOptions class) to values in JSON (.json), '\
+          'TOML (.toml) or Python literal (any other extension) format; '\
+          'command line options take precedence (can be specified multiple '\
+          'times)'
+    parser.add_option('--options-file', action='append', metavar='FILE',
+                      dest='options_files', default=defs.options_files,
+                      help=msg)
+
+    msg = 'keep running and reprocess the input files, whenever they or any '\
+          'of the files included by them change; in this mode, all '\
+          'positional arguments are pairs of INFILE and OUTFILE'
+    parser.add_option('--watch', action='store_true', dest='watch',
+                      default=defs.watch, help=msg)
+
+    msg = 'interval in seconds between the checks for changed files in '\
+          'watch mode (default: 0.5)'
+    parser.add_option('--watch-interval', metavar='SEC', type='float',
+                      dest='watch_interval', default=defs.watch_interval,
+                      help=msg)
+
+    msg = 'process the input files concurrently with NUM threads; in this '\
+          'mode, all positional arguments are pairs of INFILE and OUTFILE'
+    parser.add_option('-j', '--jobs', metavar='NUM', type=int, dest='jobs',
+                      default=defs.jobs, help=msg)
+
     return parser
 
 
@@ -2951,11 +6901,55 @@ def run_fypp():
     options = FyppOptions()
     optparser = get_option_parser()
     opts, leftover = optparser.parse_args(values=options)
+    if opts.options_files:
+        options = FyppOptions()
+        try:
+            for fname in opts.options_files:
+                options.update_from_file(fname)
+        except FyppFatalError as exc:
+            sys.stderr.write(_formatted_exception(exc))
+            sys.exit(ERROR_EXIT_CODE)
+        # Command line settings override the ones in the options files
+        opts, leftover = optparser.parse_args(values=options)
+    if opts.watch:
+        if not leftover or len(leftover) % 2:
+            optparser.error('watch mode needs pairs of INFILE and OUTFILE')
+        if STDIN in leftover or '-' in leftover:
+            optparser.error('watch mode can not use stdin or stdout')
+        watcher = _FileWatcher(opts, list(zip(leftover[0::2], leftover[1::2])))
+        try:
+            watcher.run(opts.watch_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+    if opts.jobs is not None:
+        if not leftover or len(leftover) % 2:
+            optparser.error('option --jobs needs pairs of INFILE and OUTFILE')
+        _run_fypp_batch(opts, list(zip(leftover[0::2], leftover[1::2])))
+        return
     infile = leftover[0] if len(leftover) > 0 else '-'
     outfile = leftover[1] if len(leftover) > 1 else '-'
     try:
+        if opts.translate_locations is not None:
+            _translate_locations(opts.translate_locations, infile, outfile)
+            return
         tool = Fypp(opts)
-        tool.process_file(infile, outfile)
+        try:
+            tool.process_file(infile, outfile)
+        finally:
+            if opts.metrics_file is not None:
+                _write_metrics(tool.get_metrics(), opts.metrics_file)
+        if opts.depfile is not None:
+            _write_depfile(tool.get_dependencies(), opts.depfile,
+                           opts.depfile_target, opts.create_parent_folder)
+        if opts.macro_cache_report:
+            sys.stderr.write(
+                _formatted_macro_cache_stats(tool.get_macro_cache_stats()))
+        if opts.memory_report:
+            sys.stderr.write(_formatted_memory_report(tool.get_memory_report()))
+        if opts.expansion_report is not None or opts.expansion_json is not None:
+            _write_expansion_report(tool.get_expansion_report(),
+                                    opts.expansion_report, opts.expansion_json)
     except FyppStopRequest as exc:
         sys.stderr.write(_formatted_exception(exc))
         sys.exit(USER_ERROR_EXIT_CODE)
@@ -2964,6 +6958,63 @@ def run_fypp():
         sys.exit(ERROR_EXIT_CODE)
 
 
+def _run_fypp_batch(options, filepairs):
+    '''Processes pairs of input and output files concurrently and exits with
+    the exit code of the most severe error.'''
+    exitcode = 0
+    try:
+        tool = Fypp(options)
+        errors = tool.process_files(filepairs, options.jobs)
+        if options.metrics_file is not None:
+            _write_metrics(tool.get_metrics(), options.metrics_file)
+        if options.depfile is not None and not any(errors):
+            _write_depfile(tool.get_dependencies(), options.depfile,
+                           options.depfile_target, options.create_parent_folder)
+    except FyppError as exc:
+        errors = [exc]
+    for error in errors:
+        if error is None:
+            continue
+        sys.stderr.write(_formatted_exception(error))
+        if isinstance(error, FyppStopRequest):
+            exitcode = exitcode or USER_ERROR_EXIT_CODE
+        else:
+            exitcode = ERROR_EXIT_CODE
+    if exitcode:
+        sys.exit(exitcode)
+
+
+def _write_metrics(records, fname):
+    '''Appends metrics records to a file in JSON lines format.'''
+    try:
+        with io.open(fname, 'a', encoding='utf-8') as fp:
+            for record in records:
+                fp.write(json.dumps(record, sort_keys=True) + '\n')
+    except OSError as exc:
+        msg = "Failed to write metrics file '{0}'".format(fname)
+        raise FyppFatalError(msg) from exc
+
+
+def _write_depfile(dependencies, fname, target=None, create_parents=False):
+    '''Writes the dependencies of output files as Makefile rules (or as a
+    single rule for the given target).'''
+    dependencies = sorted(dependencies)
+    if target is not None:
+        prereqs = [prereq for _, prereqs in dependencies for prereq in prereqs]
+        dependencies = [(target, list(dict.fromkeys(prereqs)))]
+    rules = []
+    for outfile, prereqs in dependencies:
+        rules.append('{0}: {1}\n'.format(
+            _escape_make_path(outfile),
+            ' \\\n  '.join(_escape_make_path(prereq) for prereq in prereqs)))
+    _write_file_if_changed(fname, ''.join(rules), 'utf-8', create_parents)
+
+
+def _escape_make_path(path):
+    '''Escapes the characters of a path with special meaning in Makefiles.'''
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
 def linenumdir_cpp(linenr, fname, flag=None):
     """Returns a GNU cpp style line directive.
 
@@ -3010,6 +7061,286 @@ def _open_input_file(inpfile, encoding=None):
     return inpfp
 
 
+def _is_ascii_compatible(encoding):
+    try:
+        encoded = _MMAP_SCANNED_CHARS.encode(encoding)
+    except (LookupError, UnicodeError):
+        return False
+    return encoded == _MMAP_SCANNED_CHARS.encode('ascii')
+
+
+def _find_mapped_region_end(buf, pos):
+    '''Returns the end of the line containing pos, including all
+    continuation lines following it.'''
+    size = len(buf)
+    while True:
+        eol = buf.find(b'\n', pos)
+        if eol == -1:
+            return size
+        if not buf[pos:eol].rstrip(b' \t').endswith(b'&'):
+            return eol + 1
+        pos = eol + 1
+
+
+def _load_cached_block(cachedir, digest):
+    fname = os.path.join(cachedir, digest + '.json')
+    try:
+        with io.open(fname, 'r', encoding='utf-8') as fp:
+            data = json.load(fp)
+        out = data['out']
+        ieval = data['ieval']
+        peval = [(tuple(span), spanfname) for span, spanfname in data['peval']]
+        dependencies = dict(data['dependencies'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return (out, ieval, peval), dependencies
+
+
+def _store_cached_block(cachedir, digest, cached, dependencies):
+    out, ieval, peval = cached
+    data = {'out': out, 'ieval': ieval, 'peval': peval,
+            'dependencies': dependencies}
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        _write_file_atomically(
+            os.path.join(cachedir, digest + '.json'),
+            json.dumps(data).encode('utf-8'))
+    except OSError as exc:
+        msg = "Failed to store cached block in folder '{0}'".format(cachedir)
+        raise FyppFatalError(msg) from exc
+
+
+def _has_literal_repr(value):
+    '''Checks whether the repr() of a value is a literal of an equal value.'''
+    try:
+        return ast.literal_eval(repr(value)) == value
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False
+
+
+def _write_file_atomically(fname, content):
+    '''Writes content (bytes) into a temporary file in the target directory
+    and renames it, so that concurrent readers never see partial content.'''
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(fname)), suffix='.tmp',
+        dir=dirname)
+    try:
+        with io.open(fd, 'wb') as fp:
+            fp.write(content)
+        os.replace(tmpname, fname)
+    except OSError:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def _get_file_digest(fname):
+    '''Returns the SHA256 digest of a file or None, if it can not be read.'''
+    try:
+        with io.open(fname, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _load_data_file(fname):
+    '''Returns the table stored in a JSON, TOML or Python literal file.
+
+    Loaded files are cached, the cache entry being keyed by the modification
+    time and the size of the file. A copy of the cached content is returned.
+    '''
+    try:
+        stat = os.stat(fname)
+        key = os.path.abspath(fname)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _LOADED_DATA_FILES.get(key)
+        if cached is None or cached[0] != signature:
+            with io.open(fname, 'rb') as fp:
+                content = fp.read()
+            cached = (signature, _parse_data_file(fname, content))
+            _LOADED_DATA_FILES[key] = cached
+    except OSError as exc:
+        msg = "Failed to open file '{0}' for read".format(fname)
+        raise FyppFatalError(msg) from exc
+    return copy.deepcopy(cached[1])
+
+
+def _parse_data_file(fname, content):
+    ext = os.path.splitext(fname)[1].lower()
+    try:
+        if ext == '.json':
+            data = json.loads(content.decode('utf-8'))
+        elif ext == '.toml':
+            try:
+                import tomllib
+            except ImportError as exc:
+                msg = "reading TOML file '{0}' needs Python 3.11 or newer"\
+                    .format(fname)
+                raise FyppFatalError(msg) from exc
+            data = tomllib.loads(content.decode('utf-8'))
+        else:
+            data = ast.literal_eval(content.decode('utf-8'))
+    except FyppFatalError:
+        raise
+    except Exception as exc:
+        msg = "invalid content in file '{0}'".format(fname)
+        raise FyppFatalError(msg) from exc
+    if not isinstance(data, dict):
+        msg = "file '{0}' does not contain a table".format(fname)
+        raise FyppFatalError(msg)
+    return data
+
+
+def _is_valid_option_value(default, value):
+    '''Checks whether a value has the same type as the default value of an
+    option.'''
+    if isinstance(default, list):
+        return isinstance(value, list) \
+            and all(isinstance(item, str) for item in value)
+    if isinstance(value, bool) or isinstance(default, bool):
+        return isinstance(value, bool) and isinstance(default, bool)
+    if isinstance(default, float):
+        return isinstance(value, (int, float))
+    if default is None:
+        return value is None or isinstance(value, (str, int))
+    return isinstance(value, type(default))
+
+
+def _encode_varints(values):
+    '''Encodes non-negative integers as variable length (LEB128) integers.'''
+    encoded = bytearray()
+    for value in values:
+        while value >= 0x80:
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def _decode_varints(data, pos, nvalues):
+    '''Decodes given number of variable length integers starting at pos.
+
+    Returns the values and the position after the last one.
+    '''
+    values = []
+    for _ in range(nvalues):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, pos
+
+
+def _linenumdir_record(linenr, fname, flag=None):
+    '''Returns an internal line record, which is converted into a source map
+    entry or a line marker after rendering.'''
+    return '{0}{1}\x00{2}\x00{3}\n'.format(
+        _LINE_RECORD, linenr + 1, '' if flag is None else flag, fname)
+
+
+def _get_minimal_line_markers(output, markerformat):
+    '''Replaces the line records in the output by line markers, omitting all
+    markers which would not change the line attribution.'''
+    linenumdir = linenumdir_std if markerformat == 'std' else linenumdir_cpp
+    gfortran5 = markerformat == 'gfortran5'
+    parts = []
+    # Source position of the next output line according to the markers so far
+    curfile = None
+    curline = None
+    pending = None
+    firstrecord = True
+    pos = 0
+    while True:
+        start = output.find(_LINE_RECORD, pos)
+        part = output[pos:] if start == -1 else output[pos:start]
+        if part:
+            if pending is not None:
+                fname, linenr, flag = pending
+                if (fname, linenr) != (curfile, curline) or flag is not None:
+                    parts.append(linenumdir(linenr - 1, fname, flag))
+                    curfile, curline = fname, linenr
+                pending = None
+            parts.append(part)
+            if curline is not None:
+                curline += part.count('\n')
+        if start == -1:
+            break
+        pos = output.index('\n', start) + 1
+        record = output[start + len(_LINE_RECORD) : pos - 1]
+        linenr, flag, fname = record.split('\x00', 2)
+        flag = int(flag) if flag else None
+        if firstrecord and not gfortran5:
+            flag = None
+        firstrecord = False
+        # Records without output in between: only the last one matters, but
+        # include flags are kept to preserve the nesting of the files
+        if pending is not None and pending[2] is not None:
+            if pending[0] != fname:
+                parts.append(linenumdir(pending[1] - 1, pending[0], pending[2]))
+                curfile, curline = pending[0], pending[1]
+            elif flag is None:
+                flag = pending[2]
+        pending = (fname, int(linenr), flag)
+    return ''.join(parts)
+
+
+def _translate_locations(mapfile, infile, outfile):
+    '''Replaces output file locations in a text with source file locations.'''
+    sourcemap = SourceMap.read(mapfile)
+    if sourcemap.outfile is None:
+        msg = "source map '{0}' does not contain the output file name"\
+            .format(mapfile)
+        raise FyppFatalError(msg)
+    regexp = re.compile(r'(?<![^\s"\'(])(?:[^\s:"\']*[/\\])?{0}:(\d+)'.format(
+        re.escape(os.path.basename(sourcemap.outfile))))
+
+    def translated(match):
+        origin = sourcemap.lookup(int(match.group(1)))
+        if origin is None:
+            return match.group(0)
+        return '{0}:{1}'.format(*origin)
+
+    if infile == '-':
+        txt = sys.stdin.read()
+    else:
+        with _open_input_file(infile) as inpfp:
+            txt = inpfp.read()
+    txt = regexp.sub(translated, txt)
+    if outfile == '-':
+        sys.stdout.write(txt)
+    else:
+        with _open_output_file(outfile) as outfp:
+            outfp.write(txt)
+
+
+def _get_snapshot_copy(value):
+    '''Returns a copy of mutable containers, and the value itself for all other
+    objects.'''
+    if not isinstance(value, (list, dict, set)):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return value
+
+
+def _get_file_signature(fname):
+    '''Returns modification time and size of a file or None, if it does not
+    exist.'''
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
 def _open_output_file(outfile, encoding=None, create_parents=False):
     if create_parents:
         parentdir = os.path.abspath(os.path.dirname(outfile))
@@ -3029,6 +7360,21 @@ def _open_output_file(outfile, encoding=None, create_parents=False):
     return outfp
 
 
+def _write_file_if_changed(outfile, txt, encoding=None, create_parents=False):
+    '''Writes a file unless it exists already with the same content, so that
+    its modification time only changes if its content does.'''
+    try:
+        with io.open(outfile, 'r', encoding=encoding) as fp:
+            unchanged = fp.read() == txt
+    except (IOError, UnicodeDecodeError):
+        unchanged = False
+    if unchanged:
+        return
+    outfp = _open_output_file(outfile, encoding, create_parents)
+    with outfp:
+        outfp.write(txt)
+
+
 # Signature objects are available from Python 3.3 (and deprecated from 3.5)
 def _get_callable_argspec(func):
     sig = inspect.signature(func)
@@ -3052,6 +7398,209 @@ def _get_callable_argspec(func):
 
 
 
+@functools.lru_cache(maxsize=_COMPILED_EXPR_CACHE_SIZE)
+def _compile_expression(expr):
+    '''Compiles an expression for eval() (which ignores leading blanks).'''
+    return compile(expr.lstrip(' \t'), '<string>', 'eval')
+
+
+@functools.lru_cache(maxsize=_COMPILED_EXPR_CACHE_SIZE)
+def _get_trivial_evaluator(expr):
+    '''Returns a fast evaluator for trivial expressions.
+
+    Trivial expressions are literal constants, variable names, attribute and
+    index lookups and single comparisons of those. They can be evaluated
+    without invoking eval().
+
+    Args:
+        expr (str): Expression to classify.
+
+    Returns:
+        tuple or None: None, if the expression is not trivial. Otherwise a tuple
+        containing the names the expression reads from the scope and a function
+        mapping the scope onto the value of the expression. The function may
+        only be called if all names are present in the scope (otherwise eval()
+        must be used to obtain the correct name resolution and error).
+    '''
+    try:
+        tree = ast.parse(expr.lstrip(' \t'), mode='eval')
+    except SyntaxError:
+        return None
+    names = []
+    node = tree.body
+    if isinstance(node, ast.Compare):
+        if len(node.ops) != 1 or type(node.ops[0]) not in _TRIVIAL_COMPARISONS:
+            return None
+        left = _get_trivial_operand_getter(node.left, names)
+        right = _get_trivial_operand_getter(node.comparators[0], names)
+        if left is None or right is None:
+            return None
+        compare = _TRIVIAL_COMPARISONS[type(node.ops[0])]
+        getter = lambda scope: compare(left(scope), right(scope))
+    else:
+        getter = _get_trivial_operand_getter(node, names)
+        if getter is None:
+            return None
+    return tuple(names), getter
+
+
+@functools.lru_cache(maxsize=_COMPILED_EXPR_CACHE_SIZE)
+def _get_expression_names(expr):
+    '''Returns the names an expression reads (including the ones of local
+    variables of lambdas and comprehensions).'''
+    try:
+        tree = ast.parse(expr.lstrip(' \t'), mode='eval')
+    except SyntaxError:
+        return frozenset()
+    return frozenset(node.id for node in ast.walk(tree)
+                     if isinstance(node, ast.Name)
+                     and isinstance(node.ctx, ast.Load))
+
+
+def _get_trivial_operand_getter(node, names):
+    if isinstance(node, ast.Name):
+        name = node.id
+        names.append(name)
+        return operator.itemgetter(name)
+    if isinstance(node, ast.Attribute):
+        getobj = _get_trivial_operand_getter(node.value, names)
+        if getobj is None:
+            return None
+        attr = node.attr
+        return lambda scope: getattr(getobj(scope), attr)
+    if isinstance(node, ast.Subscript):
+        getobj = _get_trivial_operand_getter(node.value, names)
+        # Python < 3.9 wraps the index into an ast.Index node
+        indexnode = node.slice
+        if type(indexnode).__name__ == 'Index':
+            indexnode = indexnode.value
+        getindex = _get_trivial_operand_getter(indexnode, names)
+        if getobj is None or getindex is None:
+            return None
+        return lambda scope: getobj(scope)[getindex(scope)]
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return None
+    if type(value) not in _TRIVIAL_CONSTANT_TYPES:
+        return None
+    return lambda scope: value
+
+
+def _get_string_constant(node):
+    '''Returns the value of a string literal node (or None).'''
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return None
+    return value if isinstance(value, str) else None
+
+
+def _is_immutable_literal(value):
+    '''Checks whether a value is immutable and can be written as literal.'''
+    if type(value) is tuple:
+        return all(_is_immutable_literal(item) for item in value)
+    return type(value) in _TRIVIAL_CONSTANT_TYPES \
+        and _get_literal_expression(value) is not None
+
+
+def _get_literal_expression(value):
+    '''Returns a literal evaluating to a value or None, if there is none.'''
+    if type(value) in (list, tuple):
+        if not all(_get_literal_expression(item) is not None for item in value):
+            return None
+    elif type(value) not in _TRIVIAL_CONSTANT_TYPES:
+        return None
+    literal = repr(value)
+    try:
+        restored = ast.literal_eval(literal)
+    except (ValueError, SyntaxError):
+        return None
+    if type(restored) is not type(value) or restored != value:
+        return None
+    return literal
+
+
+def _get_event_recorder(events, name, handler):
+    '''Returns a wrapper of an event handler, which records its calls.'''
+    def record_event(*args, **keywords):
+        events.append((name, args, keywords))
+        handler(*args, **keywords)
+    return record_event
+
+
+def _init_loop_worker(renderer):
+    '''Initializes a forked process rendering iterations of parallel loops.'''
+    global _LOOP_WORKER_STATE
+    _LOOP_WORKER_STATE = renderer
+    # The pool belongs to the parent process
+    renderer._looppool = None
+
+
+def _render_loop_chunk(task):
+    '''Renders a chunk of iterations of a parallel loop.
+
+    Returns None, if rendering failed.
+    '''
+    try:
+        return _LOOP_WORKER_STATE._render_loop_task(*task)
+    except Exception:
+        return None
+
+
+def _is_immutable_for_workers(value):
+    '''Checks whether a value can not have been changed since the workers
+    of parallel loops were forked, provided it is still the same object.'''
+    if isinstance(value, _Macro):
+        return not value.localscope
+    if isinstance(value, types.FunctionType):
+        return value.__closure__ is None
+    return isinstance(value, (types.ModuleType, types.BuiltinFunctionType,
+                              type))
+
+
+def _get_code_names(code):
+    '''Returns the global names used by a code object and its nested code.'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_get_code_names(const))
+    return names
+
+
+def _get_materialized_arguments(args, keywords):
+    '''Returns the macro call arguments with lazy arguments rendered.'''
+    if any(type(arg) is _LazyArgument for arg in args):
+        args = tuple(arg.data if type(arg) is _LazyArgument else arg
+                     for arg in args)
+    if any(type(value) is _LazyArgument for value in keywords.values()):
+        keywords = {name: value.data if type(value) is _LazyArgument else value
+                    for name, value in keywords.items()}
+    return args, keywords
+
+
+def _get_macro_cache_key(args, keywords):
+    '''Returns hashable key for the given macro call arguments.
+
+    Raises TypeError, if any of the arguments is not hashable.
+    '''
+    key = (tuple(_get_typed_cache_key(arg) for arg in args),
+           frozenset((name, _get_typed_cache_key(value))
+                     for name, value in keywords.items()))
+    hash(key)
+    return key
+
+
+def _get_typed_cache_key(value):
+    # Lazy arguments would have to be rendered to obtain their hash
+    if type(value) is _LazyArgument:
+        raise TypeError('lazy argument can not be used as cache key')
+    # Include types to distinguish arguments comparing equal (e.g. 1 and 1.0)
+    if type(value) is tuple:
+        return (tuple, tuple(_get_typed_cache_key(item) for item in value))
+    return (type(value), value)
+
+
 def _blank_match(match):
     size = match.end() - match.start()
     return " " * size
@@ -3060,33 +7609,37 @@ def _blank_match(match):
 def _argsplit_fortran(argtxt):
     txt = _INLINE_EVAL_REGION_REGEXP.sub(_blank_match, argtxt)
     splitpos = [-1]
-    quote = None
     closing_brace_stack = []
     closing_brace = None
-    for ind, char in enumerate(txt):
-        if quote:
-            if char == quote:
-                quote = None
-            continue
-        if char in _QUOTES_FORTRAN:
-            quote = char
-            continue
-        if char in _OPENING_BRACKETS_FORTRAN:
+    # Jump from token to token, where tokens are complete quoted strings,
+    # unterminated quotes, brackets and (outside of brackets) separators.
+    tokenregexp = _ARGSPLIT_TOKEN_REGEXP
+    match = tokenregexp.search(txt)
+    while match is not None:
+        token = match.group()
+        pos = match.end()
+        if len(token) > 1:
+            pass
+        elif token == _ARGUMENT_SPLIT_CHAR_FORTRAN:
+            splitpos.append(pos - 1)
+        elif token in _OPENING_BRACKETS_FORTRAN:
             closing_brace_stack.append(closing_brace)
-            ind = _OPENING_BRACKETS_FORTRAN.index(char)
-            closing_brace = _CLOSING_BRACKETS_FORTRAN[ind]
-            continue
-        if char in _CLOSING_BRACKETS_FORTRAN:
-            if char == closing_brace:
-                closing_brace = closing_brace_stack.pop(-1)
-                continue
-            else:
-                msg = "unexpected closing delimiter '{0}' in expression '{1}' "\
-                      "at position {2}".format(char, argtxt, ind + 1)
-                raise FyppFatalError(msg)
-        if not closing_brace and char == _ARGUMENT_SPLIT_CHAR_FORTRAN:
-            splitpos.append(ind)
-    if quote or closing_brace:
+            closing_brace = _CLOSING_BRACKETS_FORTRAN[
+                _OPENING_BRACKETS_FORTRAN.index(token)]
+            tokenregexp = _ARGSPLIT_NESTED_TOKEN_REGEXP
+        elif token == closing_brace:
+            closing_brace = closing_brace_stack.pop(-1)
+            if closing_brace is None:
+                tokenregexp = _ARGSPLIT_TOKEN_REGEXP
+        elif token in _CLOSING_BRACKETS_FORTRAN:
+            msg = "unexpected closing delimiter '{0}' in expression '{1}' "\
+                  "at position {2}".format(token, argtxt, pos)
+            raise FyppFatalError(msg)
+        else:
+            # Unterminated quote
+            break
+        match = tokenregexp.search(txt, pos)
+    if match is not None or closing_brace:
         msg = "open quotes or brackets in expression '{0}'".format(argtxt)
         raise FyppFatalError(msg)
     splitpos.append(len(txt))
@@ -3116,5 +7669,85 @@ def _formatted_exception(exc):
     return ''.join(out)
 
 
+def _formatted_macro_cache_stats(stats):
+    out = ['Memoization statistics of pure macros:\n']
+    for name, fname, linenr, info in stats:
+        ncalls = info['hits'] + info['misses'] + info['uncached']
+        hitrate = 100.0 * info['hits'] / ncalls if ncalls else 0.0
+        out.append(
+            "{0}:{1}: macro '{2}': {3} calls, {4} hits, {5} misses, {6} "
+            "uncached, hit rate {7:.1f}%, {8}/{9} results cached\n".format(
+                fname, linenr + 1, name, ncalls, info['hits'], info['misses'],
+                info['uncached'], hitrate, info['currsize'], info['maxsize']))
+    return ''.join(out)
+
+
+def _formatted_memory_report(report):
+    out = ['Memory usage (retained / peak, relative to start of processing):\n']
+    for name, retained, peak in report['phases']:
+        out.append('{0:>8}: {1} / {2}\n'.format(
+            name, _formatted_size(retained), _formatted_size(peak)))
+    tree = report['tree']
+    out.append('Tree: {0} nodes, depth {1}, {2}\n'.format(
+        tree['nodes'], tree['depth'], _formatted_size(tree['size'])))
+    output = report['output']
+    out.append('Output buffer: {0} items, {1}, joined output {2}\n'.format(
+        output['items'], _formatted_size(output['size']),
+        _formatted_size(output['joined'])))
+    evals = report['evals']
+    out.append('Eval index lists: {0} entries, {1}\n'.format(
+        evals['entries'], _formatted_size(evals['size'])))
+    macros = report['macros']
+    out.append('Macros: {0} macros, {1} nodes, {2}\n'.format(
+        macros['macros'], macros['nodes'], _formatted_size(macros['size'])))
+    return ''.join(out)
+
+
+def _write_expansion_report(report, nsites, jsonfile):
+    if nsites is not None:
+        sys.stderr.write(_formatted_expansion_report(report, nsites))
+    if jsonfile is not None:
+        try:
+            with io.open(jsonfile, 'w', encoding='utf-8') as fp:
+                json.dump(report, fp, indent=2)
+                fp.write('\n')
+        except OSError as exc:
+            msg = "Failed to write expansion report '{0}'".format(jsonfile)
+            raise FyppFatalError(msg) from exc
+
+
+def _formatted_expansion_report(report, nsites):
+    total = report['total']
+    out = ['Output expansion ({0} characters, {1} lines before line '
+           'folding):\n'.format(total['chars'], total['lines'])]
+    sites = report['sites'][:nsites]
+    out.append('Top {0} of {1} source lines:\n'.format(
+        len(sites), len(report['sites'])))
+    for site in sites:
+        share = 100.0 * site['chars'] / total['chars'] if total['chars'] \
+            else 0.0
+        out.append('{0}:{1}: {2} characters ({3:.1f}%), {4} lines\n'.format(
+            site['file'], site['line'], site['chars'], share, site['lines']))
+    out.append('Files:\n')
+    for fileinfo in report['files']:
+        ratio = fileinfo['ratio']
+        out.append('{0}: {1} -> {2} characters (ratio {3}), {4} -> {5} '
+                   'lines\n'.format(
+                       fileinfo['file'], fileinfo['input_chars'],
+                       fileinfo['output_chars'],
+                       '?' if ratio is None else '{0:.1f}'.format(ratio),
+                       fileinfo['input_lines'], fileinfo['output_lines']))
+    return ''.join(out)
+
+
+def _formatted_size(nbytes):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(nbytes) < 1024:
+            return '{0:.1f} {1}'.format(nbytes, unit) if unit != 'B' \
+                else '{0} B'.format(nbytes)
+        nbytes /= 1024.0
+    return '{0:.1f} GiB'.format(nbytes)
+
+
 if __name__ == '__main__':
     run_fypp()
@@ -0,0 +1 @@
+{'A': 12, 'B': 'text', 'C': (1, 2.5), 'D': None}
@@ -1,6 +1,15 @@
 '''Unit tests for testing Fypp.'''
 from pathlib import Path
+import os
+import asyncio
 import platform
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
 import unittest
 import fypp
 
@@ -409,6 +418,191 @@ SIMPLE_TESTS = [
       '|12[]|\n'
      )
     ),
+    ('pure_macro',
+     ([],
+      '#:def macro(x, y=2) pure\n|${x}$${y}$|\n#:enddef\n'\
+      '$:macro(1)\n@:macro(1, 3)\n$:macro(1)\n',
+      '|12|\n|13|\n|12|\n'
+     )
+    ),
+    ('pure_macro_memoized',
+     ([],
+      '#:set cnt = 0\n#:def macro(x) pure\n#:global cnt\n'\
+      '#:set cnt = cnt + 1\n${x}$\n#:enddef\n'\
+      '${macro(1)}$${macro(1)}$${macro(1.0)}$${macro(2)}$ ${cnt}$\n',
+      '111.02 3\n'
+     )
+    ),
+    ('pure_macro_unhashable_args',
+     ([],
+      '#:set cnt = 0\n#:def macro(x) pure\n#:global cnt\n'\
+      '#:set cnt = cnt + 1\n${x}$\n#:enddef\n'\
+      '${macro([1])}$${macro([1])}$ ${cnt}$\n',
+      '[1][1] 2\n'
+     )
+    ),
+    ('pure_macro_no_memoization',
+     (['--macro-cache-size=0'],
+      '#:set cnt = 0\n#:def macro(x) pure\n#:global cnt\n'\
+      '#:set cnt = cnt + 1\n${x}$\n#:enddef\n'\
+      '${macro(1)}$${macro(1)}$ ${cnt}$\n',
+      '11 2\n'
+     )
+    ),
+    ('pure_macro_lru_bound',
+     (['--macro-cache-size=1'],
+      '#:set cnt = 0\n#:def macro(x) pure\n#:global cnt\n'\
+      '#:set cnt = cnt + 1\n${x}$\n#:enddef\n'\
+      '${macro(1)}$${macro(2)}$${macro(2)}$${macro(1)}$ ${cnt}$\n',
+      '1221 3\n'
+     )
+    ),
+    ('parallel_loop',
+     (['--loop-workers=2'],
+      '#:def macro(x)\n|${x}$|\n#:enddef\n'\
+      '#:for parallel i, j in [(1, 2), (3, 4), (5, 6)]\n'\
+      '#:for k in range(j - i + 1)\n@:macro(${i}$${k}$)\n#:endfor\n'\
+      '#:endfor\n${i}$\n',
+      '|10|\n|11|\n|30|\n|31|\n|50|\n|51|\n5\n'
+     )
+    ),
+    ('parallel_loop_setting_variable',
+     (['--loop-workers=2'],
+      '#:set cnt = 0\n#:for parallel i in range(4)\n#:set cnt = cnt + i\n'\
+      '#:endfor\n${cnt}$\n',
+      '6\n'
+     )
+    ),
+    ('parallel_loop_macro_with_global',
+     (['--loop-workers=2'],
+      '#:set cnt = 0\n#:def macro(x)\n#:global cnt\n#:set cnt = cnt + x\n'\
+      '#:enddef\n#:for parallel i in range(4)\n$:macro(i)\n'\
+      '#:endfor\n${cnt}$\n',
+      '\n\n\n\n6\n'
+     )
+    ),
+    ('parallel_loop_variable_name',
+     (['--loop-workers=2'],
+      '#:set parallel = [1, 2]\n#:for i in parallel\n${i}$\n#:endfor\n',
+      '1\n2\n'
+     )
+    ),
+    ('parallel_loop_variable_name_in_expression',
+     (['--loop-workers=2'],
+      '#:set parallel = [2, 3]\n#:for i in [1] + parallel\n${i}$\n#:endfor\n'\
+      '#:for parallel in [4]\n${parallel}$\n#:endfor\n',
+      '1\n2\n3\n4\n'
+     )
+    ),
+    ('parallel_loop_changed_variables',
+     (['--loop-workers=2'],
+      '#:set lst = [1]\n#:set f = lambda x: x + y\n#:set y = 10\n'\
+      '#:for parallel i in range(2)\n${lst}$ ${f(i)}$\n#:endfor\n'\
+      '$:lst.append(2)\n#:set y = 20\n#:for j in range(2)\n'\
+      '#:for parallel i in range(2)\n${lst}$ ${f(i)}$ ${j}$\n#:endfor\n'\
+      '#:endfor\n',
+      '[1] 10\n[1] 11\n\n[1, 2] 20 0\n[1, 2] 21 0\n[1, 2] 20 1\n'\
+      '[1, 2] 21 1\n'
+     )
+    ),
+    ('parallel_loop_redefined_macro',
+     (['--loop-workers=2'],
+      '#:def m(a)\n#:set loc = 2 * a\n#:for parallel i in range(2)\n'\
+      '${loc + i}$\n#:endfor\n#:enddef\n$:m(1)\n$:m(5)\n'\
+      '#:def m(x)\n<${x}$>\n#:enddef\n#:for parallel i in range(2)\n'\
+      '@:m(${i}$)\n#:endfor\n',
+      '2\n3\n10\n11\n<0>\n<1>\n'
+     )
+    ),
+    ('lazy_macro_unused_argument',
+     ([],
+      '#:set cnt = 0\n#:def macro(x, y) lazy\n${x}$\n#:enddef\n'\
+      '#:call macro\nA\n#:nextarg\n#:global cnt\n#:set cnt = cnt + 1\nB\n'\
+      '#:endcall\n${cnt}$\n',
+      'A\n0\n'
+     )
+    ),
+    ('lazy_macro_rendered_once',
+     ([],
+      '#:set cnt = 0\n#:def macro(x) lazy\n${x}$${x.lower()}$\n#:enddef\n'\
+      '#:call macro\n#:global cnt\n#:set cnt = cnt + 1\nA\n'\
+      '#:endcall\n${cnt}$\n',
+      'Aa\n1\n'
+     )
+    ),
+    ('lazy_macro_caller_scope',
+     ([],
+      '#:def macro(x) pure lazy\n#:set i = 9\n${i}$${x + "|"}$\n#:enddef\n'\
+      '#:for i in range(2)\n#:call macro\n${i}$\n#:endcall\n#:endfor\n',
+      '90|\n91|\n'
+     )
+    ),
+    ('lazy_arguments',
+     (['--lazy-arguments'],
+      '#:def macro(x)\n${"".join([x, "!"])}$\n#:enddef\n'\
+      '#:call macro\nA\n#:endcall\n',
+      'A!\n'
+     )
+    ),
+    ('lazy_macro_forwarding_argument',
+     ([],
+      '#:def inner(x)\n${"".join([x, "!"])}$\n#:enddef\n'\
+      '#:def outer(x) lazy\n$:inner(x)\n#:enddef\n'\
+      '#:call outer\nA\n#:endcall\n',
+      'A!\n'
+     )
+    ),
+    ('pure_lazy_macro_unused_argument',
+     ([],
+      '#:set cnt = 0\n#:def macro(x, y) pure lazy\n${x}$\n#:enddef\n'\
+      '#:call macro\nA\n#:nextarg\n#:global cnt\n#:set cnt = cnt + 1\nB\n'\
+      '#:endcall\n${cnt}$\n',
+      'A\n0\n'
+     )
+    ),
+    ('lazy_arguments_python_callable',
+     (['--lazy-arguments'],
+      '#:set func = lambda x: "".join([x, "!"])\n'\
+      '#:call func\nA\n#:endcall\n',
+      'A!\n'
+     )
+    ),
+    ('specialize_if',
+     ([_defvar('DEBUG', 0), _defvar('KIND', '"dp"'), '--specialize'],
+      '#:if DEBUG > 0\nA\n#:elif KIND == "sp"\nB\n#:else\n${KIND}$\n#:endif\n',
+      'dp\n'
+     )
+    ),
+    ('specialize_unknown_condition',
+     ([_defvar('DEBUG', 0), '--specialize'],
+      '#:set X = 1\n#:if DEBUG\nA\n#:elif X > 0\nB\n#:else\nC\n#:endif\n',
+      'B\n'
+     )
+    ),
+    ('specialize_assigned_variable',
+     ([_defvar('X', 1), '--specialize'],
+      '${X}$\n#:set X = 2\n${X}$\n',
+      '1\n2\n'
+     )
+    ),
+    ('specialize_setvar',
+     ([_defvar('X', 1), '--specialize'],
+      '$:setvar("X", 2)\n#:if X == 1\nA\n#:else\nB\n#:endif\n',
+      '\nB\n'
+     )
+    ),
+    ('specialize_macro_argument',
+     ([_defvar('X', 1), '--specialize'],
+      '#:def macro(X)\n${X}$\n#:enddef\n${X}$ @{macro(2)}@\n',
+      '1 2\n'
+     )
+    ),
+    ('specialize_mutable_value',
+     ([_defvar('X', '[1]'), '--specialize'],
+      '$:X.append(2) or ""\n${len(X)}$\n',
+      '\n2\n'
+     )
+    ),
     ('macro_vararg_named_arguments_call',
      ([],
       '#:def macro(x, y, *vararg)\n|${x}$${y}$${vararg}$|\n#:enddef\n'\
@@ -992,6 +1186,13 @@ SIMPLE_TESTS = [
       '|\'L1, L2\'|L3|',
      )
     ),
+    ('direct_call_2_args_array_constructor',
+     ([],
+      '#:def mymacro(val1, val2)\n|${val1}$|${val2}$|\n#:enddef\n'\
+      '@:mymacro([1, (2, ")"), 3], \'L2, ]\')\n',
+      '|[1, (2, ")"), 3]|\'L2, ]\'|\n',
+     )
+    ),
     ('direct_call_2_args_escape7',
      ([],
       '#:def mymacro(val1, val2)\n|${val1}$|${val2}$|\n#:enddef\n'\
@@ -1347,6 +1548,26 @@ SIMPLE_TESTS = [
       'A\nVAR=2\n'
      )
     ),
+    ('cache',
+     ([],
+      '#:set cnt = 0\n#:for i in range(3)\n#:cache i % 2\n'\
+      '#:set cnt = cnt + 1\n${i}$\n#:endcache\n#:endfor\n${cnt}$\n',
+      '0\n1\n0\n2\n'
+     )
+    ),
+    ('cache_in_macro',
+     ([],
+      '#:def macro(x)\n#:cache x\n|${x}$|\n#:endcache\n#:enddef\n'\
+      '$:macro(1)\n$:macro(2)\n$:macro(1)\n',
+      '|1|\n|2|\n|1|\n'
+     )
+    ),
+    ('output',
+     ([],
+      'A\n#:output "a.f90"\n#:set X = 2\nB\n#:endoutput\nX=${X}$\n',
+      'A\nX=2\n'
+     )
+    ),
     ('builtin_var_line',
      ([],
       '${_LINE_}$',
@@ -1438,6 +1659,12 @@ SIMPLE_TESTS = [
       ' ! Should be not folded\nShould be&\n  & folded\n'
      )
     ),
+    ('repeated_folded_lines',
+     ([_linelen(15)],
+      '#:for i in range(2)\n${"a" * 20}$\n  ! ${"b" * 20}$\n#:endfor\n',
+      ('aaaaaaaaaaaaaa&\n    &aaaaaa\n  ! bbbbbbbbbbbbbbbbbbbb\n') * 2
+     )
+    ),
     ('no_folding',
      ([_linelen(15), _indentation(4), _NO_FOLDING_FLAG],
       '  ${3}$456 89 123456 8',
@@ -1830,6 +2057,25 @@ SIMPLE_TESTS = [
        '12 str'
      )
     ),
+    ('defines_file_json',
+     (['--defines-file', 'input/defines.json'],
+      '${A + 1}$ ${B}$ ${C}$ ${D}$',
+      '13 text [1, 2.5] '
+     )
+    ),
+    ('defines_file_literal',
+     (['--defines-file', 'input/defines.py'],
+      '${A + 1}$ ${B}$ ${C}$ ${D}$',
+      '13 text (1, 2.5) '
+     )
+    ),
+    # Check, whether command line definitions override the ones in the file
+    ('defines_file_override',
+     (['--defines-file', 'input/defines.json', _defvar("A", "2")],
+      '${A}$ ${B}$',
+      '2 text'
+     )
+    ),
 ]
 
 
@@ -2113,6 +2359,31 @@ LINENUM_TESTS = [
       _linenum(0) + 'A\n' + _linenum(5) + 'VAR=2\n'
      )
     ),
+    ('parallel_loop',
+     ([_LINENUM_FLAG, '--loop-workers=2'],
+      '#:for parallel i in range(2)\n${i}$\n#:endfor\n',
+      _linenum(0) + _linenum(1) + '0\n' + _linenum(1) + '1\n' + _linenum(3)
+     )
+    ),
+    ('cache',
+     ([_LINENUM_FLAG],
+      '#:for i in range(2)\n#:cache 0\n${i}$\n#:endcache\n#:endfor\n',
+      _linenum(0) + _linenum(1) + _linenum(2) + '0\n' + _linenum(4)
+      + _linenum(1) + _linenum(2) + '0\n' + _linenum(4) + _linenum(5)
+     )
+    ),
+    ('output',
+     ([_LINENUM_FLAG],
+      'A\n#:output "a.f90"\nB\n#:endoutput\nC\n',
+      _linenum(0) + 'A\n' + _linenum(4) + 'C\n'
+     )
+    ),
+    ('specialize_if',
+     ([_LINENUM_FLAG, _defvar('X', 2), '--specialize'],
+      '#:if X == 1\nA\n#:elif X == 2\nB\n#:else\nC\n#:endif\nD\n',
+      _linenum(0) + _linenum(3) + 'B\n' + _linenum(7) + 'D\n'
+     )
+    ),
     ('direct_call',
      ([_LINENUM_FLAG],
       '#:def mymacro(val)\n|${val}$|\n#:enddef\n'\
@@ -2147,6 +2418,18 @@ LINENUM_TESTS = [
       + '      & 123456&\n' + _linenum(0) + '      & 8\n' + 'Done\n'
      )
     ),
+    ('minimal_nested_if',
+     ([_LINENUM_FLAG, _linenumbering('minimal')],
+      '#:if True\n#:if True\nA\n#:endif\n#:endif\nB\n',
+      _linenum(2) + 'A\n' + _linenum(5) + 'B\n'
+     )
+    ),
+    ('minimal_set',
+     ([_LINENUM_FLAG, _linenumbering('minimal')],
+      '#:set X = 1\nA\n${X}$\n',
+      _linenum(1) + 'A\n1\n'
+     )
+    ),
     ('smart_folding_nocontlines',
      ([_LINENUM_FLAG, _linenumbering('nocontlines'), _linelen(15),
        _indentation(4), _folding('smart')],
@@ -2233,6 +2516,31 @@ INCLUDE_TESTS = [
       _linenum(0) + 'START\n' + _linenum(4) + 'DONE\n'
      )
     ),
+    ('preload',
+     (['--preload', 'include/fypp1.inc'],
+      'START\n@:incmacro(1)\nDONE\n',
+      'START\nINCMACRO(1)\nDONE\n'
+     )
+    ),
+    ('preload_skipped_include',
+     (['--preload', 'include/fypp1.inc', _incdir('include')],
+      '#:include "fypp1.inc"\n@:incmacro(1)\n',
+      'INCMACRO(1)\n'
+     )
+    ),
+    ('preload_skipped_nested_include',
+     (['--preload', 'include/subfolder/include_fypp1.inc', _incdir('include')],
+      '#:include "fypp1.inc"\n@:incmacro(1)\n',
+      'INCMACRO(1)\n'
+     )
+    ),
+    ('preload_skipped_include_linenum',
+     ([_LINENUM_FLAG, '--preload', 'include/fypp1.inc', _incdir('include')],
+      '#:include "fypp1.inc"\nDONE\n',
+      _linenum(0) + _linenum(0, 'include/fypp1.inc', 1) + _linenum(1, flag=2)
+      + 'DONE\n'
+     )
+    ),
 ]
 
 
@@ -2272,6 +2580,41 @@ INPUT_FILE_TESTS = [
          'THIS_FILE: input/filevarroot.inc:3\n'
         )
     ),
+    ('mmapped_input',
+        (['--mmap-threshold=1'],
+         'input/mmapped.fypp',
+         'program test\n'
+         '  integer :: ival(2) = [1, 2]\n'
+         '  character(*), parameter :: txt = "ÄÖÜ ${escaped}$"\n'
+         '  ! Included text without directives\n'
+         '  ! ÄÖÜ\n'
+         '! N = 2\n'
+         '  print *, 1\n'
+         '  print *, 2\n'
+         '  print *, 3\n'
+         'end program test\n'
+        )
+    ),
+    ('mmapped_input_linenum',
+        ([_LINENUM_FLAG, '--mmap-threshold=1'],
+         'input/mmapped.fypp',
+         _linenum(0, 'input/mmapped.fypp')
+         + _linenum(2, 'input/mmapped.fypp') + 'program test\n'
+         + _linenum(4, 'input/mmapped.fypp')
+         + _linenum(6, 'input/mmapped.fypp')
+         + '  integer :: ival(2) = [1, 2]\n'
+         + '  character(*), parameter :: txt = "ÄÖÜ ${escaped}$"\n'
+         + _linenum(0, 'input/mmapped.inc', _NEW_FILE)
+         + '  ! Included text without directives\n'
+         + '  ! ÄÖÜ\n'
+         + '! N = 2\n'
+         + _linenum(9, 'input/mmapped.fypp', _RETURN_TO_FILE)
+         + _linenum(10, 'input/mmapped.fypp') + '  print *, 1\n'
+         + _linenum(10, 'input/mmapped.fypp') + '  print *, 2\n'
+         + _linenum(10, 'input/mmapped.fypp') + '  print *, 3\n'
+         + _linenum(12, 'input/mmapped.fypp') + 'end program test\n'
+        )
+    ),
 ]
 
 
@@ -2296,6 +2639,12 @@ EXCEPTION_TESTS = [
       [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
      )
     ),
+    ('invalid_macrodef_attribute',
+     ([],
+      '#:def alma(x) impure\n#:enddef\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
+     )
+    ),
     ('invalid_for_decl',
      ([],
       '#:for i = 1, 2\n',
@@ -2368,6 +2717,60 @@ EXCEPTION_TESTS = [
       [(fypp.FyppFatalError, fypp.STRING, (1, 1))]
      )
     ),
+    ('missing_cache_key',
+     ([],
+      '#:cache\n#:endcache\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
+     )
+    ),
+    ('invalid_endcache',
+     ([],
+      '#:cache 1\n#:endcache INVALID\n',
+      [(fypp.FyppFatalError, fypp.STRING, (1, 2))]
+     )
+    ),
+    ('inline_cache',
+     ([],
+      '#{cache 1}#test#{endcache}#\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 0))]
+     )
+    ),
+    ('invalid_cache_key',
+     ([],
+      '#:cache 1 +\n#:endcache\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
+     )
+    ),
+    ('parallel_loop_error',
+     (['--loop-workers=2'],
+      '#:for parallel i in range(4)\n${1 // (i - 2)}$\n#:endfor\n',
+      [(fypp.FyppFatalError, fypp.STRING, (1, 1))]
+     )
+    ),
+    ('missing_output_path',
+     ([],
+      '#:output\n#:endoutput\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
+     )
+    ),
+    ('inline_output',
+     ([],
+      '#{output "a.f90"}#test#{endoutput}#\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 0))]
+     )
+    ),
+    ('non_string_output_path',
+     ([],
+      '#:output 1\n#:endoutput\n',
+      [(fypp.FyppFatalError, fypp.STRING, (0, 1))]
+     )
+    ),
+    ('specialize_failing_expression',
+     ([_defvar('X', 0), '--specialize'],
+      'A\n#:if X == 0\n${1 // X}$\n#:endif\n',
+      [(fypp.FyppFatalError, fypp.STRING, (2, 2))]
+     )
+    ),
     ('setvar_with_equal',
      ([],
       '#:setvar x = 2\n$: x\n',
@@ -2675,6 +3078,18 @@ EXCEPTION_TESTS = [
       [(fypp.FyppFatalError, fypp.STRING, (2, 3))]
      )
     ),
+    ('mismatching_endcache',
+     ([],
+      '#:cache 1\n#:mute\n#:endcache\n',
+      [(fypp.FyppFatalError, fypp.STRING, (2, 3))]
+     )
+    ),
+    ('mismatching_endoutput',
+     ([],
+      '#:output "a.f90"\n#:mute\n#:endoutput\n',
+      [(fypp.FyppFatalError, fypp.STRING, (2, 3))]
+     )
+    ),
     ('unclosed_directive',
      ([],
       '#:if 1 > 2\nA\n',
@@ -3015,6 +3430,24 @@ EXCEPTION_TESTS = [
        (fypp.FyppFatalError, None, None)]
      )
     ),
+    ('defines_file_not_a_table',
+     (['--defines-file', 'input/invalid_defines.json'],
+      '',
+      [(fypp.FyppFatalError, None, None)]
+     )
+    ),
+    ('defines_file_invalid_name',
+     (['--defines-file', 'input/invalid_defines_name.json'],
+      '',
+      [(fypp.FyppFatalError, None, None)]
+     )
+    ),
+    ('defines_file_missing',
+     (['--defines-file', 'input/nonexisting.json'],
+      '',
+      [(fypp.FyppFatalError, None, None)]
+     )
+    ),
 ]
 
 
@@ -3200,5 +3633,1136 @@ class ImportTest(_TestContainer): pass
 ImportTest.add_test_methods(IMPORT_TESTS, _get_test_output_method)
 
 
+class _TupleBuilder(fypp.Builder):
+    '''Builder returning the tree with all nodes converted into tuples.'''
+
+    @property
+    def tree(self):
+        return self._as_tuples(super().tree)
+
+    def _as_tuples(self, item):
+        if isinstance(item, fypp._Node):
+            return tuple(self._as_tuples(field) for field in item)
+        if isinstance(item, list):
+            return [self._as_tuples(elem) for elem in item]
+        return item
+
+
+class TupleTreeTest(unittest.TestCase):
+    '''Tests the rendering of trees made of tuple nodes.'''
+
+    def test_tuple_nodes(self):
+        '''Tests that all nodes are rendered if given as tuples.'''
+        txt = 'A\n#:if X > 0\n${X}$\n#:endif\n'\
+              '#:for i in range(2)\nB${i}$\n#:endfor\n'
+        expected = fypp.Fypp().process_text('#:set X = 1\n' + txt)
+        tool = fypp.Fypp(builder_factory=_TupleBuilder)
+        self.assertEqual(expected, tool.process_text('#:set X = 1\n' + txt))
+
+
+class _PlainDefBuilder(fypp.Builder):
+    '''Builder overriding handle_def() with the signature of earlier versions.'''
+
+    def handle_def(self, span, name, argexpr):
+        super().handle_def(span, name, argexpr)
+
+
+class CustomBuilderTest(unittest.TestCase):
+    '''Tests builders written for earlier versions.'''
+
+    def test_plain_def(self):
+        '''Tests that macros without attributes are passed to old builders.'''
+        tool = fypp.Fypp(builder_factory=_PlainDefBuilder)
+        self.assertEqual('|1|\n', tool.process_text(
+            '#:def m(x)\n|${x}$|\n#:enddef\n@:m(1)\n'))
+
+
+class _TempDirMixin:
+    '''Provides a temporary directory for the files of each test.'''
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._root = self._tmpdir.name
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _path(self, fname):
+        return os.path.join(self._root, fname)
+
+    def _write(self, fname, txt):
+        with open(self._path(fname), 'w') as fp:
+            fp.write(txt)
+
+
+class OutputCacheTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the content addressed output cache.'''
+
+    def setUp(self):
+        super().setUp()
+        self._cachedir = self._path('cache')
+        os.mkdir(self._path('inc'))
+        self._write('main.fypp',
+                    '#:include "defs.inc"\n${X}$${getvar("Y", "")}$\n')
+        self._write('inc/defs.inc', '#:set X = 1\n')
+
+    def _process(self, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['--cache-dir', self._cachedir,
+             _incdir(self._path('inc'))] + list(args))
+        return fypp.Fypp(options).process_file(self._path('main.fypp'))
+
+    def _tamper_objects(self):
+        objdir = os.path.join(self._cachedir, 'objects')
+        for fname in os.listdir(objdir):
+            with open(os.path.join(objdir, fname), 'w') as fp:
+                fp.write('cached\n')
+
+    def test_hit(self):
+        '''Tests that unchanged input is served from the cache.'''
+        self.assertEqual('1\n', self._process())
+        self._tamper_objects()
+        self.assertEqual('cached\n', self._process())
+
+    def test_changed_define(self):
+        '''Tests that a changed definition invalidates the entry.'''
+        self.assertEqual('1\n', self._process())
+        self._tamper_objects()
+        self.assertEqual('12\n', self._process(_defvar('Y', 2)))
+
+    def test_changed_include(self):
+        '''Tests that a changed include file invalidates the entry.'''
+        self.assertEqual('1\n', self._process())
+        self._tamper_objects()
+        self._write('inc/defs.inc', '#:set X = 3\n')
+        self.assertEqual('3\n', self._process())
+
+    def test_shadowing_include(self):
+        '''Tests that an include file appearing earlier in the search path
+        invalidates the entry.'''
+        self.assertEqual('1\n', self._process())
+        self._tamper_objects()
+        self._write('defs.inc', '#:set X = 4\n')
+        self.assertEqual('4\n', self._process())
+
+    def test_timestamp(self):
+        '''Tests that inputs reading the date or time are not stored.'''
+        self._write('main.fypp', '${_TIME_ > ""}$\n')
+        self.assertEqual('True\n', self._process())
+        self.assertFalse(os.path.exists(os.path.join(self._cachedir,
+                                                     'objects')))
+
+    def test_changed_submodule(self):
+        '''Tests that a changed submodule of an imported package invalidates
+        the entry.'''
+        os.makedirs(self._path('mods/cachetestpkg'))
+        self._write('mods/cachetestpkg/__init__.py',
+                    'from . import sub\n')
+        self._write('mods/cachetestpkg/sub.py', 'X = 1\n')
+        args = [_moddir(self._path('mods')), _importmodule('cachetestpkg')]
+        self.assertEqual('1\n', self._process(*args))
+        self._tamper_objects()
+        self._write('mods/cachetestpkg/sub.py', 'X = 2\n')
+        self.assertEqual('1\n', self._process(*args))
+
+
+class BlockCacheTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the storage of cache blocks in the block cache directory.'''
+
+    def _process(self, txt, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['--block-cache-dir', self._path('cache')] + list(args))
+        return fypp.Fypp(options).process_text(txt)
+
+    def _tamper_blocks(self):
+        cachedir = self._path('cache')
+        for fname in os.listdir(cachedir):
+            with open(os.path.join(cachedir, fname)) as fp:
+                data = json.load(fp)
+            data['out'] = [txt.replace('1', 'X') for txt in data['out']]
+            with open(os.path.join(cachedir, fname), 'w') as fp:
+                json.dump(data, fp)
+
+    def test_hit(self):
+        '''Tests that blocks reading unchanged variables are reused.'''
+        txt = '#:cache (R,)\n#:for r in R\n${r}$\n#:endfor\n#:endcache\n'
+        self.assertEqual('1\n2\n', self._process(txt, _defvar('R', '(1, 2)')))
+        self._tamper_blocks()
+        self.assertEqual('X\n2\n', self._process(txt, _defvar('R', '(1, 2)')))
+
+    def test_changed_variable(self):
+        '''Tests that a variable missing from the key invalidates the block.'''
+        txt = '#:cache 1\n${A}$\n#:endcache\n'
+        self.assertEqual('1\n', self._process(txt, _defvar('A', 1)))
+        self.assertEqual('2\n', self._process(txt, _defvar('A', 2)))
+
+    def test_changed_macro(self):
+        '''Tests that a changed macro called by the block invalidates it.'''
+        txt = '#:def m()\n{0}\n#:enddef\n#:cache 1\n$:m()\n#:endcache\n'
+        self.assertEqual('X\n', self._process(txt.format('X')))
+        self.assertEqual('Y\n', self._process(txt.format('Y')))
+
+    def test_unstored_block(self):
+        '''Tests that blocks reading values without literal form are not
+        stored.'''
+        self._process('#:cache 1\n${os.sep}$\n#:endcache\n',
+                      _importmodule('os'))
+        self.assertFalse(os.path.exists(self._path('cache')))
+
+    def test_non_literal_key(self):
+        '''Tests that keys without literal representation are rejected.'''
+        with self.assertRaises(fypp.FyppFatalError):
+            self._process('#:cache object()\nA\n#:endcache\n')
+
+
+_CPP_LINE_MARKER_REGEXP = re.compile(r'^# (\d+) "(.*)"(?: \d)?$')
+
+def _get_marker_attribution(output):
+    '''Returns the output lines and their origin according to the line
+    markers in the output.'''
+    attribution = []
+    origin = None
+    for line in output.split('\n')[:-1]:
+        match = _CPP_LINE_MARKER_REGEXP.match(line)
+        if match:
+            origin = (match.group(2), int(match.group(1)))
+            continue
+        attribution.append((line, origin))
+        origin = (origin[0], origin[1] + 1) if origin is not None else None
+    return attribution
+
+
+class MinimalLineMarkerTest(unittest.TestCase):
+    '''Tests the minimal line numbering mode.'''
+
+    def test_attribution(self):
+        '''Tests that minimal markers attribute the lines as full ones do.'''
+        for name, (args, inp, _) in LINENUM_TESTS:
+            if _linenum_std() in args or any(arg.startswith('-N') for arg in args):
+                continue
+            with self.subTest(name=name):
+                optparser = fypp.get_option_parser()
+                options, _ = optparser.parse_args(args)
+                full = fypp.Fypp(options).process_text(inp)
+                options, _ = optparser.parse_args(
+                    args + [_linenumbering('minimal')])
+                minimal = fypp.Fypp(options).process_text(inp)
+                self.assertEqual(_get_marker_attribution(full),
+                                 _get_marker_attribution(minimal))
+                self.assertLessEqual(len(minimal.split('\n')),
+                                     len(full.split('\n')))
+
+
+class SourceMapTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the creation of source maps.'''
+
+    def test_attribution(self):
+        '''Tests that source maps attribute the lines as line markers do.'''
+        for name, (args, inp, _) in LINENUM_TESTS:
+            if _linenum_std() in args:
+                continue
+            with self.subTest(name=name):
+                optparser = fypp.get_option_parser()
+                options, _ = optparser.parse_args(args)
+                expected = _get_marker_attribution(
+                    fypp.Fypp(options).process_text(inp))
+                options, _ = optparser.parse_args(args + ['--source-map=json'])
+                tool = fypp.Fypp(options)
+                output = tool.process_text(inp)
+                sourcemap = tool.get_source_map()
+                result = [(line, sourcemap.lookup(iline + 1))
+                          for iline, line in enumerate(output.split('\n')[:-1])]
+                self.assertEqual(expected, result)
+
+    def test_encoding(self):
+        '''Tests that source maps are restored from their encoded forms.'''
+        sourcemap = fypp.SourceMap(['a.fypp', 'b.inc'],
+                                   [(1, 0, 1), (3, 1, 1), (7, 0, 3), (300, 1, 200),
+                                    (301, 0, 4)], 'a.f90')
+        for fmt in ('json', 'binary'):
+            restored = fypp.SourceMap.loads(sourcemap.dumps(fmt))
+            self.assertEqual(sourcemap.sources, restored.sources)
+            self.assertEqual(sourcemap.segments, restored.segments)
+            self.assertEqual(sourcemap.outfile, restored.outfile)
+        self.assertEqual(('b.inc', 3), sourcemap.lookup(5))
+        self.assertEqual(('a.fypp', 13), sourcemap.lookup(17))
+
+    def test_sidecar_file(self):
+        '''Tests that the source map is written next to the output.'''
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(['--source-map=binary'])
+        outfile = self._path('out.f90')
+        fypp.Fypp(options).process_file('input/filevarroot.fypp', outfile)
+        sourcemap = fypp.SourceMap.read(outfile + '.map')
+        with open(outfile) as fp:
+            self.assertFalse('\x00' in fp.read())
+        self.assertEqual(outfile, sourcemap.outfile)
+        self.assertEqual(('input/filevarroot.fypp', 1), sourcemap.lookup(1))
+
+
+class DefinesFileTest(unittest.TestCase):
+    '''Tests the reading of definition files.'''
+
+    @unittest.skipIf(sys.version_info < (3, 11),
+                     'TOML files need Python 3.11 or newer')
+    def test_toml(self):
+        '''Tests that the variables are defined from a TOML file.'''
+        test_output = _get_test_output_method(
+            ['--defines-file', 'input/defines.toml'],
+            '${A + 1}$ ${B}$ ${C}$', '13 text [1, 2.5]')
+        test_output(self)
+
+
+class OptionsFileTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the reading of options files.'''
+
+    def test_update_from_file(self):
+        '''Tests that the options are set from the file.'''
+        options = fypp.FyppOptions()
+        options.update_from_file('input/options.json')
+        self.assertEqual(['A=1'], options.defines)
+        self.assertEqual(40, options.line_length)
+        self.assertTrue(options.no_folding)
+
+    def test_invalid_options(self):
+        '''Tests that unknown options and values of wrong type are rejected.'''
+        for content in ('{"unknown": 1}', '{"line_length": "40"}',
+                        '{"defines": "A=1"}', '{"no_folding": 1}',
+                        '{"line length": 40}', '{"x,y": 1}'):
+            self._write('options.json', content)
+            options = fypp.FyppOptions()
+            with self.assertRaises(fypp.FyppFatalError):
+                options.update_from_file(self._path('options.json'))
+
+
+class OutputDirectiveTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the files written by output directives.'''
+
+    def setUp(self):
+        super().setUp()
+        self._write('main.fypp', '#:for name in ["a", "b", "a"]\n'
+                    '#:output "mods/" + name + ".f90"\n${name}$\n'
+                    '#:endoutput\n#:endfor\nmain\n')
+
+    def _outpath(self, fname):
+        return self._path(os.path.join('out', fname))
+
+    def _process(self):
+        options = fypp.FyppOptions()
+        options.create_parent_folder = True
+        tool = fypp.Fypp(options)
+        tool.process_file(self._path('main.fypp'), self._outpath('main.f90'))
+        return tool
+
+    def test_files(self):
+        '''Tests that content is written relative to the output file.'''
+        tool = self._process()
+        expected = {'mods/a.f90': 'a\na\n', 'mods/b.f90': 'b\n'}
+        self.assertEqual(expected, tool.get_output_files())
+        for fname in ('main.f90', 'mods/a.f90', 'mods/b.f90'):
+            with open(self._outpath(fname)) as fp:
+                output = fp.read()
+            self.assertEqual(expected.get(fname, 'main\n'), output)
+
+    def test_unchanged_file(self):
+        '''Tests that files with unchanged content are not written again.'''
+        self._process()
+        os.utime(self._outpath('mods/b.f90'), ns=(0, 0))
+        self._process()
+        self.assertEqual(0, os.stat(self._outpath('mods/b.f90')).st_mtime_ns)
+
+    def test_text_input(self):
+        '''Tests that no files are written when processing a string.'''
+        tool = fypp.Fypp()
+        output = tool.process_text(
+            '#:output "a.f90"\nA\n#:endoutput\nB\n')
+        self.assertEqual('B\n', output)
+        self.assertEqual({'a.f90': 'A\n'}, tool.get_output_files())
+
+
+class ThreadedBatchTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the concurrent processing of files in a thread pool.'''
+
+    _NR_FILES = 64
+
+    def setUp(self):
+        super().setUp()
+        self._write('lib.fypp', '#:def wrap(x) pure\n|${x}$|\n#:enddef\n')
+        self._write('common.inc', '#:include "lib.fypp"\n'
+                    '#:def repeat(txt, n)\n#:for i in range(n)\n$:txt\n'
+                    '#:endfor\n#:enddef\n')
+        self._filepairs = []
+        for ifile in range(self._NR_FILES):
+            self._write('in{0}.fypp'.format(ifile),
+                        '#:include "common.inc"\n#:set ID = {0}\n'
+                        '#:call repeat(n=ID % 5 + 1)\n@:wrap(${{ID}}$)\n'
+                        '#:endcall\n${{VAL + ID}}$\n'.format(ifile))
+            self._filepairs.append(
+                (self._path('in{0}.fypp'.format(ifile)),
+                 self._path('out/out{0}.f90'.format(ifile))))
+
+    def _get_tool(self, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['-DVAL=100', '--create-parents'] + list(args))
+        return fypp.Fypp(options)
+
+    def _check_outputs(self):
+        for ifile, (_, outfile) in enumerate(self._filepairs):
+            with open(outfile) as fp:
+                output = fp.read()
+            expected = '|{0}|\n'.format(ifile) * (ifile % 5 + 1)\
+                + '{0}\n'.format(100 + ifile)
+            self.assertEqual(expected, output)
+
+    def test_outputs(self):
+        '''Tests that concurrently processed files are not mixed up.'''
+        errors = self._get_tool().process_files(self._filepairs, 8)
+        self.assertEqual([None] * self._NR_FILES, errors)
+        self._check_outputs()
+
+    def test_preloaded_library(self):
+        '''Tests that each thread uses its own copy of preloaded macros.'''
+        tool = self._get_tool('--preload', self._path('lib.fypp'))
+        errors = tool.process_files(self._filepairs, 8)
+        self.assertEqual([None] * self._NR_FILES, errors)
+        self._check_outputs()
+
+    def test_failing_file(self):
+        '''Tests that errors are returned for the failing files only.'''
+        self._write('in3.fypp', '#:include "common.inc"\n${UNDEFINED}$\n')
+        errors = self._get_tool().process_files(self._filepairs[:8], 4)
+        self.assertIsInstance(errors[3], fypp.FyppFatalError)
+        self.assertEqual([None] * 7, errors[:3] + errors[4:])
+
+
+class AsyncFyppTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the asyncio interface.'''
+
+    @staticmethod
+    def _get_options(*args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(['-m', 'time'] + list(args))
+        return options
+
+    def test_concurrent_texts(self):
+        '''Tests that concurrently processed texts are not mixed up.'''
+        async def process():
+            async with fypp.AsyncFypp(self._get_options('-DX=1'), 4) as tool:
+                return await asyncio.gather(
+                    *[tool.process_text('#:set Y = {0}\n${{X + Y}}$\n'\
+                                        .format(ind)) for ind in range(20)])
+        results = asyncio.run(process())
+        self.assertEqual(['{0}\n'.format(ind + 1) for ind in range(20)],
+                         results)
+
+    def test_error(self):
+        '''Tests that errors are raised in the awaiting task.'''
+        async def process():
+            async with fypp.AsyncFypp(self._get_options()) as tool:
+                await tool.process_text('${UNDEFINED}$\n')
+        with self.assertRaises(fypp.FyppFatalError):
+            asyncio.run(process())
+
+    def test_cancellation(self):
+        '''Tests that cancelled processings raise an error and do not write
+        any output.'''
+        infile = self._path('slow.fypp')
+        self._write('slow.fypp', '${time.sleep(0.2) or "slow"}$\n')
+        outfiles = [self._path('out{0}.f90'.format(ind)) for ind in range(2)]
+
+        async def process():
+            async with fypp.AsyncFypp(self._get_options(), 1) as tool:
+                tasks = [asyncio.ensure_future(tool.process_file(infile, fname))
+                         for fname in outfiles]
+                await asyncio.sleep(0.05)
+                for task in tasks:
+                    task.cancel()
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.sleep(0.3)
+                return results
+
+        results = asyncio.run(process())
+        for result in results:
+            self.assertIsInstance(result, fypp.FyppFatalError)
+        for fname in outfiles:
+            self.assertFalse(os.path.exists(fname))
+
+
+class TrivialExpressionTest(unittest.TestCase):
+    '''Tests the evaluation of trivial expressions without eval().'''
+
+    def setUp(self):
+        self._evaluator = fypp.Evaluator()
+        self._evaluator.define('LIST', [1, 2, 3])
+        self._evaluator.define('DICT', {'a': 'b'})
+        self._evaluator.define('NUM', 3)
+        self._evaluator.define('NONE', None)
+
+    def _get_error(self, expr):
+        try:
+            self._evaluator.evaluate(expr)
+        except Exception as exc:
+            return type(exc), str(exc)
+        self.fail('No exception was raised')
+
+    def test_classification(self):
+        '''Tests which expressions are considered to be trivial.'''
+        for expr in ('NUM', ' 3', '"a"', '-1.5', 'NUM.real', 'LIST[0]',
+                     'DICT["a"]', 'LIST[NUM]', 'NUM > 1', 'NONE is None',
+                     '"a" in DICT', 'DICT["a"].upper'):
+            self.assertIsNotNone(fypp._get_trivial_evaluator(expr), expr)
+        for expr in ('[1]', 'f(1)', 'NUM + 1', '1 < NUM < 4', 'LIST[1:]',
+                     '{}', 'not NUM', 'NUM >'):
+            self.assertIsNone(fypp._get_trivial_evaluator(expr), expr)
+
+    def test_results(self):
+        '''Tests that trivial expressions yield the eval() result.'''
+        for expr, result in (('NUM', 3), ('"a"', 'a'), ('-1.5', -1.5),
+                             ('LIST[-1]', 3), ('DICT["a"]', 'b'),
+                             ('LIST[NUM - 1]', 3), ('NUM >= 3', True),
+                             ('NONE is not None', False), ('2 in LIST', True),
+                             ('len is None', False), ('defined("NUM")', True)):
+            self.assertEqual(result, self._evaluator.evaluate(expr), expr)
+
+    def test_errors(self):
+        '''Tests that trivial expressions raise the eval() errors.'''
+        for expr in ('UNDEFINED', 'NUM == UNDEFINED', 'NUM.undefined',
+                     'LIST[3]', 'DICT["c"]', 'NUM < "a"', 'NUM[0]'):
+            self.assertEqual(self._get_error(expr),
+                             self._get_error('[' + expr + '][0]'), expr)
+        self.assertEqual((NameError, "name 'UNDEFINED' is not defined"),
+                         self._get_error('UNDEFINED'))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'processes can not be forked')
+class ParallelLoopTest(unittest.TestCase):
+    '''Tests the worker processes of parallel loops.'''
+
+    def _get_pids(self, txt):
+        options = fypp.FyppOptions()
+        options.loop_workers = 2
+        options.modules = ['os']
+        output = fypp.Fypp(options).process_text(txt)
+        return [set(block.split()) for block in output.split('-\n')]
+
+    def test_pool_reuse(self):
+        '''Tests that the workers are reused by the loops of a render.'''
+        pids1, pids2 = self._get_pids(
+            '#:for parallel i in range(4)\n${os.getpid()}$\n#:endfor\n-\n'
+            '#:set x = 1\n#:for parallel i in range(4)\n${os.getpid() * x}$\n'
+            '#:endfor\n')
+        self.assertNotIn(str(os.getpid()), pids1)
+        # Workers forked again would have different process ids
+        self.assertLessEqual(len(pids1 | pids2), 2)
+
+    def test_new_macro(self):
+        '''Tests that workers are forked again for macros defined later.'''
+        pids1, pids2 = self._get_pids(
+            '#:for parallel i in range(4)\n${os.getpid()}$\n#:endfor\n-\n'
+            '#:def pid()\n${os.getpid()}$\n#:enddef\n'
+            '#:for parallel i in range(4)\n$:pid()\n#:endfor\n')
+        self.assertTrue(pids1.isdisjoint(pids2))
+
+    def test_cache_block(self):
+        '''Tests that loops with cache blocks render as serial loops.'''
+        txt = '#:for parallel i in range(4)\n#:cache i % 2\n${i}$\n'\
+            '#:endcache\n#:endfor\n'
+        outputs = []
+        for loopworkers in (1, 2):
+            options = fypp.FyppOptions()
+            options.loop_workers = loopworkers
+            outputs.append(fypp.Fypp(options).process_text(txt))
+        self.assertEqual('0\n1\n0\n1\n', outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class SpecializerTest(unittest.TestCase):
+    '''Tests the specialization of trees for fixed variables.'''
+
+    def _get_tree(self, txt):
+        builder = fypp.Builder()
+        processor = fypp.Processor(builder=builder)
+        processor._parser.parse(txt)
+        return builder.tree
+
+    def _specialize(self, txt, fixedvalues):
+        evaluator = fypp.Evaluator()
+        for name, value in fixedvalues.items():
+            evaluator.define(name, value)
+        specializer = fypp._Specializer(evaluator, fixedvalues)
+        return specializer.specialize(self._get_tree(txt))
+
+    def test_pruned_branches(self):
+        '''Tests that dead branches are removed and expressions folded.'''
+        tree = self._specialize(
+            '#:if X > 1\nA\n#:elif Y\n${X + 1}$\n#:else\nC\n#:endif\n',
+            {'X': 1, 'Z': 0})
+        ifnode = tree[0].content[0]
+        self.assertEqual(['Y', 'True'], ifnode.conds)
+        self.assertEqual('2', ifnode.contents[0][0].expr)
+        self.assertEqual(3, len(ifnode.spans))
+
+    def test_unknown_scope_access(self):
+        '''Tests that trees accessing variables by computed names are not
+        specialized.'''
+        tree = self._get_tree('$:setvar(NAME, 1)\n#:if X\nA\n#:endif\n')
+        evaluator = fypp.Evaluator()
+        evaluator.define('X', 1)
+        specializer = fypp._Specializer(evaluator, {'X': 1})
+        self.assertIs(tree, specializer.specialize(tree))
+
+    def test_changed_value(self):
+        '''Tests that variables with values changed since the creation of the
+        specializer are not folded.'''
+        evaluator = fypp.Evaluator()
+        evaluator.define('X', 2)
+        specializer = fypp._Specializer(evaluator, {'X': 1})
+        tree = self._get_tree('${X}$\n')
+        self.assertIs(tree, specializer.specialize(tree))
+
+    def test_rebound_builtins(self):
+        '''Tests that builtins rebound by definitions are not folded.'''
+        args = ['-DX=1', '-Dmax=lambda *a: 99', '-Dlen=str']
+        for specialize in ([], ['--specialize']):
+            optparser = fypp.get_option_parser()
+            options, _ = optparser.parse_args(args + specialize)
+            tool = fypp.Fypp(options)
+            self.assertEqual('99\n', tool.process_text('${max(X, 2)}$\n'))
+            with self.assertRaises(fypp.FyppFatalError):
+                tool.process_text('${len("ab") + X}$\n')
+
+
+class DefineUsageTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the recording of the variables read during the processing.'''
+
+    _INPUT = '#:def macro()\n${A}$\n#:enddef\n@:macro()\n'\
+             '${defined("C") or getvar("D", 0)}$\n#:set E = 1\n${E + len([])}$\n'
+
+    def _get_tool(self, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['--define-usage', '-DA=1', '-DB=2'] + list(args))
+        return fypp.Fypp(options)
+
+    def test_manifest(self):
+        '''Tests the content of the manifest.'''
+        tool = self._get_tool()
+        tool.process_text(self._INPUT)
+        self.assertEqual({'variables': ['A', 'C', 'D', 'E', 'macro'],
+                          'definitions': {'A': '1'}},
+                         tool.get_define_usage())
+
+    def test_specialized(self):
+        '''Tests that variables read by folded expressions are recorded.'''
+        tool = self._get_tool('--specialize')
+        tool.process_text('#:if B > 1\nA\n#:endif\n')
+        self.assertEqual({'variables': ['B'], 'definitions': {'B': '2'}},
+                         tool.get_define_usage())
+
+    def test_manifest_file(self):
+        '''Tests that the manifest is written next to the output file.'''
+        tool = self._get_tool()
+        self._write('test.fypp', self._INPUT)
+        outfile = self._path('test.f90')
+        tool.process_file(self._path('test.fypp'), outfile)
+        with open(outfile + '.defines.json') as fp:
+            self.assertEqual(tool.get_define_usage(), json.load(fp))
+
+    def test_caches(self):
+        '''Tests that variables read by cached blocks and macros are recorded
+        when the cached output is available.'''
+        txt = '#:cache 1\n${A}$\n#:endcache\n'\
+              '#:def macro(x) pure\n${x + B}$\n#:enddef\n${macro(1)}$\n'
+        tool = self._get_tool('--block-cache-dir', self._root)
+        for _ in range(2):
+            tool.process_text(txt)
+            self.assertEqual(['A', 'B', 'macro', 'x'],
+                             tool.get_define_usage()['variables'])
+
+
+class MemoryReportTest(unittest.TestCase):
+    '''Tests the report of the memory usage of the processing phases.'''
+
+    def test_report(self):
+        '''Tests the phases and the statistics of the report.'''
+        options = fypp.FyppOptions()
+        options.memory_report = True
+        tool = fypp.Fypp(options)
+        tool.process_text('#:def m(x)\n${x}$\n#:enddef\n'
+                          '#:for i in range(3)\n#:if i > 0\n@:m(${i}$)\n'
+                          '#:endif\n#:endfor\n')
+        report = tool.get_memory_report()
+        self.assertEqual(['parse', 'render', 'join', 'write'],
+                         [name for name, _, _ in report['phases']])
+        for _, retained, peak in report['phases']:
+            self.assertLessEqual(retained, peak)
+        # Input file > for > if > call > argument
+        self.assertEqual(5, report['tree']['depth'])
+        self.assertEqual(1, report['macros']['macros'])
+        self.assertEqual(2, report['evals']['entries'])
+        self.assertIn('depth 5',
+                      fypp._formatted_memory_report(report))
+
+    def test_no_report(self):
+        '''Tests that no report is created by default.'''
+        tool = fypp.Fypp(fypp.FyppOptions())
+        tool.process_text('A\n')
+        self.assertIsNone(tool.get_memory_report())
+
+    def test_failing_processing(self):
+        '''Tests that tracing is stopped, if the processing fails.'''
+        options = fypp.FyppOptions()
+        options.memory_report = True
+        tool = fypp.Fypp(options)
+        with self.assertRaises(fypp.FyppFatalError):
+            tool.process_text('${undefined}$\n')
+        self.assertFalse(tracemalloc.is_tracing())
+        tool.process_text('A\n')
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class ExpansionReportTest(unittest.TestCase):
+    '''Tests the attribution of the output to the source lines.'''
+
+    _INPUT = '#:def m(x)\n${x}$${x}$\n#:enddef\nA\n'\
+             '#:for i in range(3)\n@:m(ab)\n#:endfor\n#:mute\nB\n#:endmute\n'
+
+    def test_report(self):
+        '''Tests the attribution of the output to sites and files.'''
+        options = fypp.FyppOptions()
+        options.expansion_report = 10
+        tool = fypp.Fypp(options)
+        output = tool.process_text(self._INPUT)
+        report = tool.get_expansion_report()
+        self.assertEqual({'chars': len(output), 'lines': 4}, report['total'])
+        self.assertEqual(
+            [{'file': fypp.STRING, 'line': 6, 'chars': 15, 'lines': 3},
+             {'file': fypp.STRING, 'line': 4, 'chars': 2, 'lines': 1}],
+            report['sites'])
+        self.assertEqual(
+            [{'file': fypp.STRING, 'input_chars': len(self._INPUT),
+              'input_lines': 10, 'output_chars': 17, 'output_lines': 4,
+              'ratio': 17 / len(self._INPUT)}],
+            report['files'])
+        txt = fypp._formatted_expansion_report(report, 1)
+        self.assertIn('Top 1 of 2 source lines:\n{0}:6: 15 characters'\
+                      .format(fypp.STRING), txt)
+
+    def test_line_markers(self):
+        '''Tests that line markers are attributed as well.'''
+        options = fypp.FyppOptions()
+        options.expansion_json = 'report.json'
+        options.line_numbering = True
+        tool = fypp.Fypp(options)
+        output = tool.process_text(self._INPUT)
+        report = tool.get_expansion_report()
+        self.assertEqual(len(output), report['total']['chars'])
+        self.assertEqual(len(output), sum(site['chars']
+                                          for site in report['sites']))
+
+    def test_failed_render(self):
+        '''Tests that the render depth is restored if rendering fails.'''
+        tracker = fypp._ExpansionTracker()
+        tracker.start()
+        renderer = fypp.Renderer()
+        renderer.set_expansion_tracker(tracker)
+        builder = fypp.Builder()
+        fypp.Processor(builder=builder)._parser.parse(
+            '#:mute\n${1 // 0}$\n#:endmute\n')
+        with self.assertRaises(fypp.FyppFatalError):
+            renderer.render(builder.tree)
+        self.assertEqual(0, tracker.renderdepth)
+
+
+class _RecordingHooks(fypp.FyppHooks):
+    '''Records the events, which were notified.'''
+
+    def __init__(self):
+        self.events = []
+
+    def parse_begin(self, fname):
+        self.events.append(('parse_begin', fname))
+
+    def parse_end(self, fname, tree):
+        self.events.append(('parse_end', fname))
+
+    def macro_call_begin(self, name, fname, linenr):
+        self.events.append(('macro_call_begin', name, linenr))
+
+    def macro_call_end(self, name, fname, linenr):
+        self.events.append(('macro_call_end', name, linenr))
+
+    def include_begin(self, fname, linenr, includefname):
+        self.events.append(('include_begin', linenr, includefname))
+
+    def include_end(self, fname, linenr, includefname):
+        self.events.append(('include_end', linenr, includefname))
+
+    def eval_begin(self, expr, fname, linenr):
+        self.events.append(('eval_begin', expr, linenr))
+
+    def eval_end(self, expr, fname, linenr):
+        self.events.append(('eval_end', expr, linenr))
+
+    def write_begin(self, outfile):
+        self.events.append(('write_begin', outfile))
+
+    def write_end(self, outfile):
+        self.events.append(('write_end', outfile))
+
+
+class HooksTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the notification of hooks about the processing steps.'''
+
+    def test_events(self):
+        '''Tests the order of the notified events.'''
+        tool = fypp.Fypp()
+        hooks = _RecordingHooks()
+        tool.add_hooks(hooks)
+        output = tool.process_text('#:def m(x)\n${x}$\n#:enddef\n@:m(1)\n')
+        self.assertEqual('1\n', output)
+        self.assertEqual(
+            [('parse_begin', fypp.STRING), ('parse_end', fypp.STRING),
+             ('include_begin', None, fypp.STRING),
+             ('eval_begin', 'lambda x: None', 0),
+             ('eval_end', 'lambda x: None', 0),
+             ('eval_begin', 'm', 3), ('eval_end', 'm', 3),
+             ('macro_call_begin', 'm', 0),
+             ('eval_begin', 'x', 1), ('eval_end', 'x', 1),
+             ('macro_call_end', 'm', 0),
+             ('include_end', None, fypp.STRING)],
+            hooks.events)
+
+    def test_include_and_write(self):
+        '''Tests the events of included and written files.'''
+        incfile = self._path('inc.fypp')
+        infile = self._path('in.fypp')
+        outfile = self._path('out.f90')
+        self._write('inc.fypp', 'A\n')
+        self._write('in.fypp', '#:include "inc.fypp"\n')
+        tool = fypp.Fypp()
+        hooks = _RecordingHooks()
+        tool.add_hooks(hooks)
+        tool.process_file(infile, outfile)
+        self.assertEqual(
+            [('parse_begin', infile), ('parse_end', infile),
+             ('include_begin', None, infile),
+             ('include_begin', 0, incfile), ('include_end', 0, incfile),
+             ('include_end', None, infile),
+             ('write_begin', outfile), ('write_end', outfile)],
+            hooks.events)
+
+    def test_node_events(self):
+        '''Tests that each rendered node is notified.'''
+        nodes = []
+
+        class NodeHooks(fypp.FyppHooks):
+            def render_node_begin(self, node):
+                nodes.append(('begin', type(node).__name__))
+            def render_node_end(self, node):
+                nodes.append(('end', type(node).__name__))
+
+        tool = fypp.Fypp()
+        tool.add_hooks(NodeHooks())
+        tool.process_text('A\n')
+        self.assertEqual(
+            [('begin', '_IncludeNode'), ('begin', '_TextNode'),
+             ('end', '_TextNode'), ('end', '_IncludeNode')], nodes)
+
+    def test_several_hooks(self):
+        '''Tests that all registered hooks are notified until removed.'''
+        tool = fypp.Fypp()
+        hooks1 = _RecordingHooks()
+        hooks2 = _RecordingHooks()
+        tool.add_hooks(hooks1)
+        tool.add_hooks(hooks2)
+        tool.process_text('${1}$\n')
+        self.assertEqual(hooks1.events, hooks2.events)
+        self.assertIn(('eval_begin', '1', 0), hooks1.events)
+        tool.remove_hooks(hooks1)
+        tool.process_text('${2}$\n')
+        self.assertNotIn(('eval_begin', '2', 0), hooks1.events)
+        self.assertIn(('eval_begin', '2', 0), hooks2.events)
+
+    def test_batch(self):
+        '''Tests that hooks are notified by the threads of a batch.'''
+        filepairs = []
+        for ind in range(3):
+            infile = self._path('in{0}.fypp'.format(ind))
+            self._write('in{0}.fypp'.format(ind), '${{{0}}}$\n'.format(ind))
+            filepairs.append((infile, self._path('out{0}.f90'.format(ind))))
+        tool = fypp.Fypp()
+        hooks = _RecordingHooks()
+        tool.add_hooks(hooks)
+        tool.process_files(filepairs, workers=2)
+        written = sorted(event[1] for event in hooks.events
+                         if event[0] == 'write_end')
+        self.assertEqual([outfile for _, outfile in filepairs], written)
+
+    def test_parallel_loop(self):
+        '''Tests that the iterations of parallel loops are notified.'''
+        options = fypp.FyppOptions()
+        options.loop_workers = 4
+        tool = fypp.Fypp(options)
+        hooks = _RecordingHooks()
+        tool.add_hooks(hooks)
+        output = tool.process_text(
+            '#:for parallel i in range(4)\n${i}$\n#:endfor\n')
+        self.assertEqual('0\n1\n2\n3\n', output)
+        evals = [event for event in hooks.events if event[0] == 'eval_end']
+        self.assertEqual(5, len(evals))
+
+
+class MetricsTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the collection of per file metrics.'''
+
+    def setUp(self):
+        super().setUp()
+        self._infile = self._path('in.fypp')
+        self._input = '#:include "inc.fypp"\n#:for i in range(2)\n@:m(${i}$)\n'\
+                      '#:endfor\n'
+        self._write('inc.fypp', '#:def m(x)\n${x}$\n#:enddef\n')
+        self._write('in.fypp', self._input)
+
+    def _get_tool(self, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['--metrics-file', self._path('metrics.jsonl')] + list(args))
+        return fypp.Fypp(options)
+
+    def test_record(self):
+        '''Tests the metrics of a successfully processed file.'''
+        tool = self._get_tool()
+        outfile = self._path('out.f90')
+        tool.process_file(self._infile, outfile)
+        records = tool.get_metrics()
+        self.assertEqual(1, len(records))
+        record = records[0]
+        self.assertEqual(
+            {'input': self._infile, 'output': outfile, 'status': 0,
+             'input_bytes': len(self._input), 'output_bytes': 4,
+             'includes': 1, 'evals': 8, 'macro_calls': 2, 'loops': 1,
+             'cache_hit': False},
+            {key: record[key] for key in
+             ('input', 'output', 'status', 'input_bytes', 'output_bytes',
+              'includes', 'evals', 'macro_calls', 'loops', 'cache_hit')})
+        for phase in ('parse', 'render', 'write'):
+            self.assertGreater(record[phase + '_time'], 0.0)
+
+    def test_failing_file(self):
+        '''Tests that the exit status of failing files is recorded.'''
+        self._write('in.fypp', '#:stop "no"\n')
+        tool = self._get_tool()
+        with self.assertRaises(fypp.FyppStopRequest):
+            tool.process_file(self._infile)
+        record = tool.get_metrics()[0]
+        self.assertEqual(fypp.USER_ERROR_EXIT_CODE, record['status'])
+        self.assertIsNone(record['output_bytes'])
+
+    def test_cache_hit(self):
+        '''Tests that outputs taken from the output cache are recorded.'''
+        cachedir = self._path('cache')
+        self._get_tool('--cache-dir', cachedir).process_file(self._infile)
+        tool = self._get_tool('--cache-dir', cachedir)
+        tool.process_file(self._infile)
+        record = tool.get_metrics()[0]
+        self.assertTrue(record['cache_hit'])
+        self.assertEqual(4, record['output_bytes'])
+        self.assertEqual(0, record['evals'])
+        self.assertEqual(1, record['includes'])
+
+    def test_batch(self):
+        '''Tests that each file of a batch gets its own record.'''
+        filepairs = [(self._infile, self._path('out{0}.f90'.format(ind)))
+                     for ind in range(4)]
+        tool = self._get_tool()
+        tool.process_files(filepairs, 2)
+        records = tool.get_metrics()
+        self.assertEqual(sorted(outfile for _, outfile in filepairs),
+                         sorted(record['output'] for record in records))
+        self.assertEqual([2] * 4, [record['macro_calls']
+                                   for record in records])
+
+    def test_write(self):
+        '''Tests that records are appended as JSON lines.'''
+        fname = self._path('metrics.jsonl')
+        records = [{'input': 'a.fypp', 'status': 0},
+                   {'input': 'b.fypp', 'status': 1}]
+        fypp._write_metrics(records[:1], fname)
+        fypp._write_metrics(records[1:], fname)
+        with open(fname) as fp:
+            self.assertEqual(records, [json.loads(line) for line in fp])
+
+
+class DependencyFileTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the dependency file and the write-if-changed output.'''
+
+    def setUp(self):
+        super().setUp()
+        self._infile = self._path('in.fypp')
+        self._incfile = self._path('inc.fypp')
+        self._write('in.fypp',
+                    '#:include "inc.fypp"\n#:include "inc.fypp"\n${X}$\n')
+        self._write('inc.fypp', '#:set X = 1\n')
+
+    def _get_tool(self, *args):
+        optparser = fypp.get_option_parser()
+        options, _ = optparser.parse_args(
+            ['--depfile', self._path('deps.d')] + list(args))
+        return fypp.Fypp(options)
+
+    def test_dependencies(self):
+        '''Tests that each include file is listed once.'''
+        tool = self._get_tool()
+        outfile = self._path('out.f90')
+        tool.process_file(self._infile, outfile)
+        self.assertEqual([(outfile, [self._infile, self._incfile])],
+                         tool.get_dependencies())
+
+    def test_cache_hit(self):
+        '''Tests that outputs from the output cache list their includes.'''
+        cachedir = self._path('cache')
+        outfile = self._path('out.f90')
+        self._get_tool('--cache-dir', cachedir).process_file(
+            self._infile, outfile)
+        tool = self._get_tool('--cache-dir', cachedir)
+        tool.process_file(self._infile, outfile)
+        self.assertEqual([(outfile, [self._infile, self._incfile])],
+                         tool.get_dependencies())
+
+    def test_write_depfile(self):
+        '''Tests the Makefile rules written into the dependency file.'''
+        fname = self._path('deps.d')
+        deps = [('b.f90', ['b.fypp', 'my inc.fypp']), ('a.f90', ['a.fypp'])]
+        fypp._write_depfile(deps, fname)
+        self.assertEqual('a.f90: a.fypp\nb.f90: b.fypp \\\n  my\\ inc.fypp\n',
+                         Path(fname).read_text())
+        fypp._write_depfile(deps, fname, target='$stamp')
+        self.assertEqual('$$stamp: a.fypp \\\n  b.fypp \\\n  my\\ inc.fypp\n',
+                         Path(fname).read_text())
+
+    def test_write_if_changed(self):
+        '''Tests that unchanged outputs keep their modification time.'''
+        outfile = self._path('out.f90')
+        tool = self._get_tool('--write-if-changed')
+        tool.process_file(self._infile, outfile)
+        os.utime(outfile, (0, 0))
+        tool.process_file(self._infile, outfile)
+        self.assertEqual(0, os.path.getmtime(outfile))
+        self._write('inc.fypp', '#:set X = 2\n')
+        tool.process_file(self._infile, outfile)
+        self.assertNotEqual(0, os.path.getmtime(outfile))
+        self.assertEqual('2\n', Path(outfile).read_text())
+
+
+def _find_fortran_compiler():
+    compiler = os.environ.get('FC')
+    if compiler:
+        return shutil.which(compiler)
+    return shutil.which('gfortran')
+
+
+@unittest.skipUnless(shutil.which('cmake') and _find_fortran_compiler(),
+                     'needs CMake and a Fortran compiler')
+class CMakeIntegrationTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the FyppPreprocess CMake module with its example project.'''
+
+    _ROOT = Path(__file__).resolve().parent.parent
+
+    def setUp(self):
+        super().setUp()
+        # Copy of the module and the example, so that the test can touch the
+        # include file of the example
+        cmakedir = self._path('cmake')
+        shutil.copytree(str(self._ROOT / 'tools' / 'cmake'), cmakedir)
+        self._srcdir = os.path.join(cmakedir, 'example')
+        self._builddir = self._path('build')
+
+    def _run(self, *args):
+        result = subprocess.run(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        self.assertEqual(0, result.returncode, result.stdout)
+        return result.stdout
+
+    def _build(self):
+        return self._run('cmake', '--build', self._builddir)
+
+    def test_build(self):
+        '''Tests the build and the rebuild after an include changes.'''
+        fyppcmd = str(self._ROOT / 'bin' / 'fypp')
+        self._run('cmake', '-S', self._srcdir, '-B', self._builddir,
+                  '-DFYPP_EXECUTABLE=' + fyppcmd,
+                  '-DCMAKE_Fortran_COMPILER=' + _find_fortran_compiler())
+        self.assertIn('Preprocessing Fypp sources', self._build())
+        executable = os.path.join(self._builddir, 'fyppexample')
+        self.assertEqual('Total: 11.0', self._run(executable).strip())
+        generated = os.path.join(self._builddir, 'sums.f90')
+        mtime = os.path.getmtime(generated)
+        self.assertNotIn('Preprocessing Fypp sources', self._build())
+        incfile = os.path.join(self._srcdir, 'include', 'common.fypp')
+        os.utime(incfile, (mtime + 10, mtime + 10))
+        self.assertIn('Preprocessing Fypp sources', self._build())
+        self.assertEqual(mtime, os.path.getmtime(generated))
+
+
+class PreloadTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the processing of files with preloaded libraries.'''
+
+    def test_isolation(self):
+        '''Tests that each processing starts with the preloaded definitions.'''
+        options = fypp.FyppOptions()
+        tool = fypp.Fypp(options)
+        self._write('lib.fypp',
+                    '#:set ITEMS = [1]\n#:def items()\n${ITEMS}$\n#:enddef\n')
+        tool.preload(self._path('lib.fypp'))
+        txt = '$:ITEMS.append(2) or ""\n#:set X = 1\n@:items()\n'
+        self.assertEqual('\n[1, 2]\n', tool.process_text(txt))
+        self.assertEqual('\n[1, 2]\n', tool.process_text(txt))
+        self.assertEqual('False\n', tool.process_text('${defined("X")}$\n'))
+
+
+class WatchTest(_TempDirMixin, unittest.TestCase):
+    '''Tests the reprocessing of changed files in watch mode.'''
+
+    def setUp(self):
+        super().setUp()
+        self._write('a.fypp', '#:include "a.inc"\n${X}$\n')
+        self._write('a.inc', '#:set X = 1\n')
+        self._write('b.fypp', 'b\n')
+        filepairs = [(self._path('a.fypp'), self._path('a.f90')),
+                     (self._path('b.fypp'), self._path('b.f90'))]
+        self._watcher = fypp._FileWatcher(fypp.FyppOptions(), filepairs)
+
+    def _updated(self):
+        return [(os.path.basename(outfile), error is None)
+                for outfile, _, error in self._watcher.update()]
+
+    def test_unchanged(self):
+        '''Tests that files are only processed again after a change.'''
+        self.assertEqual([('a.f90', True), ('b.f90', True)], self._updated())
+        self.assertEqual([], self._updated())
+
+    def test_changed_include(self):
+        '''Tests that only files depending on a changed include are
+        processed again.'''
+        self._updated()
+        self._write('a.inc', '#:set X = 12\n')
+        self.assertEqual([('a.f90', True)], self._updated())
+        with open(self._path('a.f90')) as fp:
+            self.assertEqual('12\n', fp.read())
+
+    def test_failing_file(self):
+        '''Tests that a failing file is processed again after a change.'''
+        self._write('a.inc', '#:set X = \n')
+        self.assertEqual([('a.f90', False), ('b.f90', True)], self._updated())
+        self.assertEqual([], self._updated())
+        self._write('a.inc', '#:set X = 2\n')
+        self.assertEqual([('a.f90', True)], self._updated())
+
+
 if __name__ == '__main__':
     unittest.main()
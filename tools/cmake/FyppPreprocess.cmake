@@ -0,0 +1,144 @@
+#[=======================================================================[.rst:
+FyppPreprocess
+--------------
+
+Preprocesses Fortran sources with Fypp and adds the results to a target.
+
+All sources of a target are processed by a single Fypp invocation, which
+processes the files concurrently (``--jobs``). Fypp writes a dependency file
+listing the files included by each source, so that the sources are reprocessed
+whenever any of their include files changes. Generated files are only
+rewritten if their content changes (``--write-if-changed``), so that an
+unchanged result does not trigger the recompilation of the target.
+
+The module requires CMake 3.20 or newer (dependency files for all generators).
+
+.. command:: fypp_target_sources
+
+  ::
+
+    fypp_target_sources(<target> <source>...
+                        [FLAGS <flag>...]
+                        [INCLUDE_DIRECTORIES <dir>...]
+                        [OUTPUT_DIRECTORY <dir>]
+                        [OUTPUT_EXTENSION <ext>]
+                        [JOBS <n>])
+
+  Preprocesses the given sources and adds the generated files as private
+  sources to ``<target>``. Relative source paths are interpreted relative to
+  the current source directory.
+
+  ``FLAGS``
+    Additional command line options for Fypp (e.g. ``-DDEBUG=1``).
+
+  ``INCLUDE_DIRECTORIES``
+    Directories to search for include files (``-I``). Relative paths are
+    interpreted relative to the current source directory.
+
+  ``OUTPUT_DIRECTORY``
+    Directory to write the generated files into. Default:
+    ``${CMAKE_CURRENT_BINARY_DIR}``.
+
+  ``OUTPUT_EXTENSION``
+    Extension replacing the last extension of each source. Default: ``.f90``.
+
+  ``JOBS``
+    Number of files Fypp processes concurrently. Default: number of logical
+    cores of the host.
+
+  The Fypp command is taken from the ``FYPP_EXECUTABLE`` variable, which is
+  searched for in the path, if not set.
+
+Example::
+
+  list(APPEND CMAKE_MODULE_PATH "${CMAKE_CURRENT_SOURCE_DIR}/cmake")
+  include(FyppPreprocess)
+
+  add_executable(myprog main.f90)
+  fypp_target_sources(myprog mymod.fypp utils.fypp
+                      INCLUDE_DIRECTORIES include FLAGS -DDEBUG=0)
+#]=======================================================================]
+
+include_guard(GLOBAL)
+
+if(CMAKE_VERSION VERSION_LESS 3.20)
+  message(FATAL_ERROR "FyppPreprocess requires CMake 3.20 or newer")
+endif()
+
+find_program(FYPP_EXECUTABLE NAMES fypp DOC "Fypp preprocessor")
+
+
+function(fypp_target_sources target)
+
+  cmake_parse_arguments(PARSE_ARGV 1 _fypp ""
+    "OUTPUT_DIRECTORY;OUTPUT_EXTENSION;JOBS" "FLAGS;INCLUDE_DIRECTORIES")
+
+  if(NOT FYPP_EXECUTABLE)
+    message(FATAL_ERROR "Fypp not found, set FYPP_EXECUTABLE")
+  endif()
+  if(NOT _fypp_UNPARSED_ARGUMENTS)
+    message(FATAL_ERROR "fypp_target_sources: no sources given")
+  endif()
+  if(NOT _fypp_OUTPUT_DIRECTORY)
+    set(_fypp_OUTPUT_DIRECTORY "${CMAKE_CURRENT_BINARY_DIR}")
+  endif()
+  get_filename_component(outdir "${_fypp_OUTPUT_DIRECTORY}" ABSOLUTE
+    BASE_DIR "${CMAKE_CURRENT_BINARY_DIR}")
+  if(NOT DEFINED _fypp_OUTPUT_EXTENSION)
+    set(_fypp_OUTPUT_EXTENSION ".f90")
+  endif()
+
+  set(options ${_fypp_FLAGS})
+  foreach(incdir IN LISTS _fypp_INCLUDE_DIRECTORIES)
+    get_filename_component(incdir "${incdir}" ABSOLUTE)
+    list(APPEND options "-I${incdir}")
+  endforeach()
+
+  # File pairs of all sources, processed by a single Fypp invocation
+  set(filepairs)
+  set(infiles)
+  set(outfiles)
+  foreach(source IN LISTS _fypp_UNPARSED_ARGUMENTS)
+    get_filename_component(infile "${source}" ABSOLUTE)
+    get_filename_component(name "${source}" NAME_WLE)
+    set(outfile "${outdir}/${name}${_fypp_OUTPUT_EXTENSION}")
+    if(outfile IN_LIST outfiles)
+      message(FATAL_ERROR
+        "fypp_target_sources: several sources map to '${outfile}'")
+    endif()
+    list(APPEND filepairs "${infile}" "${outfile}")
+    list(APPEND infiles "${infile}")
+    list(APPEND outfiles "${outfile}")
+  endforeach()
+
+  if(_fypp_JOBS)
+    set(jobs ${_fypp_JOBS})
+  else()
+    cmake_host_system_information(RESULT jobs QUERY NUMBER_OF_LOGICAL_CORES)
+  endif()
+
+  # Several calls for the same target must not share a dependency file
+  string(MD5 hash "${outfiles}")
+  string(SUBSTRING "${hash}" 0 8 hash)
+  set(depfile "${CMAKE_CURRENT_BINARY_DIR}/${target}-fypp-${hash}.d")
+
+  # The stamp file records the time of the last invocation, as unchanged
+  # outputs keep their modification time
+  set(stamp "${CMAKE_CURRENT_BINARY_DIR}/${target}-fypp-${hash}.stamp")
+
+  add_custom_command(
+    OUTPUT "${stamp}"
+    BYPRODUCTS ${outfiles}
+    COMMAND "${FYPP_EXECUTABLE}" ${options} --create-parents
+            --write-if-changed --depfile "${depfile}"
+            --depfile-target "${stamp}" --jobs ${jobs}
+            ${filepairs}
+    COMMAND "${CMAKE_COMMAND}" -E touch "${stamp}"
+    DEPENDS ${infiles}
+    DEPFILE "${depfile}"
+    COMMENT "Preprocessing Fypp sources of target ${target}"
+    VERBATIM)
+
+  target_sources(${target} PRIVATE "${stamp}" ${outfiles})
+
+endfunction()
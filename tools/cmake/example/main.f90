@@ -0,0 +1,11 @@
+program fyppexample
+  use sums, only : total
+  implicit none
+
+  real :: array1(3), array2(2, 2)
+
+  array1(:) = 1.0
+  array2(:,:) = 2.0
+  print "(A,F4.1)", "Total: ", total(array1) + total(array2)
+
+end program fyppexample